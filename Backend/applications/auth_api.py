@@ -1,7 +1,15 @@
 from applications.user_datastore import user_datastore
 from flask_restful import Resource
 from flask import make_response, jsonify, request
-from flask_security import utils, auth_token_required
+from flask_security import utils, auth_token_required, roles_required, current_user
+from applications.principal_cache import principal_cache
+from applications.password_pool import password_pool, PoolSaturated
+
+
+def busy_response():
+    response = make_response(jsonify({'message':'Server is busy, please try again'}),503)
+    response.headers['Retry-After'] = '1'
+    return response
 
 
 
@@ -19,9 +27,19 @@ class Login(Resource):
         if not user:
             return make_response(jsonify({'message':'Invalid Credentials - User doesn\'t exist '}),401)
         
-        if not utils.verify_password(password, user.password):
+        try:
+            verified, new_hash = password_pool.verify_and_update(password, user.password)
+        except PoolSaturated:
+            return busy_response()
+
+        if not verified:
             return make_response(jsonify({'message':'Invalid Credentials - Invalid Password'}),401)
 
+        if new_hash: # Stored hash was made with an older scheme or cost, upgrade it
+            user.password = new_hash
+            user_datastore.put(user)
+            user_datastore.commit()
+
         utils.login_user(user)
         auth_token = user.get_auth_token()
 
@@ -78,9 +96,14 @@ class Register(Resource):
         if role not in ['admin','user']:
             return make_response(jsonify({'message':'Invalid Role'}),400)
         
+        try:
+            password_hash = password_pool.hash_password(password)
+        except PoolSaturated:
+            return busy_response()
+
         try:
             role = user_datastore.find_role(role)
-            user = user_datastore.create_user(email=email, username=username, password=utils.hash_password(password),roles=[role]) 
+            user = user_datastore.create_user(email=email, username=username, password=password_hash,roles=[role]) 
             user_datastore.commit()
             # auth_token = user.get_auth_token()
 
@@ -99,5 +122,13 @@ class Register(Resource):
 class Logout(Resource):
     @auth_token_required
     def post(self):
+        principal_cache.evict(current_user.fs_token_uniquifier)
         utils.logout_user()
-        return make_response(jsonify({'message':'Logout Successful'}),200)
\ No newline at end of file
+        return make_response(jsonify({'message':'Logout Successful'}),200)
+
+
+class PrincipalCacheStats(Resource):
+    @auth_token_required
+    @roles_required('admin')
+    def get(self):
+        return make_response(jsonify(principal_cache.stats()),200)
\ No newline at end of file
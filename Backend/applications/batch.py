@@ -0,0 +1,130 @@
+import inspect
+import re
+from urllib.parse import urlsplit
+from flask import current_app, make_response, jsonify, request
+from flask_restful import Resource
+from flask_security import auth_token_required, roles_required
+from werkzeug.exceptions import HTTPException
+from applications.database import db, begin_immediate, BATCH
+from applications.cache import deferred_evictions
+from applications.library_management_api import Books, Sections
+
+# POST /api/v1/batch - several Books/Sections operations in one request and one transaction.
+#   {"mode": "atomic", "operations": [
+#       {"method": "POST", "path": "/section", "body": {"name": "Poetry", "description": "..."}},
+#       {"method": "POST", "path": "/book", "body": {"title": "...", "section_id": "$0.section.section_id", ...}},
+#       {"method": "PUT", "path": "/section/3", "body": {"description": "..."}}]}
+# answers {"mode", "committed", "results": [{"status", "body"} per operation]}.
+# The token and the admin role are checked once for the whole batch. Every operation runs the
+# resource's handler (without its auth decorators and response cache) in its own SAVEPOINT, and the
+# handlers' commits only flush (see RoutingSession.commit), so the batch commits once at the end.
+#   atomic (default): the first operation answering >= 400 rolls everything back, the rest is not run
+#   independent:      a failed operation is rolled back to its savepoint alone, the others are committed
+# A string "$<n>.<key>..." in a body or a path segment ("/book/$1.book.book_id") is replaced by that
+# field of the response of operation n.
+
+MODES = ('atomic', 'independent')
+METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE')
+RESOURCES = {'books':Books, 'sections':Sections}
+
+_REFERENCE = re.compile(r'^\$(\d+)((?:\.\w+)*)$')
+
+
+def resolve(value, results):
+    # Replaces the "$<n>.<key>..." references in a value by the values they point at
+    if isinstance(value, dict):
+        return {key:resolve(item, results) for key, item in value.items()}
+    if isinstance(value, list):
+        return [resolve(item, results) for item in value]
+    match = _REFERENCE.match(value) if isinstance(value, str) else None
+    if not match:
+        return value
+    index = int(match.group(1))
+    if index >= len(results) or results[index]['status'] >= 400:
+        raise ValueError(f'{value} refers to an operation that did not succeed')
+    resolved = results[index]['body']
+    for key in filter(None, match.group(2).split('.')):
+        if not isinstance(resolved, dict) or key not in resolved:
+            raise ValueError(f'{value}: operation {index} answered no {key}')
+        resolved = resolved[key]
+    return resolved
+
+
+def run_operation(adapter, operation, results):
+    # Dispatches one operation to its resource handler. Returns (status, body).
+    method = str(operation.get('method', 'GET')).upper()
+    url = urlsplit(str(operation.get('path', '')))
+    try:
+        path = '/'.join(str(resolve(part, results)) for part in url.path.split('/'))
+        path = path if path.startswith('/api/') else '/api/v1' + path
+        body = resolve(operation.get('body'), results)
+        endpoint, view_args = adapter.match(path, method=method)
+    except ValueError as e:
+        return 400, {'message':str(e)}
+    except HTTPException as e:
+        return e.code, {'message':e.description}
+    if endpoint not in RESOURCES:
+        return 400, {'message':f'{method} {url.path} cannot be batched'}
+    if method not in METHODS or not hasattr(RESOURCES[endpoint], method.lower()):
+        return 405, {'message':f'{method} is not allowed on {url.path}'}
+
+    resource = RESOURCES[endpoint]()
+    handler = inspect.unwrap(getattr(RESOURCES[endpoint], method.lower()))
+    with current_app.test_request_context(path, method=method, query_string=url.query, json=body):
+        try:
+            response = current_app.make_response(handler(resource, **view_args))
+        except HTTPException as e:
+            return e.code, {'message':e.description}
+        except Exception as e:
+            return 500, {'message':str(e)}
+    return response.status_code, response.get_json(silent=True)
+
+
+class Batch(Resource):
+    @auth_token_required
+    @roles_required('admin')
+    def post(self):
+        data = request.get_json(silent=True) or {}
+        mode = data.get('mode', 'atomic')
+        operations = data.get('operations')
+        limit = current_app.config.get('BATCH_MAX_OPERATIONS', 100)
+        if mode not in MODES:
+            return make_response(jsonify({'message':'mode must be %s' % ' or '.join(MODES)}),400)
+        if not isinstance(operations, list) or not operations or not all(isinstance(op, dict) for op in operations):
+            return make_response(jsonify({'message':'operations must be a list of operations'}),400)
+        if len(operations) > limit:
+            return make_response(jsonify({'message':f'A batch takes at most {limit} operations'}),400)
+
+        adapter = current_app.url_map.bind_to_environ(request.environ)
+        session = db.session()
+        results = []
+        failed = None
+        with deferred_evictions():
+            session.info[BATCH] = True
+            try:
+                if any(str(op.get('method', 'GET')).upper() != 'GET' for op in operations):
+                    begin_immediate(session) # the write lock for the whole batch, taken once
+                for index, operation in enumerate(operations):
+                    savepoint = session.begin_nested()
+                    status, body = run_operation(adapter, operation, results)
+                    results.append({'status':status, 'body':body})
+                    if status < 400:
+                        savepoint.commit()
+                        continue
+                    savepoint.rollback()
+                    if mode == 'atomic':
+                        failed = index
+                        break
+            finally:
+                session.info.pop(BATCH, None)
+
+            if failed is None:
+                session.commit()
+            else:
+                session.rollback()
+
+        if failed is not None:
+            results += [{'status':424, 'body':{'message':'Not run, an earlier operation failed'}}
+                        for _ in operations[len(results):]]
+            return make_response(jsonify({'mode':mode, 'committed':False, 'failed':failed, 'results':results}),400)
+        return make_response(jsonify({'mode':mode, 'committed':True, 'results':results}),200)
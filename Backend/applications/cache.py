@@ -0,0 +1,347 @@
+import hashlib
+import itertools
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from flask import Response, request, make_response, jsonify
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Read-through response cache for the catalog GET endpoints.
+# Every resource has a key (see the *_key helpers below). The value stored under a key is a dict of
+# {query string: (etag, body)}, so evicting a key drops every variant (pages, includes...) of that resource.
+# The query string of a variant only holds the parameters its endpoint reads, and a key keeps at most
+# CACHE_MAX_VARIANTS of them (the oldest goes first), so clients cannot grow the cache with made up queries.
+# The write handlers evict exactly the keys they touch once their transaction is committed.
+# Evicting a key also bumps its generation: a GET stores the body it built only if the generation is the
+# one it saw before reading the database, so a write committed meanwhile is not hidden behind a stale body.
+
+ALL_SECTIONS_KEY = 'sections'
+
+# Keys held back by deferred_evictions()
+_deferred = ContextVar('deferred_evictions', default=None)
+
+
+def section_key(section_id):
+    return f'section:{section_id}'
+
+
+def section_books_key(section_id):
+    return f'section:{section_id}:books'
+
+
+def book_key(book_id):
+    return f'book:{book_id}'
+
+
+class CacheBackend:
+    # Interface every backend implements. Values are opaque python objects.
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def generation(self, key):
+        # Changes whenever the key is deleted
+        raise NotImplementedError
+
+    def set_if_generation(self, key, value, generation, ttl=None):
+        # set() unless the key was deleted since generation(key) returned `generation`
+        raise NotImplementedError
+
+    def delete(self, *keys):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class NullCache(CacheBackend):
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def generation(self, key):
+        return 0
+
+    def set_if_generation(self, key, value, generation, ttl=None):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUCache(CacheBackend):
+    # In-process LRU with a per entry TTL. Only valid for a single worker process
+    # (other workers would keep serving their own copy until the TTL runs out).
+    # A deleted key's generation is the next value of one counter. Only the last maxsize deleted keys are
+    # remembered; the others report the highest generation forgotten, so a generation never goes back.
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._generations = OrderedDict()
+        self._forgotten = 0
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def _set(self, key, value, ttl):
+        self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def generation(self, key):
+        with self._lock:
+            return self._generations.get(key, self._forgotten)
+
+    def set_if_generation(self, key, value, generation, ttl=None):
+        with self._lock:
+            if self._generations.get(key, self._forgotten) == generation:
+                self._set(key, value, ttl)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+                self._generations[key] = next(self._counter)
+                self._generations.move_to_end(key)
+            while len(self._generations) > self.maxsize:
+                self._forgotten = max(self._forgotten, self._generations.popitem(last=False)[1])
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SharedCache(CacheBackend):
+    # Adapter for a cache shared by all workers. `client` only needs redis style
+    # get(key), set(key, value, ex=seconds), delete(*keys), incr(key) and expire(key, seconds) working on bytes.
+    # Generations are counters under gen:<key>, kept GENERATION_TTL seconds after the last delete. Checking
+    # and setting are two calls, a delete landing in between is still caught by the next one.
+    GENERATION_TTL = 3600
+
+    def __init__(self, client, ttl=30, prefix='lms:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return pickle.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl or self.ttl)
+
+    def generation(self, key):
+        return int(self.client.get(self.prefix + 'gen:' + key) or 0)
+
+    def set_if_generation(self, key, value, generation, ttl=None):
+        if self.generation(key) == generation:
+            self.set(key, value, ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+            for key in keys:
+                self.client.incr(self.prefix + 'gen:' + key)
+                self.client.expire(self.prefix + 'gen:' + key, self.GENERATION_TTL)
+
+    def clear(self):
+        self.client.flushdb()
+
+
+class LocalSharedClient:
+    # Local stand-in for the shared store (development and single host setups).
+    # Implements the same client interface SharedCache expects.
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ex if ex else None, value)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            expires, value = self._data.get(key, (None, b'0'))
+            if expires is not None and expires < time.monotonic():
+                expires, value = None, b'0'
+            value = str(int(value) + 1).encode()
+            self._data[key] = (expires, value)
+            return int(value)
+
+    def expire(self, key, seconds):
+        with self._lock:
+            if key in self._data:
+                self._data[key] = (time.monotonic() + seconds, self._data[key][1])
+
+    def flushdb(self):
+        with self._lock:
+            self._data.clear()
+
+
+class Cache:
+    def __init__(self):
+        self.backend = NullCache()
+        self.max_variants = 32
+
+    def init_app(self, app):
+        self.max_variants = app.config.get('CACHE_MAX_VARIANTS', self.max_variants)
+        kind = app.config.get('CACHE_BACKEND', 'lru')
+        ttl = app.config.get('CACHE_TTL', 30)
+        if kind == 'lru':
+            self.backend = LRUCache(app.config.get('CACHE_MAXSIZE', 1024), ttl)
+        elif kind == 'shared':
+            client = app.config.get('CACHE_SHARED_CLIENT') or LocalSharedClient()
+            self.backend = SharedCache(client, ttl)
+        elif kind == 'null':
+            self.backend = NullCache()
+        else:
+            raise ValueError(f'Unknown CACHE_BACKEND {kind}')
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(key, value, ttl)
+
+    def generation(self, key):
+        return self.backend.generation(key)
+
+    def set_if_generation(self, key, value, generation, ttl=None):
+        self.backend.set_if_generation(key, value, generation, ttl)
+
+    def delete(self, *keys):
+        deferred = _deferred.get()
+        if deferred is not None:
+            deferred.update(keys)
+            return
+        self.backend.delete(*keys)
+
+    def clear(self):
+        self.backend.clear()
+
+
+cache = Cache()
+
+
+@contextmanager
+def deferred_evictions():
+    # cache.delete() calls made in the block are applied when it exits. For a transaction that spans
+    # several write handlers (applications/batch.py): commit inside the block, evict after it.
+    keys = set()
+    token = _deferred.set(keys)
+    try:
+        yield keys
+    finally:
+        _deferred.reset(token)
+        if keys:
+            cache.delete(*keys)
+
+
+def evict_on_commit(session, *keys):
+    # For writes that happen away from the handlers (flush hooks, jobs): the keys are evicted once the
+    # session commits, and forgotten if it rolls back.
+    session.info.setdefault('evict_cache', set()).update(keys)
+
+
+@event.listens_for(Session, 'after_commit')
+def _evict_committed(session):
+    keys = session.info.pop('evict_cache', None)
+    if keys:
+        cache.delete(*keys)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_rolled_back(session):
+    session.info.pop('evict_cache', None)
+
+
+def etag_for(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+def _variant(params):
+    return '&'.join(f'{k}={v}' for k in sorted(params) for v in request.args.getlist(k))
+
+
+def cached(key_func, params=()):
+    # Decorator for Resource.get methods. `key_func` gets the view arguments and returns the cache key,
+    # `params` names the query parameters the view reads (the others do not change the response).
+    # Hits (and If-None-Match revalidations) are answered from the cache without touching the database.
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if 'stream' in request.args:
+                return f(*args, **kwargs)
+
+            key = key_func(**kwargs)
+            variant = _variant(params)
+            generation = cache.generation(key) # before the view reads the database
+            entry = cache.get(key) or {}
+            if variant in entry:
+                etag, body = entry[variant]
+                response = Response(body, 200, mimetype='application/json')
+                response.set_etag(etag)
+                return response.make_conditional(request)
+
+            rv = f(*args, **kwargs)
+            response = rv if isinstance(rv, Response) else make_response(jsonify(rv), 200)
+            if response.status_code != 200 or response.is_streamed:
+                return response
+
+            body = response.get_data()
+            etag = etag_for(body)
+            entry = dict(entry)
+            entry[variant] = (etag, body)
+            while len(entry) > cache.max_variants:
+                del entry[next(iter(entry))]
+            cache.set_if_generation(key, entry, generation) # not if a write evicted the key meanwhile
+
+            response.set_etag(etag)
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
@@ -0,0 +1,282 @@
+import csv
+import io
+import json
+from datetime import date
+from flask import current_app
+from sqlalchemy import select, insert
+from sqlalchemy.exc import IntegrityError
+from applications.database import db
+from applications.model import Section, Book
+from applications import search
+from applications.cache import evict_on_commit, ALL_SECTIONS_KEY, section_key, section_books_key
+
+# Bulk catalog import and export, in NDJSON (one JSON object per line) or CSV (with a header line).
+# Imports read the input as a stream and work in chunks of CATALOG_IMPORT_CHUNK_SIZE rows: every row is
+# validated on its own, the checks that need the database (section exists, id free) run once per chunk,
+# and the valid rows are inserted with one batched INSERT and indexed for search in one transaction.
+# A rejected row is reported with its line number and the load goes on. Exports stream the table in
+# batches of CATALOG_EXPORT_BATCH_SIZE rows, in the format and with the fields the import accepts,
+# so an export can be loaded back as is.
+# Used by the /api/v1/admin/import|export/<kind> endpoints and the import-catalog/export-catalog commands.
+
+FORMATS = ('ndjson', 'csv')
+MIMETYPES = {'ndjson':'application/x-ndjson', 'csv':'text/csv'}
+
+
+def _text(column):
+    limit = column.type.length
+
+    def convert(value):
+        value = str(value).strip()
+        if not value:
+            raise ValueError('must not be empty')
+        if limit and len(value) > limit:
+            raise ValueError(f'is longer than {limit} characters')
+        return value
+    return convert
+
+
+def _id(value):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('must be an integer')
+    if value < 1:
+        raise ValueError('must be a positive integer')
+    return value
+
+
+def _price(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValueError('must be a number')
+    if value < 0:
+        raise ValueError('must not be negative')
+    return value
+
+
+def _date(value):
+    try:
+        return date.fromisoformat(str(value))
+    except ValueError:
+        raise ValueError('must be a date (YYYY-MM-DD)')
+
+
+# kind: (model, {field: converter}, required fields). The fields are also the exported columns, in order.
+KINDS = {
+    'sections':(Section, {
+        'id':_id,
+        'name':_text(Section.name),
+        'description':_text(Section.description),
+        'image':_text(Section.image),
+        'date_created':_date,
+    }, {'name', 'description'}),
+    'books':(Book, {
+        'id':_id,
+        'title':_text(Book.title),
+        'content_type':_text(Book.content_type),
+        'content':_text(Book.content),
+        'author':_text(Book.author),
+        'image':_text(Book.image),
+        'date_created':_date,
+        'download_price':_price,
+        'section_id':_id,
+    }, {'title', 'content_type', 'content', 'author', 'download_price', 'section_id'}),
+}
+
+
+def guess_format(name, default='ndjson'):
+    # From a file name or a Content-Type
+    name = (name or '').lower()
+    return 'csv' if name.endswith('.csv') or 'csv' in name else default
+
+
+def read_records(stream, fmt):
+    # Yields (line number, record) from a text stream. A line that cannot be parsed is yielded as
+    # (line number, ValueError) so the caller can report it and carry on.
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            if None in record:
+                yield reader.line_num, ValueError('more values than header columns')
+                continue
+            yield reader.line_num, {key:value for key, value in record.items() if value not in ('', None)}
+        return
+
+    for line, text in enumerate(stream, 1):
+        if not text.strip():
+            continue
+        try:
+            record = json.loads(text)
+        except ValueError:
+            yield line, ValueError('invalid JSON')
+            continue
+        if not isinstance(record, dict):
+            yield line, ValueError('expected a JSON object')
+            continue
+        yield line, {key:value for key, value in record.items() if value is not None}
+
+
+def validate(kind, record):
+    # Returns the column values of one record, or raises ValueError
+    model, fields, required = KINDS[kind]
+    unknown = sorted(set(record) - set(fields))
+    if unknown:
+        raise ValueError('unknown field %s' % ', '.join(unknown))
+    missing = sorted(required - set(record))
+    if missing:
+        raise ValueError('missing %s' % ', '.join(missing))
+    row = {}
+    for name, value in record.items():
+        try:
+            row[name] = fields[name](value)
+        except ValueError as e:
+            raise ValueError(f'{name} {e}')
+    row.setdefault('date_created', date.today())
+    return row
+
+
+class ImportReport:
+    def __init__(self, kind, max_errors=100):
+        self.kind = kind
+        self.max_errors = max_errors
+        self.inserted = 0
+        self.failed = 0
+        self.chunks = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line':line, 'message':message})
+
+    def to_dict(self):
+        return {
+            'kind':self.kind,
+            'inserted':self.inserted,
+            'failed':self.failed,
+            'chunks':self.chunks,
+            'errors':sorted(self.errors, key=lambda error: error['line']), # checks on a chunk report late
+            'errors_truncated':self.failed > len(self.errors),
+        }
+
+
+def _check_chunk(kind, chunk, report):
+    # The checks that need the database, one query each for the whole chunk. Returns the rows that pass.
+    model = KINDS[kind][0]
+    taken = set()
+    explicit_ids = [row['id'] for line, row in chunk if 'id' in row]
+    if explicit_ids:
+        taken = set(db.session.execute(select(model.id).where(model.id.in_(explicit_ids))).scalars())
+    sections = None
+    if kind == 'books':
+        section_ids = {row['section_id'] for line, row in chunk}
+        sections = set(db.session.execute(select(Section.id).where(Section.id.in_(section_ids))).scalars())
+
+    rows = []
+    for line, row in chunk:
+        if 'id' in row and row['id'] in taken:
+            report.error(line, f'id {row["id"]} already exists')
+            continue
+        if sections is not None and row['section_id'] not in sections:
+            report.error(line, f'section {row["section_id"]} does not exist')
+            continue
+        if 'id' in row:
+            taken.add(row['id'])
+        rows.append((line, row))
+    return rows
+
+
+def _insert(kind, rows):
+    # Batched INSERT ... RETURNING id, one statement per set of keys (rows with and without an id).
+    # Missing keys keep their column defaults.
+    model = KINDS[kind][0]
+    groups = {}
+    for line, row in rows:
+        groups.setdefault(frozenset(row), []).append(row)
+    ids = []
+    for group in groups.values():
+        ids += db.session.execute(insert(model).returning(model.id), group).scalars().all()
+    if kind == 'books':
+        search.index_books(ids)
+        section_ids = {row['section_id'] for line, row in rows}
+        evict_on_commit(db.session, ALL_SECTIONS_KEY, *[key for section_id in section_ids
+                                                         for key in (section_key(section_id), section_books_key(section_id))])
+    else:
+        search.index_sections(ids)
+        evict_on_commit(db.session, ALL_SECTIONS_KEY)
+    return ids
+
+
+def _load_chunk(kind, chunk, report):
+    # One transaction per chunk. If the batch still hits a constraint, the chunk is retried row by row
+    # so only the offending rows are rejected.
+    report.chunks += 1
+    rows = _check_chunk(kind, chunk, report)
+    if not rows:
+        db.session.rollback()
+        return
+    try:
+        report.inserted += len(_insert(kind, rows))
+        db.session.commit()
+        return
+    except IntegrityError:
+        db.session.rollback()
+
+    for line, row in rows:
+        try:
+            report.inserted += len(_insert(kind, [(line, row)]))
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            report.error(line, str(e.orig))
+
+
+def import_catalog(kind, records, chunk_size=None, max_errors=None):
+    # Loads (line number, record) pairs (see read_records) and returns an ImportReport
+    chunk_size = chunk_size or current_app.config.get('CATALOG_IMPORT_CHUNK_SIZE', 1000)
+    report = ImportReport(kind, max_errors or current_app.config.get('CATALOG_IMPORT_MAX_ERRORS', 100))
+    chunk = []
+    for line, record in records:
+        try:
+            if isinstance(record, Exception):
+                raise record
+            chunk.append((line, validate(kind, record)))
+        except ValueError as e:
+            report.error(line, str(e))
+        if len(chunk) >= chunk_size:
+            _load_chunk(kind, chunk, report)
+            chunk = []
+    if chunk:
+        _load_chunk(kind, chunk, report)
+    return report
+
+
+def export_catalog(kind, fmt, batch_size=None):
+    # Yields the table as text, one piece per batch of rows pulled from the cursor
+    batch_size = batch_size or current_app.config.get('CATALOG_EXPORT_BATCH_SIZE', 1000)
+    model, fields, required = KINDS[kind]
+    names = list(fields)
+    stmt = select(*[getattr(model, name) for name in names]).order_by(model.id)
+    result = db.session.execute(stmt.execution_options(yield_per=batch_size))
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(names)
+    try:
+        for rows in result.partitions():
+            for row in rows:
+                values = [value.isoformat() if isinstance(value, date) else value for value in row]
+                if fmt == 'csv':
+                    writer.writerow(values)
+                else:
+                    buffer.write(json.dumps(dict(zip(names, values))) + '\n')
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    finally:
+        result.close()
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,167 @@
+import click
+from applications.database import db
+
+# Command line tools, run them with `flask --app main <command>` from the Backend folder.
+
+
+def init_db(app):
+    # Creates the missing tables, applies the pending migrations and builds the search index
+    from applications.migrations import upgrade
+    from applications.search import create_search_index
+    with app.app_context():
+        db.create_all()
+        applied = upgrade(db.engine)
+        create_search_index()
+    return applied
+
+
+def seed(app, admin_email='admin@gmail.com', admin_username='admin', admin_password='password'):
+    # Creates the admin and user roles and the admin account if they don't exist. Returns True if the
+    # admin was created.
+    from flask_security import hash_password
+    with app.app_context():
+        datastore = app.security.datastore
+        admin = datastore.find_or_create_role(name='admin', description='Administrator')
+        datastore.find_or_create_role(name='user', description='Customers')
+        created = False
+        if not datastore.find_user(email=admin_email):
+            datastore.create_user(email=admin_email, username=admin_username,
+                                  password=hash_password(admin_password), roles=[admin])
+            created = True
+        db.session.commit()
+    return created
+
+
+def register_commands(app):
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Create the schema, apply migrations and build the search index (run once per deployment)."""
+        for version, description in init_db(app):
+            click.echo(f'Applied {version}: {description}')
+        click.echo('Database ready')
+
+    @app.cli.command('seed')
+    @click.option('--admin-email', default='admin@gmail.com')
+    @click.option('--admin-username', default='admin')
+    @click.option('--admin-password', default='password')
+    def seed_command(admin_email, admin_username, admin_password):
+        """Create the default roles and the admin account."""
+        if seed(app, admin_email, admin_username, admin_password):
+            click.echo(f'Created admin {admin_email}')
+        else:
+            click.echo('Roles ready, admin already exists')
+
+    @app.cli.command('migrate')
+    @click.option('--to', 'target', type=int, default=None, help='Stop at this schema version')
+    def migrate(target):
+        """Apply pending schema migrations to the configured database."""
+        from applications.migrations import upgrade, current_version
+        applied = upgrade(db.engine, target)
+        for version, description in applied:
+            click.echo(f'Applied {version}: {description}')
+        with db.engine.connect() as conn:
+            click.echo(f'Schema version {current_version(conn)}')
+
+    @app.cli.command('backfill-ratings')
+    def backfill_ratings():
+        """Recompute the rating aggregates of every book and section."""
+        from applications.ratings import rating_aggregates
+        with db.engine.begin() as conn:
+            rating_aggregates.backfill(conn)
+        click.echo('Rating aggregates rebuilt')
+
+    @app.cli.command('backfill-loans')
+    def backfill_loans():
+        """Recompute the available copies of every book and the active loans of every user."""
+        from applications import loans
+        with db.engine.begin() as conn:
+            loans.backfill(conn)
+        click.echo('Loan counters rebuilt')
+
+    @app.cli.command('rebuild-recommendations')
+    def rebuild_recommendations():
+        """Recompute the "also borrowed" co-occurrence index from every loan and owned book."""
+        import time
+        from applications.recommendations import co_occurrence
+        started = time.perf_counter()
+        with db.engine.begin() as conn:
+            borrows, pairs = co_occurrence.rebuild(conn)
+        click.echo(f'{borrows} borrows, {pairs} book pairs indexed in {time.perf_counter() - started:.1f}s')
+
+    @app.cli.command('run-scheduler')
+    def run_scheduler():
+        """Run the periodic jobs in the foreground (sidecar mode)."""
+        from applications.scheduler import scheduler
+        scheduler.stop()
+        click.echo('Running jobs: ' + ', '.join(scheduler.jobs))
+        scheduler.run_forever()
+
+    @app.cli.command('expire-loans')
+    @click.option('--batch-size', type=int, default=None)
+    def expire_loans(batch_size):
+        """Deactivate overdue loans once."""
+        from applications.scheduler import scheduler
+        click.echo(f"{scheduler.run_job('expire_loans', batch_size=batch_size)} loans expired")
+
+    @app.cli.command('rollup-stats')
+    @click.option('--batch-size', type=int, default=None)
+    @click.option('--rebuild', is_flag=True, help='Drop the rollups first and recount the whole history')
+    def rollup_stats(batch_size, rebuild):
+        """Count the loans and ratings not in the analytics rollups yet."""
+        from applications.scheduler import scheduler
+        from applications.stats import reset
+        if rebuild:
+            with db.engine.begin() as conn:
+                reset(conn)
+        click.echo(f"{scheduler.run_job('rollup_stats', batch_size=batch_size)} rows rolled up")
+
+    @app.cli.command('import-catalog')
+    @click.argument('kind', type=click.Choice(['sections', 'books']))
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+    @click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), default=None,
+                  help='Default: csv for a .csv file, ndjson otherwise')
+    @click.option('--chunk-size', type=int, default=None)
+    def import_catalog(kind, path, fmt, chunk_size):
+        """Load sections or books from an NDJSON or CSV file ('-' for stdin), reporting the rejected rows."""
+        from applications import catalog_io
+        with click.open_file(path, encoding='utf-8') as f:
+            report = catalog_io.import_catalog(kind, catalog_io.read_records(f, fmt or catalog_io.guess_format(path)),
+                                               chunk_size)
+        for error in report.errors:
+            click.echo(f"line {error['line']}: {error['message']}", err=True)
+        click.echo(f'{report.inserted} {kind} imported, {report.failed} rows rejected')
+        if report.failed:
+            raise SystemExit(1)
+
+    @app.cli.command('export-catalog')
+    @click.argument('kind', type=click.Choice(['sections', 'books']))
+    @click.argument('path', default='-')
+    @click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), default=None,
+                  help='Default: csv for a .csv file, ndjson otherwise')
+    def export_catalog(kind, path, fmt):
+        """Write every section or book as NDJSON or CSV to a file ('-' for stdout), in the import format."""
+        from applications import catalog_io
+        with click.open_file(path, 'w', encoding='utf-8') as f:
+            for piece in catalog_io.export_catalog(kind, fmt or catalog_io.guess_format(path)):
+                f.write(piece)
+
+    @app.cli.command('check-query-plans')
+    def check_query_plans():
+        """Fail if any query issued by the API does a full table scan, or a request exceeds its query budget or fails."""
+        from main import create_app
+        from applications.config import get_config
+        from applications.query_plans import check_query_plans, TourRequestFailed
+        from applications.query_guard import QueryBudgetExceeded
+        try:
+            violations, count = check_query_plans(create_app, get_config())
+        except (QueryBudgetExceeded, TourRequestFailed) as e:
+            click.echo(str(e))
+            raise SystemExit(1)
+        for sql, plan in violations:
+            click.echo(sql.strip())
+            for line in plan:
+                click.echo(f'    {line}')
+            click.echo()
+        click.echo(f'{count} statements checked, {len(violations)} with a table scan')
+        if violations:
+            raise SystemExit(1)
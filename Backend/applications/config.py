@@ -1,7 +1,168 @@
+import os
+
+# Configuration profiles, selected with the LMS_CONFIG environment variable: development by default,
+# production when served through wsgi.py.
+# Config holds the shared settings, the profiles below only override what differs.
+
+
 class Config:
-    DEBUG = True
+    DEBUG = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///database.sqlite3'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    SQLALCHEMY_BINDS = {}
+    # Run on every new SQLite connection (applications/database.py). A busy timeout makes a connection
+    # wait for the write lock instead of failing at once with "database is locked". SQLite only enforces
+    # foreign keys (and their ON DELETE CASCADE) on connections that turn them on.
+    SQLITE_PRAGMAS = {'busy_timeout': 5000, 'foreign_keys': 'ON'}
 
     SECRET_KEY = 'mysecretkey'
     SECURITY_PASSWORD_SALT = 'mysecuritypasswordsalt'
+    # Flask-Security's joined load of roles nests role_user inside a LEFT JOIN, which SQLite materializes
+    # with a full scan of role_user. Roles are loaded by username through ix_role_user_username instead.
+    SECURITY_JOIN_USER_ROLES = False
+
+    # Response cache for the catalog endpoints: 'lru' (per process), 'shared' or 'null'
+    CACHE_BACKEND = 'lru'
+    CACHE_TTL = 30
+    CACHE_MAXSIZE = 1024
+    CACHE_MAX_VARIANTS = 32 # query strings (pages, includes) cached per resource
+    CACHE_SHARED_CLIENT = None # redis style client used by the 'shared' backend, defaults to a local stand-in
+
+    # Auth token -> principal cache, 0 TTL disables it
+    PRINCIPAL_CACHE_SIZE = 4096
+    PRINCIPAL_CACHE_TTL = 60
+
+    # Password hashing process pool used by Login/Register, 0 workers hashes inline.
+    # Cost parameters go in SECURITY_PASSWORD_HASH_PASSLIB_OPTIONS (e.g. {'argon2__rounds': 4});
+    # when they change, users are rehashed on their next login.
+    PASSWORD_POOL_WORKERS = 2
+    PASSWORD_POOL_MAX_PENDING = 16 # queued + running calls before Login/Register answer 503
+    PASSWORD_POOL_TIMEOUT = 10
+
+    # Prior of the Bayesian average used to rank books: a book with few ratings is pulled towards
+    # RATING_PRIOR_MEAN as if it had RATING_PRIOR_WEIGHT extra ratings. Run backfill-ratings after changing it.
+    RATING_PRIOR_MEAN = 3.0
+    RATING_PRIOR_WEIGHT = 5
+
+    # Loans (applications/loans.py). A borrow or return that still finds the database locked after
+    # busy_timeout is retried LOAN_BUSY_RETRIES times, after LOAN_BUSY_PAUSE seconds doubled each time,
+    # then answered 503.
+    LOAN_DAYS = 14
+    LOAN_LIMIT = 5 # active loans per user
+    LOAN_BUSY_RETRIES = 5
+    LOAN_BUSY_PAUSE = 0.02
+
+    # "Also borrowed" recommendations (applications/recommendations.py). A borrow is paired with the
+    # borrower's RECOMMENDATIONS_WINDOW previous books, run rebuild-recommendations after changing it.
+    RECOMMENDATIONS_WINDOW = 20
+    RECOMMENDATIONS_LIMIT = 10 # books answered when the request has no limit
+    RECOMMENDATIONS_SEED_BOOKS = 10 # recent books of a user their recommendations are drawn from
+
+    # Background jobs (applications/jobs.py), run by the one serving process holding SCHEDULER_LOCK (a file
+    # in the instance folder). Or disable this and run `flask --app main run-scheduler` as a sidecar.
+    SCHEDULER_ENABLED = True
+    SCHEDULER_LOCK = 'scheduler.lock'
+    SCHEDULER_INTERVALS = {'expire_loans': 300, 'rollup_stats': 60} # seconds between runs
+    LOAN_EXPIRY_BATCH_SIZE = 500 # rows updated per transaction
+    LOAN_EXPIRY_BATCH_PAUSE = 0.05 # seconds between batches
+
+    # Analytics rollups served at /api/v1/admin/stats (applications/stats.py). A write also counts the rows
+    # written before it without the ORM, up to STATS_INLINE_MAX_ROWS, the rollup_stats job does the rest.
+    STATS_INLINE_MAX_ROWS = 1000
+    STATS_ROLLUP_BATCH_SIZE = 5000 # ids counted per transaction by the rollup_stats job
+    STATS_MAX_BUCKETS = 1000 # buckets one request may cover
+
+    # SQL statements a request may issue before it is reported as an N+1 regression
+    # (applications/query_guard.py). QUERY_BUDGETS overrides it per endpoint, e.g. {'books': 6}.
+    # QUERY_BUDGET_STRICT makes an overrun fail the request, it defaults to on when TESTING.
+    QUERY_BUDGET = 15
+    QUERY_BUDGETS = {'catalogimport': None, 'batch': None} # their statements grow with their input
+
+    # Token bucket limits per endpoint (applications/rate_limit.py): {scope: (requests, seconds)} lets a
+    # client burst `requests` and then refills them over `seconds`. Scopes are 'ip', 'user' (auth token)
+    # and 'account' (the email posted to Login/Register). The buckets are shared by the workers of a host
+    # through RATE_LIMIT_STORE, a file of RATE_LIMIT_SLOTS slots (relative to the instance folder). None
+    # keeps them in a temporary file, shared only by workers forked from the process that built the app.
+    RATE_LIMIT_ENABLED = True
+    RATE_LIMITS = {
+        'login': {'ip': (20, 60), 'account': (5, 60)},
+        'register': {'ip': (5, 300)},
+        'allsections': {'ip': (120, 60), 'user': (120, 60)},
+        'booksapi': {'ip': (120, 60), 'user': (120, 60)},
+        'search': {'ip': (60, 60), 'user': (60, 60)},
+        'topbooks': {'ip': (120, 60), 'user': (120, 60)},
+    }
+    RATE_LIMIT_STORE = None
+    RATE_LIMIT_SLOTS = 65536
+
+    BATCH_MAX_OPERATIONS = 100 # operations accepted by one /api/v1/batch request (applications/batch.py)
+
+    # Bulk catalog import/export (applications/catalog_io.py)
+    CATALOG_IMPORT_CHUNK_SIZE = 1000 # rows validated and inserted per transaction
+    CATALOG_IMPORT_MAX_ERRORS = 100 # rejected rows listed in the report (all of them are counted)
+    CATALOG_EXPORT_BATCH_SIZE = 1000 # rows fetched from the cursor per piece of the response
+
+    # Book files served by /api/v1/book/<id>/content, Book.content is a path under CONTENT_ROOT
+    # (instance/content when None). Behind a front server, offload the transfer with USE_X_SENDFILE
+    # (Apache/lighttpd) or CONTENT_ACCEL_PREFIX, the internal nginx location mapped to CONTENT_ROOT.
+    CONTENT_ROOT = None
+    USE_X_SENDFILE = False
+    CONTENT_ACCEL_PREFIX = None
+
+    # Request/SQL metrics served at /api/v1/metrics (applications/metrics.py) to admins, and to scrapers
+    # sending `Authorization: Bearer <METRICS_TOKEN>` when it is set
+    METRICS_ENABLED = True
+    METRICS_TOKEN = None
+    METRICS_SERVER_TIMING = False # Server-Timing header with the app and db time of each response
+    SLOW_QUERY_MS = 100 # statements slower than this are logged and kept as samples by SQL fingerprint
+    SLOW_QUERY_SAMPLES = 50
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+    METRICS_SERVER_TIMING = True
+
+
+class ProductionConfig(Config):
+    # WAL lets readers run while a writer commits, synchronous=NORMAL only syncs at checkpoints
+    # (a power loss can drop the last transactions, never corrupt the file). mmap and a 64MB page
+    # cache keep the hot catalog pages in memory.
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 268435456,
+        'cache_size': -64000,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+        'foreign_keys': 'ON',
+    }
+    SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': 10, 'max_overflow': 20, 'pool_timeout': 10}
+    # GET and HEAD requests read through the 'read' engine, writes go to SQLALCHEMY_DATABASE_URI.
+    # Point it at a replica, or keep the same file (needs WAL): the read engine is opened query_only.
+    SQLALCHEMY_BINDS = {'read': 'sqlite:///database.sqlite3'}
+    RATE_LIMIT_STORE = 'rate_limit.buckets' # one budget for all the workers, with or without --preload
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    CACHE_BACKEND = 'null'
+    PRINCIPAL_CACHE_TTL = 0
+    PASSWORD_POOL_WORKERS = 0
+    SCHEDULER_ENABLED = False
+    RATE_LIMIT_ENABLED = False
+
+
+config_profiles = {
+    'development':DevelopmentConfig,
+    'production':ProductionConfig,
+    'testing':TestingConfig,
+}
+
+
+def get_config(name=None):
+    name = name or os.environ.get('LMS_CONFIG', 'development')
+    if name not in config_profiles:
+        raise ValueError('Unknown LMS_CONFIG %s, expected one of: %s' % (name, ', '.join(config_profiles)))
+    return config_profiles[name]
@@ -1,3 +1,61 @@
+from functools import partial
+from flask import has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
 
-db = SQLAlchemy()
\ No newline at end of file
+# Bind key of the optional read-only engine (SQLALCHEMY_BINDS['read']). When it is configured, GET and
+# HEAD requests read through it and everything else (writes, flushes, CLI, jobs) uses the primary.
+READ_BIND = 'read'
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Session.info flag set while /api/v1/batch runs several handlers in one transaction (applications/batch.py)
+BATCH = 'batch'
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engines = self._db.engines
+        if (bind is None and READ_BIND in engines and not self._flushing and not self.info.get(BATCH)
+                and has_request_context() and request.method in READ_METHODS):
+            return engines[READ_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def commit(self):
+        # In a batch the handlers' commits only flush, the batch commits or rolls back once at the end
+        if self.info.get(BATCH):
+            self.flush()
+            return
+        super().commit()
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+def begin_immediate(session):
+    # Opens the session's SQLite transaction now and with the write lock. pysqlite only sends BEGIN
+    # before the first INSERT/UPDATE/DELETE: a SAVEPOINT issued earlier would start the transaction
+    # itself and its RELEASE would commit it.
+    conn = session.connection()
+    if conn.dialect.name == 'sqlite' and not conn.connection.dbapi_connection.in_transaction:
+        conn.exec_driver_sql('BEGIN IMMEDIATE')
+
+
+def _apply_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+
+def configure_engines(app):
+    # Runs SQLITE_PRAGMAS on every new SQLite connection. The read engine is also made query_only,
+    # so a write that ends up on it fails instead of going to a replica.
+    pragmas = app.config.get('SQLITE_PRAGMAS', {})
+    with app.app_context():
+        for key, engine in db.engines.items():
+            if engine.dialect.name != 'sqlite':
+                continue
+            engine_pragmas = dict(pragmas, query_only=1) if key == READ_BIND else pragmas
+            if engine_pragmas:
+                event.listen(engine, 'connect', partial(_apply_pragmas, engine_pragmas))
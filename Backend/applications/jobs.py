@@ -0,0 +1,75 @@
+import time
+from datetime import date
+from flask import current_app
+from sqlalchemy import text
+from applications.database import db
+from applications.scheduler import scheduler, begin_run, checkpoint, finish_run
+from applications import stats
+from applications.loans import end_loans
+
+# Periodic jobs run by applications/scheduler.py
+
+
+@scheduler.job('expire_loans', interval=300)
+def expire_overdue_loans(batch_size=None, pause=None, today=None):
+    # Deactivates every active UserRequest whose return_date has passed and gives the copies back (see
+    # end_loans in applications/loans.py); the content access of those loans ends with them.
+    # Works in batches of LOAN_EXPIRY_BATCH_SIZE rows, one short transaction each, so the SQLite write
+    # lock is released between batches. An interrupted run is resumed with its original cutoff date.
+    batch_size = batch_size or current_app.config.get('LOAN_EXPIRY_BATCH_SIZE', 500)
+    pause = current_app.config.get('LOAN_EXPIRY_BATCH_PAUSE', 0.05) if pause is None else pause
+    cutoff = (today or date.today()).isoformat()
+
+    run_id, cutoff, expired = begin_run('expire_loans', cutoff)
+    try:
+        while True:
+            started = time.perf_counter()
+            with db.engine.begin() as conn:
+                rows = conn.execute(text("""
+                    UPDATE user_request SET is_active = 0
+                    WHERE id IN (
+                        SELECT id FROM user_request WHERE is_active = 1 AND return_date < :cutoff LIMIT :batch_size
+                    )
+                    RETURNING id, username, book_id
+                """), {'cutoff':cutoff, 'batch_size':batch_size}).all()
+                if rows:
+                    end_loans(conn, [{'username':row.username, 'book_id':row.book_id} for row in rows])
+                    checkpoint(conn, run_id, len(rows), max(row.id for row in rows),
+                               (time.perf_counter() - started) * 1000)
+            expired += len(rows)
+            if len(rows) < batch_size:
+                break
+            time.sleep(pause) # let queued writers in before the next batch
+    except Exception as e:
+        finish_run(run_id, 'failed', str(e))
+        raise
+
+    finish_run(run_id)
+    return expired
+
+
+@scheduler.job('rollup_stats', interval=60)
+def rollup_stats(batch_size=None):
+    # Counts the loans and ratings the flush hook of applications/stats.py left behind (bulk or raw SQL
+    # inserts, or more than STATS_INLINE_MAX_ROWS behind), STATS_ROLLUP_BATCH_SIZE ids per transaction.
+    # Returns the number of ids rolled up.
+    batch_size = batch_size or current_app.config.get('STATS_ROLLUP_BATCH_SIZE', 5000)
+    run_id, cutoff, rolled = begin_run('rollup_stats')
+    try:
+        for source in stats.SOURCES:
+            while True:
+                started = time.perf_counter()
+                with db.engine.begin() as conn:
+                    first = stats.watermark(conn, source)
+                    last = min(conn.execute(text(f'SELECT coalesce(max(id), 0) FROM {source}')).scalar(),
+                               first + batch_size)
+                    if last <= first or not stats.roll_up(conn, source, first, last):
+                        break
+                    checkpoint(conn, run_id, last - first, last, (time.perf_counter() - started) * 1000)
+                rolled += last - first
+    except Exception as e:
+        finish_run(run_id, 'failed', str(e))
+        raise
+
+    finish_run(run_id)
+    return rolled
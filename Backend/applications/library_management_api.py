@@ -1,9 +1,21 @@
-from flask_restful import Resource, marshal_with
-from flask import make_response, jsonify, request as req
+from flask_restful import Resource
+import io
+import os
+from flask import make_response, jsonify, request as req, current_app, redirect, send_file, Response, stream_with_context
 from flask_security import auth_token_required, roles_required, roles_accepted, current_user
+from sqlalchemy import select, exists, or_, and_, delete, update, func
+from werkzeug.security import safe_join
+from sqlalchemy.orm import selectinload, joinedload
 from applications.model import *
 from applications.marshal_fields import *
-from datetime import datetime
+from applications.pagination import page_args, fetch_page, stream_page, PAGE_PARAMS
+from applications import search
+from applications import catalog_io
+from applications.cache import cache, cached, ALL_SECTIONS_KEY, section_key, section_books_key, book_key
+from applications.ratings import rating_aggregates
+from applications.recommendations import co_occurrence
+from applications.loans import release_loans
+from datetime import datetime, date
 
 # For the store management API, we will have the following endpoints:
 # 1. GET /api/v1/get_all_sections - Get all sections
@@ -16,63 +28,152 @@ from datetime import datetime
 # 8. POST /api/v1/book - Add a book
 # 9. PUT /api/v1/book/<book_id> - Update a book
 # 10. DELETE /api/v1/book/<book_id> - Delete a book
+#
+# The listings (1 and 6) accept `limit` and `after` for keyset pagination on id and answer
+# {"<items>": [...], "next_cursor": <id or null>}. Pass `stream=1` to stream the array row by row.
+# 11. GET /api/v1/search?q=<text> - Full text search over books (or sections with type=sections)
+# 12. GET /api/v1/books/top?section_id=<section_id>&limit=<n> - Top rated books by Bayesian average
+# 13. GET /api/v1/book/<book_id>/content - Download/read a book (admin, owner or active loan), supports Range
+# 14. PATCH /api/v1/books - Update every book matching a filter in one statement (price change, section move)
+# 15. POST /api/v1/admin/import/<sections|books>?format=<ndjson|csv> - Bulk load, see applications/catalog_io.py
+# 16. GET /api/v1/admin/export/<sections|books>?format=<ndjson|csv> - Streamed dump in the import format
+# 17. GET /api/v1/book/<book_id>/related?limit=<n> - Books most often borrowed with this one
+# 18. GET /api/v1/recommendations?limit=<n> - Books borrowed with the current user's recent books
+# 19. POST /api/v1/book/<book_id>/borrow and /return - Loans, see applications/loans.py
+#
+# Deletes are set-based: the database deletes a section's books and a book's ratings, loans and
+# user_book rows itself (ON DELETE CASCADE, see applications/migrations.py), nothing is loaded.
+#
+# GET 1, 2, 6 and 7 go through the response cache (applications/cache.py) and answer If-None-Match with 304.
+# Every write handler evicts the cache keys it affects after committing.
+#
+# GET 1, 2, 6 and 7 also accept `include=` to expand relationships in the same response:
+# sections take books and ratings_summary, books take section and ratings_summary.
 
 
 
 
+# Each include compiles to a loader option, so related rows come in one statement per relationship
+# (or in the same statement) instead of one per row. None means the data is already on the row.
+SECTION_INCLUDES = {
+    'books':selectinload(Section.books),
+    'ratings_summary':None,
+}
+BOOK_INCLUDES = {
+    'section':joinedload(Book.section),
+    'ratings_summary':None,
+}
+
+
+def parse_includes(allowed):
+    names = {name.strip() for name in req.args.get('include', '').split(',') if name.strip()}
+    unknown = sorted(names - set(allowed))
+    if unknown:
+        raise ValueError('Invalid include %s, allowed: %s' % (', '.join(unknown), ', '.join(allowed)))
+    return names, [allowed[name] for name in names if allowed[name] is not None]
+
+
+def ratings_summary(row):
+    return {
+        'count':row.rating_count,
+        'average':round(row.rating_sum / row.rating_count, 2) if row.rating_count else None
+    }
+
+
+def section_dict(row, includes=()):
+    response = section_schema.from_object(row)
+    if 'books' in includes:
+        response['books'] = [book_schema.from_object(book) for book in row.books]
+    if 'ratings_summary' in includes:
+        response['ratings_summary'] = ratings_summary(row)
+    return response
+
+
+def book_with_includes(book, includes=()):
+    response = book_schema.from_object(book)
+    if 'section' in includes:
+        response['section'] = section_ref_schema.from_object(book.section)
+    if 'ratings_summary' in includes:
+        response['ratings_summary'] = ratings_summary(book)
+    return response
+
+
 class AllSections(Resource):  
-    @marshal_with(section)
+    @cached(lambda: ALL_SECTIONS_KEY, PAGE_PARAMS + ('include',))
     def get(self):
-        sections = Section.query.all()
-        return sections
+        try:
+            paginate, limit, after, stream = page_args()
+            includes, options = parse_includes(SECTION_INCLUDES)
+        except ValueError as e:
+            return make_response(jsonify({'message':str(e)}),400)
+
+        # Without includes the rows are plain column tuples, serialized by the compiled schema
+        if includes:
+            query, tuples = select(Section).options(*options), False
+            serialize = lambda row: section_dict(row, includes)
+        else:
+            query, tuples, serialize = section_schema.select(), True, section_schema.from_row
+
+        if stream:
+            return stream_page('sections', query, Section.id, limit, after, serialize, tuples)
+
+        sections, next_cursor = fetch_page(query, Section.id, limit, after, tuples)
+        response = [serialize(row) for row in sections]
+        if not paginate:
+            return response
+        return {'sections':response, 'next_cursor':next_cursor}
 
 
 class BooksAPI(Resource):
+    @cached(lambda section_id: section_books_key(section_id), PAGE_PARAMS + ('include',))
     def get(self, section_id):
         section = Section.query.get(section_id)
         if not section:
             return make_response(jsonify({'message':'Section does not exist'}),404)
         
-        books = Book.query.filter_by(section_id=section_id).all()
-        response = []
-        for book in books:
-            response.append({
-                'book_id':book.id,
-                'title':book.title,
-                'content_type':book.content_type,
-                'content':book.content,
-                'author':book.author,
-                'image':book.image,
-                'date_created':datetime.strftime(book.date_created,'%Y-%m-%d'),
-                'download_price':book.download_price,
-                'section_id':book.section_id
-            })
+        try:
+            paginate, limit, after, stream = page_args()
+            includes, options = parse_includes(BOOK_INCLUDES)
+        except ValueError as e:
+            return make_response(jsonify({'message':str(e)}),400)
+
+        if includes:
+            query, tuples = select(Book).options(*options), False
+            serialize = lambda book: book_with_includes(book, includes)
+        else:
+            query, tuples, serialize = book_schema.select(), True, book_schema.from_row
+        query = query.where(Book.section_id == section_id)
+
+        if stream:
+            return stream_page('books', query, Book.id, limit, after, serialize, tuples)
+
+        books, next_cursor = fetch_page(query, Book.id, limit, after, tuples)
+        response = [serialize(book) for book in books]
+        if paginate:
+            response = {'books':response, 'next_cursor':next_cursor}
 
         return make_response(jsonify(response),200)
     
 
 class Books(Resource):
-    def get(self, book_id):
-        book = Book.query.get(book_id)
+    @cached(lambda id: book_key(id), ('include',))
+    def get(self, id):
+        try:
+            includes, options = parse_includes(BOOK_INCLUDES)
+        except ValueError as e:
+            return make_response(jsonify({'message':str(e)}),400)
+
+        # The section is always embedded here, load it in the same statement
+        book = db.session.execute(
+            select(Book).where(Book.id == id).options(joinedload(Book.section), *options)
+        ).scalar()
         if not book:
             return make_response(jsonify({'message':'Book does not exist'}),404)
         
-        section = Section.query.get(book.section_id)
-        response = {
-            'book_id':book.id,
-            'title':book.title,
-            'content_type':book.content_type,
-            'content':book.content,
-            'author':book.author,
-            'image':book.image,
-            'date_created':datetime.strftime(book.date_created,'%Y-%m-%d'),
-            'download_price':book.download_price,
-            'section':{
-                'section_id':section.id,
-                'name':section.name,
-                'description':section.description
-            }
-        }
+        response = book_detail_schema.from_object(book)
+        response['section'] = section_ref_schema.from_object(book.section)
+        if 'ratings_summary' in includes:
+            response['ratings_summary'] = ratings_summary(book)
         return make_response(jsonify(response),200)
     
     @auth_token_required
@@ -87,32 +188,29 @@ class Books(Resource):
         image = data.get('image')
         download_price = float(data.get('download_price'))
         section_id = int(data.get('section_id'))
+        copies = data.get('copies', 1)
         
 
         if not title or not content_type or not content or not author or not download_price or not section_id:
             return make_response(jsonify({'message':'All fields are required'}),400)
+        if not isinstance(copies, int) or copies < 1:
+            return make_response(jsonify({'message':'copies must be a positive integer'}),400)
         
         section = Section.query.get(section_id)
         if not section:
             return make_response(jsonify({'message':'Section does not exist'}),404)
         
         try:
-            book = Book(title=title,content_type=content_type,content=content,author=author,image=image,download_price=download_price,section_id=section_id,date_created=datetime.now())
+            book = Book(title=title,content_type=content_type,content=content,author=author,image=image,download_price=download_price,section_id=section_id,date_created=datetime.now(),
+                        copies=copies,available_copies=copies)
             db.session.add(book)
+            db.session.flush()
+            search.index_book(book.id)
             db.session.commit()
+            cache.delete(section_books_key(book.section_id), section_key(book.section_id), ALL_SECTIONS_KEY)
             response = {
                 'message':'Book added successfully',
-                'book':{
-                    'book_id':book.id,
-                    'title':book.title,
-                    'content_type':book.content_type,
-                    'content':book.content,
-                    'author':book.author,
-                    'image':book.image,
-                    'date_created':datetime.strftime(book.date_created,'%Y-%m-%d'),
-                    'download_price':book.download_price,
-                    'section_id':book.section_id
-                }
+                'book':book_schema.from_object(book)
             }
             return make_response(jsonify(response),201)
         except Exception as e:
@@ -134,10 +232,29 @@ class Books(Resource):
         image = data.get('image')
         download_price = float(data.get('download_price'))
         section_id = int(data.get('section_id'))
+        copies = data.get('copies')
 
-        if not title and not content_type and not content and not author and not download_price and not section_id:
+        if not title and not content_type and not content and not author and not download_price and not section_id and not copies:
             return make_response(jsonify({'message':'Edit request is empty with any data'}),400)
+        if copies is not None and (not isinstance(copies, int) or copies < 1):
+            return make_response(jsonify({'message':'copies must be a positive integer'}),400)
         
+        # Checks first, so a refused edit leaves nothing behind for the caller to roll back
+        # (inside /api/v1/batch that is the operation's savepoint)
+        if section_id and not db.session.get(Section, section_id):
+            return make_response(jsonify({'message':'Section does not exist'}),404)
+        if copies is not None:
+            # The copies on loan stay on loan: the available ones take the difference, in the same statement
+            # as the check so a concurrent borrow cannot slip in between (see applications/loans.py)
+            changed = db.session.execute(
+                update(Book).where(Book.id == id, Book.copies - Book.available_copies <= copies)
+                .values(copies=copies, available_copies=Book.available_copies + copies - Book.copies)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if not changed:
+                return make_response(jsonify({'message':'More copies than that are on loan'}),409)
+
+        old_section_id = book.section_id
         if title:
             book.title = title
         if content_type:
@@ -151,13 +268,13 @@ class Books(Resource):
         if download_price:
             book.download_price = download_price
         if section_id:
-            section = Section.query.get(section_id)
-            if not section:
-                return make_response(jsonify({'message':'Section does not exist'}),404)
             book.section_id = section_id
         
         try:
+            search.index_book(book.id)
             db.session.commit()
+            cache.delete(book_key(book.id), section_books_key(old_section_id), section_books_key(book.section_id),
+                         section_key(old_section_id), section_key(book.section_id), ALL_SECTIONS_KEY)
             return make_response(jsonify({'message':'Book updated successfully'}),200)
         except Exception as e:
             return make_response(jsonify({'message':str(e)}),400)
@@ -165,24 +282,36 @@ class Books(Resource):
     @auth_token_required
     @roles_required('admin')
     def delete(self,id):
-        book = Book.query.get(id)
+        book = db.session.execute(select(Book.section_id, Book.rating_count, Book.rating_sum).where(Book.id == id)).first()
         if not book:
             return make_response(jsonify({'message':'Book does not exist'}),404)
         
         try:
-            db.session.delete(book)
+            section_id = book.section_id
+            search.unindex_book(id)
+            release_loans(db.session.connection(), select(Book.id).where(Book.id == id))
+            db.session.execute(delete(Book).where(Book.id == id))
+            if book.rating_count:
+                # The cascade removed its ratings, take them out of the section totals
+                rating_aggregates.move_book(db.session.connection(), book.rating_count, book.rating_sum, section_id, None)
             db.session.commit()
+            cache.delete(book_key(id), section_books_key(section_id), section_key(section_id), ALL_SECTIONS_KEY)
             return make_response(jsonify({'message':'Book deleted successfully'}),200)
         except Exception as e:
             return make_response(jsonify({'message':str(e)}),400)
 
 class Sections(Resource):
-    @marshal_with(section)
+    @cached(lambda id: section_key(id), ('include',))
     def get(self,id):
-        section = Section.query.get(id)
-        if not section:
+        try:
+            includes, options = parse_includes(SECTION_INCLUDES)
+        except ValueError as e:
+            return make_response(jsonify({'message':str(e)}),400)
+
+        row = db.session.execute(select(Section).where(Section.id == id).options(*options)).scalar()
+        if not row:
             return make_response(jsonify({'message':'Section does not exist'}),404)
-        return section
+        return section_dict(row, includes)
     
     @auth_token_required
     @roles_required('admin')
@@ -199,16 +328,13 @@ class Sections(Resource):
         try:
             section = Section(name=name,description=description,image=image,date_created=datetime.now())
             db.session.add(section)
+            db.session.flush()
+            search.index_section(section.id)
             db.session.commit()
+            cache.delete(ALL_SECTIONS_KEY)
             response = {
                 'message':'Section added successfully',
-                'section':{
-                    'section_id':section.id,
-                    'name':section.name,
-                    'description':section.description,
-                    'image':section.image,
-                    'date_created':datetime.strftime(section.date_created,'%Y-%m-%d') 
-                }
+                'section':section_created_schema.from_object(section)
             }
             return make_response(jsonify(response),201)
         except Exception as e:
@@ -242,7 +368,11 @@ class Sections(Resource):
             section.image = image
         
         try:
+            search.index_section(section.id)
             db.session.commit()
+            # Book responses embed their section, so they are stale as well
+            book_ids = [book_id for (book_id,) in db.session.query(Book.id).filter_by(section_id=id)]
+            cache.delete(ALL_SECTIONS_KEY, section_key(id), section_books_key(id), *[book_key(book_id) for book_id in book_ids])
             return make_response(jsonify({'message':'Section updated successfully'}),200)
         except Exception as e:
             return make_response(jsonify({'message':str(e)}),400)
@@ -255,8 +385,301 @@ class Sections(Resource):
             return make_response(jsonify({'message':'Section does not exist'}),404)
         
         try:
-            db.session.delete(section)
+            book_ids = [book_id for (book_id,) in db.session.query(Book.id).filter_by(section_id=id)]
+            search.unindex_section(section.id)
+            release_loans(db.session.connection(), select(Book.id).where(Book.section_id == id))
+            # One statement, the books and the rows referencing them follow through ON DELETE CASCADE
+            db.session.execute(delete(Section).where(Section.id == id))
             db.session.commit()
+            cache.delete(ALL_SECTIONS_KEY, section_key(id), section_books_key(id), *[book_key(book_id) for book_id in book_ids])
             return make_response(jsonify({'message':'Section deleted successfully'}),200)
         except Exception as e:
-            return make_response(jsonify({'message':str(e)}),400)
\ No newline at end of file
+            return make_response(jsonify({'message':str(e)}),400)
+
+
+def bulk_book_filter(args):
+    # Where clauses of a bulk update, from {"ids", "section_id", "author", "price_min", "price_max"}
+    unknown = sorted(set(args) - {'ids', 'section_id', 'author', 'price_min', 'price_max'})
+    if unknown:
+        raise ValueError('Invalid filter %s' % ', '.join(unknown))
+    conditions = []
+    if 'ids' in args:
+        ids = args['ids']
+        if not isinstance(ids, list) or not all(isinstance(book_id, int) and not isinstance(book_id, bool) for book_id in ids):
+            raise ValueError('ids must be a list of book ids')
+        conditions.append(Book.id.in_(ids))
+    if 'section_id' in args:
+        conditions.append(Book.section_id == int(args['section_id']))
+    if 'author' in args:
+        conditions.append(Book.author == str(args['author']))
+    if 'price_min' in args:
+        conditions.append(Book.download_price >= float(args['price_min']))
+    if 'price_max' in args:
+        conditions.append(Book.download_price <= float(args['price_max']))
+    return conditions
+
+
+def bulk_book_values(args):
+    # Column values of a bulk update, from {"download_price"} or {"price_factor"}, and/or {"section_id"}
+    unknown = sorted(set(args) - {'download_price', 'price_factor', 'section_id'})
+    if unknown:
+        raise ValueError('Invalid update %s' % ', '.join(unknown))
+    if 'download_price' in args and 'price_factor' in args:
+        raise ValueError('Set either download_price or price_factor')
+    values = {}
+    if 'download_price' in args:
+        values['download_price'] = float(args['download_price'])
+        if values['download_price'] < 0:
+            raise ValueError('download_price must be positive')
+    if 'price_factor' in args:
+        factor = float(args['price_factor'])
+        if factor <= 0:
+            raise ValueError('price_factor must be positive')
+        values['download_price'] = func.round(Book.download_price * factor, 2)
+    if 'section_id' in args:
+        values['section_id'] = int(args['section_id'])
+    return values
+
+
+class BulkBooks(Resource):
+    # {"filter": {"section_id": 3, "price_max": 10}, "set": {"price_factor": 1.1}} reprices, and
+    # {"filter": {"ids": [1, 2]}, "set": {"section_id": 4}} moves, every matching book with one UPDATE
+    # whatever their number. The filter is required, so a whole catalog change is explicit.
+    @auth_token_required
+    @roles_required('admin')
+    def patch(self):
+        data = req.get_json(silent=True) or {}
+        if not isinstance(data, dict) or not all(isinstance(data.get(part) or {}, dict) for part in ('filter', 'set')):
+            return make_response(jsonify({'message':'The body must be an object with filter and set objects'}),400)
+        try:
+            conditions = bulk_book_filter(data.get('filter') or {})
+            values = bulk_book_values(data.get('set') or {})
+        except (TypeError, ValueError) as e:
+            return make_response(jsonify({'message':str(e)}),400)
+
+        if not conditions:
+            return make_response(jsonify({'message':'A filter is required'}),400)
+        if not values:
+            return make_response(jsonify({'message':'Edit request is empty with any data'}),400)
+
+        new_section_id = values.get('section_id')
+        if new_section_id is not None and not db.session.get(Section, new_section_id):
+            return make_response(jsonify({'message':'Section does not exist'}),404)
+
+        try:
+            condition = and_(*conditions)
+            section_ids = set(db.session.execute(select(Book.section_id).where(condition).distinct()).scalars())
+            if new_section_id is not None:
+                # Aggregates and search index first, while the condition still matches the same books
+                rating_aggregates.move_books(db.session.connection(), condition, new_section_id)
+                search.move_books(condition, new_section_id)
+            book_ids = db.session.execute(
+                update(Book).where(condition).values(**values).returning(Book.id),
+                execution_options={'synchronize_session':False}
+            ).scalars().all()
+            db.session.commit()
+            if new_section_id is not None:
+                section_ids.add(new_section_id)
+            cache.delete(ALL_SECTIONS_KEY, *[key for section_id in section_ids
+                                             for key in (section_key(section_id), section_books_key(section_id))],
+                         *[book_key(book_id) for book_id in book_ids])
+            return make_response(jsonify({'message':'Books updated successfully', 'updated':len(book_ids)}),200)
+        except Exception as e:
+            return make_response(jsonify({'message':str(e)}),400)
+
+
+def catalog_args(kind, default_format):
+    if kind not in catalog_io.KINDS:
+        raise ValueError('Unknown catalog %s, use %s' % (kind, ' or '.join(catalog_io.KINDS)))
+    fmt = req.args.get('format') or default_format
+    if fmt not in catalog_io.FORMATS:
+        raise ValueError('Invalid format %s, use %s' % (fmt, ' or '.join(catalog_io.FORMATS)))
+    return fmt
+
+
+class CatalogImport(Resource):
+    # The body is read as a stream, it is never held in memory whole. Answers the import report:
+    # {"inserted": n, "failed": n, "errors": [{"line": n, "message": "..."}], ...}
+    @auth_token_required
+    @roles_required('admin')
+    def post(self, kind):
+        try:
+            fmt = catalog_args(kind, catalog_io.guess_format(req.mimetype))
+        except ValueError as e:
+            return make_response(jsonify({'message':str(e)}),400)
+
+        stream = io.TextIOWrapper(io.BufferedReader(req.stream), encoding='utf-8', errors='replace', newline='')
+        report = catalog_io.import_catalog(kind, catalog_io.read_records(stream, fmt))
+        return make_response(jsonify(report.to_dict()),200)
+
+
+class CatalogExport(Resource):
+    @auth_token_required
+    @roles_required('admin')
+    def get(self, kind):
+        try:
+            fmt = catalog_args(kind, 'ndjson')
+        except ValueError as e:
+            return make_response(jsonify({'message':str(e)}),400)
+
+        response = Response(stream_with_context(catalog_io.export_catalog(kind, fmt)), mimetype=catalog_io.MIMETYPES[fmt])
+        response.headers['Content-Disposition'] = f'attachment; filename={kind}.{fmt}'
+        return response
+
+
+class Search(Resource):
+    def get(self):
+        query = req.args.get('q', '').strip()
+        if not query:
+            return make_response(jsonify({'message':'Search query is required'}),400)
+
+        kind = req.args.get('type', 'books')
+        if kind not in ['books','sections']:
+            return make_response(jsonify({'message':'Invalid search type'}),400)
+
+        try:
+            limit = int(req.args.get('limit', 20))
+            offset = int(req.args.get('offset', 0))
+            section_id = int(req.args['section_id']) if 'section_id' in req.args else None
+            price_min = float(req.args['price_min']) if 'price_min' in req.args else None
+            price_max = float(req.args['price_max']) if 'price_max' in req.args else None
+        except ValueError:
+            return make_response(jsonify({'message':'Invalid search parameters'}),400)
+
+        if limit < 1 or limit > 100 or offset < 0:
+            return make_response(jsonify({'message':'limit must be between 1 and 100 and offset positive'}),400)
+
+        if kind == 'books':
+            ids = search.search_books(query, section_id, price_min, price_max, limit + 1, offset)
+            rows = {row.id:row for row in db.session.execute(book_schema.select().where(Book.id.in_(ids[:limit])))}
+            results = [book_schema.from_row(rows[id]) for id in ids[:limit] if id in rows]
+        else:
+            ids = search.search_sections(query, section_id, limit + 1, offset)
+            rows = {row.id:row for row in db.session.execute(section_schema.select().where(Section.id.in_(ids[:limit])))}
+            results = [section_schema.from_row(rows[id]) for id in ids[:limit] if id in rows]
+
+        response = {
+            kind:results,
+            'next_offset':offset + limit if len(ids) > limit else None
+        }
+        return make_response(jsonify(response),200)
+
+
+class TopBooks(Resource):
+    def get(self):
+        try:
+            limit = int(req.args.get('limit', 10))
+            min_ratings = int(req.args.get('min_ratings', 1))
+            section_id = int(req.args['section_id']) if 'section_id' in req.args else None
+        except ValueError:
+            return make_response(jsonify({'message':'Invalid parameters'}),400)
+
+        if limit < 1 or limit > 100:
+            return make_response(jsonify({'message':'limit must be between 1 and 100'}),400)
+
+        # Walks ix_book_rating_score (or ix_book_section_id_rating_score) from the top
+        query = select(*book_schema.columns, Book.rating_count, Book.rating_sum, Book.rating_score)
+        query = query.where(Book.rating_count >= min_ratings)
+        if section_id is not None:
+            query = query.where(Book.section_id == section_id)
+        query = query.order_by(Book.rating_score.desc(), Book.id.desc()).limit(limit)
+
+        response = []
+        for book in db.session.execute(query):
+            row = book_schema.from_row(book)
+            row.update({
+                'rating_count':book.rating_count,
+                'rating_average':round(book.rating_sum / book.rating_count, 2) if book.rating_count else None,
+                'rating_score':round(book.rating_score, 4)
+            })
+            response.append(row)
+        return make_response(jsonify({'books':response}),200)
+
+
+def recommendation_limit():
+    # `limit` query argument of the recommendation endpoints, raises ValueError
+    limit = int(req.args.get('limit', co_occurrence.limit))
+    if limit < 1 or limit > 100:
+        raise ValueError('limit must be between 1 and 100')
+    return limit
+
+
+class RelatedBooks(Resource):
+    # "Also borrowed": the precomputed co-occurrence counts of applications/recommendations.py
+    def get(self, id):
+        try:
+            limit = recommendation_limit()
+        except ValueError as e:
+            return make_response(jsonify({'message':str(e)}),400)
+
+        if not db.session.get(Book, id):
+            return make_response(jsonify({'message':'Book does not exist'}),404)
+
+        response = []
+        for book in db.session.execute(co_occurrence.related(id, limit)):
+            row = book_schema.from_row(book)
+            row['borrowers'] = book.borrowers
+            response.append(row)
+        return make_response(jsonify({'books':response}),200)
+
+
+class Recommendations(Resource):
+    @auth_token_required
+    def get(self):
+        try:
+            limit = recommendation_limit()
+        except ValueError as e:
+            return make_response(jsonify({'message':str(e)}),400)
+
+        seeds = db.session.execute(co_occurrence.seeds(current_user.username)).scalars().all()
+        response = []
+        if seeds:
+            for book in db.session.execute(co_occurrence.recommended(current_user.username, seeds, limit)):
+                row = book_schema.from_row(book)
+                row['score'] = book.score
+                response.append(row)
+        return make_response(jsonify({'books':response}),200)
+
+
+def is_entitled(username, book_id):
+    # An owned copy (user_book) or a loan that is active and not overdue gives access to the content
+    owned = select(user_book.c.book_id).where(user_book.c.username == username, user_book.c.book_id == book_id)
+    borrowed = select(UserRequest.id).where(UserRequest.username == username, UserRequest.book_id == book_id,
+                                            UserRequest.is_active == True, UserRequest.return_date >= date.today())
+    return db.session.execute(select(or_(exists(owned), exists(borrowed)))).scalar()
+
+
+def content_root():
+    return current_app.config.get('CONTENT_ROOT') or os.path.join(current_app.instance_path, 'content')
+
+
+class BookContent(Resource):
+    # Book.content is a URL (the client is redirected to it) or a path under CONTENT_ROOT. Local files are
+    # never read into memory: send_file hands them to the server's file wrapper (sendfile(2) under gunicorn),
+    # to the front server with USE_X_SENDFILE, or to nginx through CONTENT_ACCEL_PREFIX (X-Accel-Redirect).
+    # Range/If-Range, ETag and Last-Modified are handled by send_file's conditional mode.
+    @auth_token_required
+    def get(self, id):
+        book = db.session.get(Book, id)
+        if not book:
+            return make_response(jsonify({'message':'Book does not exist'}),404)
+
+        if not current_user.has_role('admin') and not is_entitled(current_user.username, id):
+            return make_response(jsonify({'message':'Borrow or buy the book to read it'}),403)
+
+        if book.content.startswith(('http://', 'https://')):
+            return redirect(book.content)
+
+        path = safe_join(content_root(), book.content)
+        if path is None or not os.path.isfile(path):
+            return make_response(jsonify({'message':'Book content is not available'}),404)
+
+        accel_prefix = current_app.config.get('CONTENT_ACCEL_PREFIX')
+        if accel_prefix:
+            response = make_response('', 200)
+            response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + book.content.lstrip('/')
+        else:
+            response = send_file(path, conditional=True, etag=True, last_modified=os.path.getmtime(path))
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
@@ -0,0 +1,150 @@
+import random
+import time
+from datetime import date, timedelta
+from flask import make_response, jsonify, current_app
+from flask_restful import Resource
+from flask_security import auth_token_required, current_user
+from sqlalchemy import select, update, exists, func, text
+from sqlalchemy.exc import OperationalError
+from applications.database import db, begin_immediate
+from applications.model import Book, User, UserRequest
+from applications.marshal_fields import user_request_schema
+from applications.cache import evict_on_commit, book_key
+
+# Borrow and return.
+# book.available_copies (copies not on loan) and user.active_loans are denormalized counters, so a borrow
+# never counts user_request rows. They are changed by conditional UPDATEs that only match while there is
+# a copy left and the user is under LOAN_LIMIT: the guard and the write are one statement, so two
+# concurrent borrowers can never both take the last copy. Each borrow/return is one short BEGIN IMMEDIATE
+# transaction (the write lock is taken up front, no reader-turned-writer deadlock), retried with a
+# growing pause when SQLite still answers "database is locked" after its busy_timeout.
+# The expire_loans job (applications/jobs.py) ends loans through end_loans() as well. Deletes of books
+# and sections call release_loans() before the cascade removes their loans. Writes that bypass these
+# must run backfill().
+
+
+class Busy(Exception):
+    pass
+
+
+def in_transaction(work, *args):
+    # Runs work(*args) -> (status, body) in its own BEGIN IMMEDIATE transaction, committed when the status
+    # is below 400, rolled back otherwise. Raises Busy when every attempt found the database locked.
+    retries = current_app.config.get('LOAN_BUSY_RETRIES', 5)
+    pause = current_app.config.get('LOAN_BUSY_PAUSE', 0.02)
+    for attempt in range(retries + 1):
+        try:
+            begin_immediate(db.session)
+            status, body = work(*args)
+            if status < 400:
+                db.session.commit()
+            else:
+                db.session.rollback()
+            return status, body
+        except OperationalError as e:
+            db.session.rollback()
+            if 'locked' not in str(e.orig) and 'busy' not in str(e.orig):
+                raise
+            if attempt < retries:
+                time.sleep(pause * 2 ** attempt * random.uniform(0.5, 1.5))
+    raise Busy()
+
+
+def borrow(username, book_id):
+    if db.session.execute(select(exists().where(UserRequest.username == username, UserRequest.book_id == book_id,
+                                                UserRequest.is_active == True))).scalar():
+        return 409, {'message':'You already borrowed this book'}
+
+    taken = db.session.execute(update(Book).where(Book.id == book_id, Book.available_copies > 0)
+                               .values(available_copies=Book.available_copies - 1)
+                               .execution_options(synchronize_session=False)).rowcount
+    if not taken:
+        if not db.session.get(Book, book_id):
+            return 404, {'message':'Book does not exist'}
+        return 409, {'message':'No copy of this book is available'}
+
+    limit = current_app.config.get('LOAN_LIMIT', 5)
+    counted = db.session.execute(update(User).where(User.username == username, User.active_loans < limit)
+                                 .values(active_loans=User.active_loans + 1)
+                                 .execution_options(synchronize_session=False)).rowcount
+    if not counted:
+        return 409, {'message':f'You already have {limit} books on loan, return one first'}
+
+    today = date.today()
+    loan = UserRequest(username=username, book_id=book_id, request_date=today, is_active=True,
+                       return_date=today + timedelta(days=current_app.config.get('LOAN_DAYS', 14)))
+    db.session.add(loan) # the active loan itself grants the content (is_entitled), user_book is for owned copies
+    db.session.flush()
+    evict_on_commit(db.session, book_key(book_id)) # the book response shows its available copies
+    return 201, {'message':'Book borrowed successfully', 'loan':user_request_schema.from_object(loan)}
+
+
+def give_back(username, book_id):
+    loan = db.session.execute(update(UserRequest).where(UserRequest.id == select(UserRequest.id).where(
+        UserRequest.username == username, UserRequest.book_id == book_id, UserRequest.is_active == True
+    ).limit(1).scalar_subquery()).values(is_active=False).returning(UserRequest.id)
+                              .execution_options(synchronize_session=False)).scalar()
+    if loan is None:
+        return 404, {'message':'You have no active loan of this book'}
+    end_loans(db.session.connection(), [{'username':username, 'book_id':book_id}])
+    evict_on_commit(db.session, book_key(book_id))
+    return 200, {'message':'Book returned successfully', 'loan_id':loan}
+
+
+def end_loans(conn, loans):
+    # Counterpart of loans just deactivated ({'username', 'book_id'} each): the copies are available
+    # again and the users have one loan less. Access to the content ends with the loan, owned copies
+    # (user_book) are left alone.
+    conn.execute(text('UPDATE book SET available_copies = available_copies + 1 WHERE id = :book_id'), loans)
+    conn.execute(text('UPDATE "user" SET active_loans = active_loans - 1 WHERE username = :username'), loans)
+
+
+def release_loans(conn, book_ids):
+    # Takes the active loans of the books selected by `book_ids` (a select of Book.id) out of their
+    # borrowers' counts. Run it before deleting the books, the cascade removes the loans.
+    active = select(UserRequest.username).where(UserRequest.book_id.in_(book_ids), UserRequest.is_active == True)
+    held = (select(func.count()).select_from(UserRequest)
+            .where(UserRequest.username == User.username, UserRequest.book_id.in_(book_ids), UserRequest.is_active == True)
+            .scalar_subquery())
+    conn.execute(update(User).where(User.username.in_(active)).values(active_loans=User.active_loans - held))
+
+
+def backfill(conn):
+    # Recomputes the counters from user_request. A book never has fewer copies than it has loans.
+    conn.execute(text("""
+        UPDATE book SET copies = max(copies, (
+            SELECT count(*) FROM user_request WHERE user_request.book_id = book.id AND user_request.is_active = 1
+        ))
+    """))
+    conn.execute(text("""
+        UPDATE book SET available_copies = copies - (
+            SELECT count(*) FROM user_request WHERE user_request.book_id = book.id AND user_request.is_active = 1
+        )
+    """))
+    conn.execute(text("""
+        UPDATE "user" SET active_loans = (
+            SELECT count(*) FROM user_request WHERE user_request.username = "user".username AND user_request.is_active = 1
+        )
+    """))
+
+
+def answer(work, book_id):
+    try:
+        status, body = in_transaction(work, current_user.username, book_id)
+    except Busy:
+        response = make_response(jsonify({'message':'The library is busy, try again'}),503)
+        response.headers['Retry-After'] = '1'
+        return response
+    return make_response(jsonify(body),status)
+
+
+class BookBorrow(Resource):
+    @auth_token_required
+    def post(self, id):
+        return answer(borrow, id)
+
+
+class BookReturn(Resource):
+    @auth_token_required
+    def post(self, id):
+        return answer(give_back, id)
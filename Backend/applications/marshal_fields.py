@@ -1,10 +1,22 @@
 from flask_restful import fields
 from datetime import datetime
+from functools import lru_cache
+from operator import attrgetter
+from sqlalchemy import select
+from applications.model import Book, Section, Rating, UserRequest
 
 
+# Dates repeat a lot across rows (books added the same day), so formatted values are memoized
+@lru_cache(maxsize=4096)
 def date_format(date):
     return date.strftime('%d-%m-%Y') if date else None
 
+
+@lru_cache(maxsize=4096)
+def iso_date(date):
+    return date.strftime('%Y-%m-%d') if date else None
+
+
 section = {
     "id":fields.Integer,
     "name":fields.String,
@@ -16,4 +28,106 @@ section = {
 
 sections = {
     "sections":fields.List(fields.Nested(section))
-}
\ No newline at end of file
+}
+
+
+# Schema registry.
+# A schema lists the output fields of a model as (key, attribute, formatter). It is compiled once into a
+# single function building the dict from a row tuple, so serializing a row is one dict display instead of
+# a loop over fields. from_row takes the tuples of a select(*schema.columns) query (no ORM objects, no
+# identity map), from_object takes a model instance that is already loaded.
+
+class Schema:
+    def __init__(self, name, model, field_list):
+        self.name = name
+        self.model = model
+        self.fields = [(key, attribute or key, formatter) for key, attribute, formatter in field_list]
+        self.columns = [getattr(model, attribute) for key, attribute, formatter in self.fields]
+        self._attributes = attrgetter(*[attribute for key, attribute, formatter in self.fields])
+        self.from_row = self._compile()
+
+    def _compile(self):
+        namespace = {}
+        items = []
+        for i, (key, attribute, formatter) in enumerate(self.fields):
+            if formatter is None:
+                items.append(f'{key!r}:row[{i}]')
+            else:
+                namespace[f'format_{i}'] = formatter
+                items.append(f'{key!r}:format_{i}(row[{i}])')
+        exec(f'def from_row(row):\n    return {{{", ".join(items)}}}\n', namespace)
+        return namespace['from_row']
+
+    def from_object(self, obj):
+        return self.from_row(self._attributes(obj))
+
+    def select(self):
+        return select(*self.columns)
+
+
+schemas = {}
+
+
+def register_schema(name, model, field_list):
+    schemas[name] = Schema(name, model, field_list)
+    return schemas[name]
+
+
+book_schema = register_schema('book', Book, [
+    ('book_id', 'id', None),
+    ('title', None, None),
+    ('content_type', None, None),
+    ('content', None, None),
+    ('author', None, None),
+    ('image', None, None),
+    ('date_created', None, iso_date),
+    ('download_price', None, None),
+    ('section_id', None, None),
+])
+
+# Books.get embeds the section instead of section_id, and shows the availability
+book_detail_schema = register_schema('book_detail', Book, [
+    field for field in book_schema.fields if field[0] != 'section_id'
+] + [('copies', None, None), ('available_copies', None, None)])
+
+# Same output as the `section` marshal fields above
+section_schema = register_schema('section', Section, [
+    ('id', None, None),
+    ('name', None, None),
+    ('date_created', None, date_format),
+    ('description', None, None),
+    ('image', None, None),
+])
+
+# Returned by Sections.post
+section_created_schema = register_schema('section_created', Section, [
+    ('section_id', 'id', None),
+    ('name', None, None),
+    ('description', None, None),
+    ('image', None, None),
+    ('date_created', None, iso_date),
+])
+
+# Section embedded in a book
+section_ref_schema = register_schema('section_ref', Section, [
+    ('section_id', 'id', None),
+    ('name', None, None),
+    ('description', None, None),
+])
+
+rating_schema = register_schema('rating', Rating, [
+    ('id', None, None),
+    ('book_id', None, None),
+    ('username', None, None),
+    ('rating', None, None),
+    ('feedback', None, None),
+])
+
+user_request_schema = register_schema('user_request', UserRequest, [
+    ('id', None, None),
+    ('username', None, None),
+    ('book_id', None, None),
+    ('request_date', None, iso_date),
+    ('return_date', None, iso_date),
+    ('is_active', None, None),
+])
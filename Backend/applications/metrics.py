@@ -0,0 +1,204 @@
+import hashlib
+import hmac
+import logging
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from flask import Response, g, has_request_context, request, current_app
+from flask_restful import Resource
+from flask_security import auth_token_required, roles_required
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Request and SQL metrics in the Prometheus text format, served by GET /api/v1/metrics to admins, or to a
+# scraper sending `Authorization: Bearer <METRICS_TOKEN>` when that is set.
+# For every endpoint and method: a latency histogram, the responses by status, and the number and time
+# of the SQL statements the requests issued. Statements slower than SLOW_QUERY_MS are kept as samples
+# (the last SLOW_QUERY_SAMPLES) labelled with a fingerprint of their SQL, the text itself is only logged.
+# With METRICS_SERVER_TIMING each response also carries a Server-Timing header (`app` and `db` durations).
+# Recording is a few dict updates under a lock per request.
+# Metrics are per process: with several workers, scrape each of them.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_WHITESPACE = re.compile(r'\s+')
+
+logger = logging.getLogger(__name__)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+def fingerprint(sql):
+    return hashlib.sha1(sql.encode()).hexdigest()[:12]
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.enabled = False
+        self.buckets = DEFAULT_BUCKETS
+        self.slow_query_seconds = 0.1
+        self.server_timing = False
+        self.lock = threading.Lock()
+        self.reset(50)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('METRICS_ENABLED', True)
+        self.buckets = tuple(app.config.get('METRICS_BUCKETS', DEFAULT_BUCKETS))
+        self.slow_query_seconds = app.config.get('SLOW_QUERY_MS', 100) / 1000
+        self.server_timing = app.config.get('METRICS_SERVER_TIMING', False)
+        self.reset(app.config.get('SLOW_QUERY_SAMPLES', 50))
+        if self.enabled:
+            app.before_request(self._before_request)
+            app.after_request(self._after_request)
+
+    def reset(self, samples=None):
+        with self.lock:
+            self.requests = {} # (endpoint, method) -> [bucket counts..., +Inf count, sum, sql count, sql seconds]
+            self.statuses = {} # (endpoint, method, status) -> count
+            self.slow_queries = deque(maxlen=samples or self.slow_queries.maxlen)
+
+    def _before_request(self):
+        g.metrics_started = time.perf_counter()
+        g.sql_count = 0
+        g.sql_seconds = 0.0
+
+    def _after_request(self, response):
+        started = g.get('metrics_started')
+        if started is None:
+            return response
+        seconds = time.perf_counter() - started
+        key = (request.endpoint or 'unknown', request.method)
+        sql_count = g.get('sql_count', 0)
+        sql_seconds = g.get('sql_seconds', 0.0)
+        n = len(self.buckets)
+
+        with self.lock:
+            row = self.requests.get(key)
+            if row is None:
+                row = self.requests[key] = [0] * (n + 1) + [0.0, 0, 0.0]
+            row[bisect_left(self.buckets, seconds)] += 1
+            row[n + 1] += seconds
+            row[n + 2] += sql_count
+            row[n + 3] += sql_seconds
+            status_key = key + (response.status_code,)
+            self.statuses[status_key] = self.statuses.get(status_key, 0) + 1
+
+        if self.server_timing:
+            response.headers['Server-Timing'] = 'app;dur=%.2f, db;dur=%.2f;desc="%d queries"' % (
+                seconds * 1000, sql_seconds * 1000, sql_count)
+        return response
+
+    def record_query(self, statement, seconds):
+        # Called for every statement executed inside a request
+        g.sql_count = g.get('sql_count', 0) + 1
+        g.sql_seconds = g.get('sql_seconds', 0.0) + seconds
+        if seconds >= self.slow_query_seconds:
+            sql = _WHITESPACE.sub(' ', statement).strip()
+            query = fingerprint(sql)
+            logger.warning('Slow query %s in %s %s took %.1f ms: %s', query, request.method, request.path,
+                           seconds * 1000, sql[:500])
+            with self.lock:
+                self.slow_queries.append((request.endpoint or 'unknown', request.method, seconds, query))
+
+    def render(self):
+        n = len(self.buckets)
+        with self.lock:
+            requests = {key:list(row) for key, row in self.requests.items()}
+            statuses = dict(self.statuses)
+            slow_queries = list(self.slow_queries)
+
+        lines = [
+            '# HELP lms_http_request_duration_seconds Request latency by endpoint and method.',
+            '# TYPE lms_http_request_duration_seconds histogram',
+        ]
+        for (endpoint, method), row in sorted(requests.items()):
+            labels = 'endpoint="%s",method="%s"' % (_label(endpoint), method)
+            cumulative = 0
+            for bound, count in zip(self.buckets, row):
+                cumulative += count
+                lines.append('lms_http_request_duration_seconds_bucket{%s,le="%s"} %d' % (labels, bound, cumulative))
+            total = cumulative + row[n]
+            lines.append('lms_http_request_duration_seconds_bucket{%s,le="+Inf"} %d' % (labels, total))
+            lines.append('lms_http_request_duration_seconds_sum{%s} %.6f' % (labels, row[n + 1]))
+            lines.append('lms_http_request_duration_seconds_count{%s} %d' % (labels, total))
+
+        lines += [
+            '# HELP lms_http_responses_total Responses by endpoint, method and status.',
+            '# TYPE lms_http_responses_total counter',
+        ]
+        for (endpoint, method, status), count in sorted(statuses.items()):
+            lines.append('lms_http_responses_total{endpoint="%s",method="%s",status="%d"} %d' % (
+                _label(endpoint), method, status, count))
+
+        lines += [
+            '# HELP lms_sql_queries_total SQL statements issued by the requests of an endpoint.',
+            '# TYPE lms_sql_queries_total counter',
+        ]
+        for (endpoint, method), row in sorted(requests.items()):
+            lines.append('lms_sql_queries_total{endpoint="%s",method="%s"} %d' % (_label(endpoint), method, row[n + 2]))
+        lines += [
+            '# HELP lms_sql_query_seconds_total Time spent executing those statements.',
+            '# TYPE lms_sql_query_seconds_total counter',
+        ]
+        for (endpoint, method), row in sorted(requests.items()):
+            lines.append('lms_sql_query_seconds_total{endpoint="%s",method="%s"} %.6f' % (
+                _label(endpoint), method, row[n + 3]))
+
+        lines += [
+            '# HELP lms_slow_query_seconds Most recent statements slower than SLOW_QUERY_MS, by SQL fingerprint.',
+            '# TYPE lms_slow_query_seconds gauge',
+        ]
+        for endpoint, method, seconds, query in slow_queries:
+            lines.append('lms_slow_query_seconds{endpoint="%s",method="%s",query="%s"} %.6f' % (
+                _label(endpoint), method, query, seconds))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = RequestMetrics()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    if metrics.enabled:
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_query(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('metrics_started')
+    if started:
+        seconds = time.perf_counter() - started.pop()
+        if has_request_context():
+            metrics.record_query(statement, seconds)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _failed_query(context):
+    # after_cursor_execute does not run for a failed statement
+    started = context.connection.info.get('metrics_started') if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def _scraper():
+    token = current_app.config.get('METRICS_TOKEN')
+    return bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+
+
+class Metrics(Resource):
+    def get(self):
+        if not metrics.enabled:
+            return Response('metrics are disabled\n', 404, mimetype='text/plain')
+        return self.render() if _scraper() else self.render_for_admin()
+
+    @auth_token_required
+    @roles_required('admin')
+    def render_for_admin(self):
+        return self.render()
+
+    def render(self):
+        return Response(metrics.render(), 200, mimetype='text/plain; version=0.0.4')
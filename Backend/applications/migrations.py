@@ -0,0 +1,167 @@
+from sqlalchemy import text
+from sqlalchemy.schema import CreateTable, CreateIndex
+
+# Versioned schema migrations for the SQLite database.
+# db.create_all() only creates missing tables, it never changes existing ones, so every change to an
+# existing table (indexes, columns...) is added here as a new numbered migration. The version applied
+# last is kept in PRAGMA user_version. Migrations must be idempotent: on a fresh database create_all()
+# has already built the current schema and upgrade() only records the version.
+# Migrations run with foreign key enforcement off, so a table can be rebuilt (see rebuild_table), and
+# must leave no dangling reference behind: PRAGMA foreign_key_check is run before each commit.
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def decorator(f):
+        MIGRATIONS.append((version, description, f))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return f
+    return decorator
+
+
+def create_index(conn, name, table, columns, unique=False):
+    conn.execute(text('CREATE %sINDEX IF NOT EXISTS %s ON "%s" (%s)' % (
+        'UNIQUE ' if unique else '', name, table, ', '.join(columns)
+    )))
+
+
+def add_column(conn, table, column, ddl):
+    columns = [row[1] for row in conn.execute(text(f'PRAGMA table_info("{table}")'))]
+    if column not in columns:
+        conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl}'))
+
+
+def rebuild_table(conn, table):
+    # SQLite cannot ALTER a constraint: the table is copied into a new one created from the model's
+    # current definition, swapped in, and the model's indexes are created again
+    preparer = conn.dialect.identifier_preparer
+    name = preparer.format_table(table)
+    new_name = preparer.quote(f'_new_{table.name}')
+    existing = {row[1] for row in conn.execute(text(f'PRAGMA table_info({name})'))}
+    columns = ', '.join(preparer.quote(column.name) for column in table.columns if column.name in existing)
+
+    ddl = str(CreateTable(table).compile(dialect=conn.dialect)).strip()
+    conn.execute(text(f'DROP TABLE IF EXISTS {new_name}'))
+    conn.execute(text(ddl.replace(f'CREATE TABLE {name}', f'CREATE TABLE {new_name}', 1)))
+    conn.execute(text(f'INSERT INTO {new_name} ({columns}) SELECT {columns} FROM {name}'))
+    conn.execute(text(f'DROP TABLE {name}'))
+    conn.execute(text(f'ALTER TABLE {new_name} RENAME TO {name}'))
+    for index in table.indexes:
+        conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+def on_delete(conn, table, referred_table):
+    # ON DELETE action of the foreign keys of `table` to `referred_table`
+    return {row[6] for row in conn.execute(text(f'PRAGMA foreign_key_list("{table}")')) if row[2] == referred_table}
+
+
+def current_version(conn):
+    return conn.execute(text('PRAGMA user_version')).scalar()
+
+
+def upgrade(engine, target=None):
+    # Applies every pending migration, each one in its own transaction. Returns the applied versions.
+    applied = []
+    for version, description, apply in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        with engine.connect() as conn:
+            # SQLite ignores this pragma inside a transaction, it is set before BEGIN
+            enforced = conn.execute(text('PRAGMA foreign_keys')).scalar()
+            conn.execute(text('PRAGMA foreign_keys = OFF'))
+            conn.commit()
+            try:
+                with conn.begin():
+                    if current_version(conn) >= version:
+                        continue
+                    apply(conn)
+                    violations = conn.execute(text('PRAGMA foreign_key_check')).fetchall()
+                    if violations:
+                        raise RuntimeError('Migration %d leaves dangling foreign keys: %r' % (version, violations[:10]))
+                    conn.execute(text(f'PRAGMA user_version = {int(version)}'))
+            finally:
+                conn.execute(text(f'PRAGMA foreign_keys = {int(enforced)}'))
+                conn.commit()
+        applied.append((version, description))
+    return applied
+
+
+@migration(1, 'Secondary indexes for the API lookups')
+def _api_indexes(conn):
+    create_index(conn, 'ix_user_request_username_is_active', 'user_request', ['username', 'is_active'])
+    create_index(conn, 'ix_user_request_book_id', 'user_request', ['book_id'])
+    create_index(conn, 'ix_rating_book_id', 'rating', ['book_id'])
+    create_index(conn, 'ix_book_section_id', 'book', ['section_id'])
+    create_index(conn, 'ix_role_user_username', 'role_user', ['username'])
+    create_index(conn, 'ix_section_name', 'section', ['name'])
+
+
+@migration(2, 'Rating aggregates on book and section')
+def _rating_aggregates(conn):
+    from applications.ratings import rating_aggregates
+    add_column(conn, 'book', 'rating_count', 'INTEGER NOT NULL DEFAULT 0')
+    add_column(conn, 'book', 'rating_sum', 'FLOAT NOT NULL DEFAULT 0')
+    add_column(conn, 'book', 'rating_score', 'FLOAT NOT NULL DEFAULT 0')
+    add_column(conn, 'section', 'rating_count', 'INTEGER NOT NULL DEFAULT 0')
+    add_column(conn, 'section', 'rating_sum', 'FLOAT NOT NULL DEFAULT 0')
+    create_index(conn, 'ix_book_rating_score', 'book', ['rating_score'])
+    create_index(conn, 'ix_book_section_id_rating_score', 'book', ['section_id', 'rating_score'])
+    rating_aggregates.backfill(conn)
+
+
+@migration(3, 'Index for the overdue loan expiry job')
+def _loan_expiry_index(conn):
+    create_index(conn, 'ix_user_request_is_active_return_date', 'user_request', ['is_active', 'return_date'])
+
+
+@migration(4, 'ON DELETE CASCADE from section to book and from book to its ratings, loans and owners')
+def _cascading_deletes(conn):
+    from applications.model import Book, Rating, UserRequest, user_book
+    tables = [(Book.__table__, 'section'), (Rating.__table__, 'book'), (UserRequest.__table__, 'book'),
+              (user_book, 'book')]
+    # Rows left behind by deletes that went through the ORM are dropped, they would break the new constraints
+    conn.execute(text('DELETE FROM book WHERE section_id NOT IN (SELECT id FROM section)'))
+    for table, referred in tables[1:]:
+        conn.execute(text(f'DELETE FROM "{table.name}" WHERE book_id NOT IN (SELECT id FROM book)'))
+    for table, referred in tables:
+        if on_delete(conn, table.name, referred) != {'CASCADE'}:
+            rebuild_table(conn, table)
+    create_index(conn, 'ix_user_book_book_id', 'user_book', ['book_id'])
+
+
+@migration(5, '"Also borrowed" co-occurrence index, built from the existing loans')
+def _co_occurrence(conn):
+    from applications.model import borrow_history, book_cooccurrence
+    from applications.recommendations import co_occurrence
+    borrow_history.create(conn, checkfirst=True)
+    book_cooccurrence.create(conn, checkfirst=True)
+    co_occurrence.rebuild(conn)
+
+
+@migration(6, 'Creation time of loans and ratings, analytics rollup tables')
+def _stats_rollups(conn):
+    from applications.model import stats_rollup, stats_watermark
+    add_column(conn, 'user_request', 'created_at', 'DATETIME')
+    add_column(conn, 'rating', 'created_at', 'DATETIME')
+    # Older loans only have their day, older ratings nothing (see applications/stats.py)
+    conn.execute(text("UPDATE user_request SET created_at = request_date || ' 00:00:00.000000' WHERE created_at IS NULL"))
+    create_index(conn, 'ix_user_request_book_id_is_active', 'user_request', ['book_id', 'is_active'])
+    stats_rollup.create(conn, checkfirst=True)
+    stats_watermark.create(conn, checkfirst=True)
+
+
+@migration(7, 'Available copies per book and active loans per user')
+def _loan_counters(conn):
+    from applications import loans
+    add_column(conn, 'book', 'copies', 'INTEGER NOT NULL DEFAULT 1')
+    add_column(conn, 'book', 'available_copies', 'INTEGER NOT NULL DEFAULT 1')
+    add_column(conn, 'user', 'active_loans', 'INTEGER NOT NULL DEFAULT 0')
+    loans.backfill(conn)
+
+
+@migration(8, 'Analytics rollups kept when their section is deleted')
+def _stats_rollup_history(conn):
+    from applications.model import stats_rollup
+    if list(conn.execute(text('PRAGMA foreign_key_list("stats_rollup")'))):
+        rebuild_table(conn, stats_rollup)
@@ -1,6 +1,13 @@
+from datetime import datetime
 from applications.database import db
+from flask import current_app, has_app_context
 from flask_security import UserMixin, RoleMixin
 
+
+def prior_rating_score():
+    # An unrated book ranks at the prior mean of the Bayesian average (see applications/ratings.py)
+    return current_app.config.get('RATING_PRIOR_MEAN', 3.0) if has_app_context() else 3.0
+
 class User(db.Model, UserMixin):
     username = db.Column(db.String(30),primary_key=True)
     email = db.Column(db.String(50),nullable=False,unique=True)
@@ -9,6 +16,7 @@ class User(db.Model, UserMixin):
     fs_uniquifier = db.Column(db.String(255), unique=True, nullable=False)
     fs_token_uniquifier = db.Column(db.String(255),unique=True)
     active = db.Column(db.Boolean())
+    active_loans = db.Column(db.Integer, nullable=False, default=0, server_default='0') # see applications/loans.py
 
 
     #Relationships
@@ -27,25 +35,32 @@ class Role(db.Model, RoleMixin):
 
 class RoleUser(db.Model):
     id = db.Column(db.Integer,primary_key=True)
-    username = db.Column(db.String(30),db.ForeignKey('user.username'))
+    username = db.Column(db.String(30),db.ForeignKey('user.username'),index=True)
     role_id = db.Column(db.Integer,db.ForeignKey('role.role_id'))
 
 class Section(db.Model):
     id = db.Column(db.Integer,primary_key=True)
-    name = db.Column(db.String(100),nullable=False)
+    name = db.Column(db.String(100),nullable=False,index=True)
     date_created = db.Column(db.Date,nullable=False)
     description = db.Column(db.Text, nullable=False)
     image = db.Column(db.String(255), nullable=True,
                       default='https://images.unsplash.com/photo-1603058817990-2b9a9abbce86?crop=entropy&cs=tinysrgb&fit=crop&fm=jpg&h=900&ixid=MnwxfDB8MXxyYW5kb218MHx8Ym9va3N8fHx8fHwxNzEyMzc5MTU0&ixlib=rb-4.0.3&q=80&utm_campaign=api-credit&utm_medium=referral&utm_source=unsplash_source&w=1600')    
 
+    # Rating aggregates of all the books in the section, maintained by applications/ratings.py
+    rating_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_sum = db.Column(db.Float, nullable=False, default=0, server_default='0')
+
     #Relationships
-    books = db.relationship('Book', backref='section', lazy=True)
+    # Deleting a section deletes its books in the database (ON DELETE CASCADE), the ORM does not load them
+    books = db.relationship('Book', backref='section', lazy=True, passive_deletes=True)
 
     def __repr__(self):
         return f'<Section {self.name}>'
     
 
 class Book(db.Model):
+    __table_args__ = (db.Index('ix_book_section_id_rating_score', 'section_id', 'rating_score'),)
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     content_type = db.Column(db.String(100), nullable=False)
@@ -54,11 +69,20 @@ class Book(db.Model):
     image = db.Column(db.String(255), nullable=True, default='https://images.unsplash.com/photo-1622006816342-36fe7754b0c9?q=80&w=1887&auto=format&fit=crop&ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D')
     date_created = db.Column(db.Date, nullable=False)
     download_price = db.Column(db.Float, nullable=False)
-    section_id = db.Column(db.Integer, db.ForeignKey('section.id'), nullable=False)
+    section_id = db.Column(db.Integer, db.ForeignKey('section.id', ondelete='CASCADE'), nullable=False, index=True)
 
-    # Relationships
-    requests = db.relationship('UserRequest', backref='book', lazy=True)
-    ratings = db.relationship('Rating', backref='book', lazy=True)
+    # Rating aggregates maintained by applications/ratings.py, rating_score is the Bayesian average
+    rating_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_sum = db.Column(db.Float, nullable=False, default=0, server_default='0')
+    rating_score = db.Column(db.Float, nullable=False, default=prior_rating_score, server_default='0', index=True)
+
+    # Copies that can be lent and copies not on loan, maintained by applications/loans.py
+    copies = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    available_copies = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    # Relationships, the ratings, loans and user_book rows of a deleted book are deleted by the database
+    requests = db.relationship('UserRequest', backref='book', lazy=True, passive_deletes=True)
+    ratings = db.relationship('Rating', backref='book', lazy=True, passive_deletes=True)
 
 
     def __repr__(self):
@@ -75,29 +99,105 @@ class Book(db.Model):
 
 class Rating(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id', ondelete='CASCADE'), nullable=False, index=True)
     username = db.Column(db.String(30), db.ForeignKey('user.username'), nullable=False)  # Updated line
     rating = db.Column(db.Float, nullable=False)
     feedback = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=True, default=datetime.now) # bucket of the rating in stats_rollup
 
     user = db.relationship('User', backref='ratings', lazy=True)
 
 
 user_book = db.Table('user_book',
                      db.Column('username', db.String(30), db.ForeignKey('user.username'), primary_key=True),
-                     db.Column('book_id', db.Integer, db.ForeignKey('book.id'), primary_key=True)
+                     db.Column('book_id', db.Integer, db.ForeignKey('book.id', ondelete='CASCADE'), primary_key=True),
+                     db.Index('ix_user_book_book_id', 'book_id') # the cascade from book looks rows up by book_id
                      )
 
 
+# "Also borrowed" index maintained by applications/recommendations.py.
+# borrow_history: every (user, book) pair of user_request and user_book once, position numbers a user's
+# books in the order they first appeared. book_cooccurrence: users who borrowed both books, both ways.
+borrow_history = db.Table('borrow_history',
+                          db.Column('username', db.String(30), db.ForeignKey('user.username'), primary_key=True),
+                          db.Column('book_id', db.Integer, db.ForeignKey('book.id', ondelete='CASCADE'), primary_key=True),
+                          db.Column('position', db.Integer, nullable=False),
+                          db.Index('ix_borrow_history_username_position', 'username', 'position', unique=True),
+                          db.Index('ix_borrow_history_book_id', 'book_id'),
+                          sqlite_with_rowid=False
+                          )
+
+book_cooccurrence = db.Table('book_cooccurrence',
+                             db.Column('book_id', db.Integer, db.ForeignKey('book.id', ondelete='CASCADE'), primary_key=True),
+                             db.Column('related_id', db.Integer, db.ForeignKey('book.id', ondelete='CASCADE'), primary_key=True),
+                             db.Column('borrowers', db.Integer, nullable=False),
+                             # the top-K of a book is a walk of this index from its highest count
+                             db.Index('ix_book_cooccurrence_book_id_borrowers', 'book_id', 'borrowers', 'related_id'),
+                             db.Index('ix_book_cooccurrence_related_id', 'related_id'),
+                             sqlite_with_rowid=False
+                             )
+
+
 class UserRequest(db.Model):
+    # Indexes and foreign keys are also rolled out to existing databases by applications/migrations.py
+    __table_args__ = (
+        db.Index('ix_user_request_username_is_active', 'username', 'is_active'),
+        db.Index('ix_user_request_is_active_return_date', 'is_active', 'return_date'),
+        db.Index('ix_user_request_book_id_is_active', 'book_id', 'is_active'), # active loans of a section
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(30), db.ForeignKey('user.username'), nullable=False)
-    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id', ondelete='CASCADE'), nullable=False, index=True)
     request_date = db.Column(db.Date, nullable=False)
     return_date = db.Column(db.Date, nullable=False)
     is_active = db.Column(db.Boolean, nullable=False, default=True)
+    created_at = db.Column(db.DateTime, nullable=True, default=datetime.now) # bucket of the loan in stats_rollup
 
     user = db.relationship('User', backref='requests', lazy=True)
 
     def __repr__(self):
-        return f'<UserRequest {self.id}>'
\ No newline at end of file
+        return f'<UserRequest {self.id}>'
+
+
+class JobRun(db.Model):
+    # One row per run of a scheduled job (see applications/scheduler.py)
+    __table_args__ = (db.Index('ix_job_run_job_status', 'job', 'status'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    job = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False) # running, finished or failed
+    started_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    cutoff = db.Column(db.String(30), nullable=True) # job specific bound, kept so a resumed run uses the same one
+    last_id = db.Column(db.Integer, nullable=True) # last row processed
+    rows = db.Column(db.Integer, nullable=False, default=0)
+    batches = db.Column(db.Integer, nullable=False, default=0)
+    duration_ms = db.Column(db.Float, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+
+    def __repr__(self):
+        return f'<JobRun {self.job} {self.id}>'
+
+
+# Analytics rollups maintained by applications/stats.py, one row per grain ('hour' or 'day'), bucket
+# ('2024-05-01T13' or '2024-05-01') and section. Counts loans and ratings in the bucket they were written in.
+# section_id is not a foreign key: the rows of a deleted section stay, and so do the totals they add up to.
+stats_rollup = db.Table('stats_rollup',
+                        db.Column('grain', db.String(4), primary_key=True),
+                        db.Column('bucket', db.String(13), primary_key=True),
+                        db.Column('section_id', db.Integer, primary_key=True),
+                        db.Column('loans', db.Integer, nullable=False, server_default='0'),
+                        db.Column('revenue', db.Float, nullable=False, server_default='0'), # download_price of the loaned books
+                        db.Column('ratings', db.Integer, nullable=False, server_default='0'),
+                        db.Column('rating_sum', db.Float, nullable=False, server_default='0'),
+                        *[db.Column(f'rating_{stars}', db.Integer, nullable=False, server_default='0') for stars in range(1, 6)],
+                        db.Index('ix_stats_rollup_section_id_grain_bucket', 'section_id', 'grain', 'bucket'),
+                        sqlite_with_rowid=False
+                        )
+
+# Last user_request/rating id already counted in stats_rollup
+stats_watermark = db.Table('stats_watermark',
+                           db.Column('source', db.String(30), primary_key=True),
+                           db.Column('last_id', db.Integer, nullable=False)
+                           )
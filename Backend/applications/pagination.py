@@ -0,0 +1,89 @@
+import json
+from flask import Response, request, stream_with_context
+from applications.database import db
+
+# Keyset (cursor) pagination helpers for the listing endpoints.
+# Pages are ordered by the primary key, so a page is `WHERE id > :after ORDER BY id LIMIT :limit`
+# which stays an index range scan no matter how deep the client pages.
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+STREAM_BATCH_SIZE = 500
+PAGE_PARAMS = ('limit', 'after') # query parameters read by page_args(), besides stream
+
+
+def _to_int(value, name):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} must be an integer')
+
+
+def page_args():
+    # Returns (paginate, limit, after, stream) from the query string.
+    # Listings without limit/after/stream keep the old plain-list response.
+    args = request.args
+    stream = args.get('stream', '').lower() in ('1', 'true', 'yes')
+    paginate = 'limit' in args or 'after' in args
+
+    limit = None
+    if paginate:
+        limit = _to_int(args.get('limit', DEFAULT_PAGE_SIZE), 'limit')
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            raise ValueError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+
+    after = _to_int(args.get('after', 0), 'after')
+    if after < 0:
+        raise ValueError('after must be a positive integer')
+
+    return paginate, limit, after, stream
+
+
+def keyset(stmt, id_column, limit, after):
+    # Applies the cursor to a select() statement. One extra row is fetched to know if there is a next page.
+    stmt = stmt.where(id_column > after).order_by(id_column)
+    if limit is not None:
+        stmt = stmt.limit(limit + 1)
+    return stmt
+
+
+def _rows(result, tuples):
+    # ORM entities by default, plain row tuples for a select() of columns (see marshal_fields.Schema)
+    return result if tuples else result.scalars()
+
+
+def fetch_page(stmt, id_column, limit, after, tuples=False):
+    rows = _rows(db.session.execute(keyset(stmt, id_column, limit, after)), tuples).all()
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+    return rows, next_cursor
+
+
+def stream_page(key, stmt, id_column, limit, after, serialize, tuples=False):
+    # Streams `{"<key>": [...], "next_cursor": ...}` row by row. Rows are pulled from the cursor in
+    # batches of STREAM_BATCH_SIZE, so memory stays flat whatever the size of the listing.
+    stmt = keyset(stmt, id_column, limit, after).execution_options(yield_per=STREAM_BATCH_SIZE)
+
+    def generate():
+        yield '{"%s":[' % key
+        result = _rows(db.session.execute(stmt), tuples)
+        count = 0
+        last_id = None
+        try:
+            for row in result:
+                if limit is not None and count == limit:
+                    break
+                if count:
+                    yield ','
+                yield json.dumps(serialize(row))
+                last_id = row.id
+                count += 1
+            else:
+                last_id = None
+        finally:
+            result.close()
+        yield '],"next_cursor":%s}' % json.dumps(last_id)
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
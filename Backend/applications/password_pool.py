@@ -0,0 +1,118 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from flask import current_app
+from flask_security.utils import get_hmac, use_double_hash
+from passlib.context import CryptContext
+
+# Password hashing/verification off the request threads.
+# argon2/bcrypt take tens to hundreds of ms of CPU per call, so Login and Register send the work to a
+# small process pool. At most PASSWORD_POOL_MAX_PENDING calls may be queued or running; past that the
+# caller gets PoolSaturated straight away (the handlers answer 503) instead of piling up threads.
+#
+# The HMAC pre-hash Flask-Security applies is done here in the request thread (it is cheap and needs the
+# app config), the worker only runs the passlib context, rebuilt from the app's policy string.
+
+class PoolSaturated(Exception):
+    pass
+
+
+_worker_context = None
+
+
+def _init_worker(policy):
+    global _worker_context
+    _worker_context = CryptContext.from_string(policy)
+
+
+def _hash(secret, context=None):
+    return (context or _worker_context).hash(secret)
+
+
+def _verify(verify_secret, password_hash, hash_secret, context=None):
+    # Returns (verified, new_hash). new_hash is set when the stored hash was made with another scheme
+    # or other cost parameters than the ones configured now.
+    context = context or _worker_context
+    if not context.verify(verify_secret, password_hash):
+        return False, None
+    if context.needs_update(password_hash):
+        return True, context.hash(hash_secret)
+    return True, None
+
+
+class PasswordPool:
+    def __init__(self):
+        self.workers = 0
+        self.max_pending = 0
+        self.timeout = None
+        self.start_method = 'spawn'
+        self._executor = None
+        self._executor_key = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.workers = app.config.get('PASSWORD_POOL_WORKERS', min(4, os.cpu_count() or 1))
+        self.max_pending = app.config.get('PASSWORD_POOL_MAX_PENDING', 4 * max(self.workers, 1))
+        self.timeout = app.config.get('PASSWORD_POOL_TIMEOUT', 10)
+        self.start_method = app.config.get('PASSWORD_POOL_START_METHOD', 'spawn')
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self.shutdown()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._executor_key[0] == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._executor_key = None
+
+    def _get_executor(self, policy):
+        # One executor per process (workers forked by gunicorn must not share the parent's pool)
+        # and per password policy, so a config change takes effect on the next call
+        key = (os.getpid(), policy)
+        with self._lock:
+            if self._executor_key != key:
+                if self._executor is not None and self._executor_key[0] == os.getpid():
+                    self._executor.shutdown(wait=False)
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(self.start_method),
+                    initializer=_init_worker,
+                    initargs=(policy,)
+                )
+                self._executor_key = key
+            return self._executor
+
+    def _run(self, fn, *args):
+        context = current_app.security.pwd_context
+        if not self.workers:
+            return fn(*args, context=context)
+
+        if not self._slots.acquire(blocking=False):
+            raise PoolSaturated()
+        try:
+            future = self._get_executor(context.to_string()).submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise PoolSaturated()
+
+    def hash_password(self, password):
+        # Same result as flask_security.utils.hash_password
+        secret = get_hmac(password).decode('ascii') if use_double_hash() else password
+        return self._run(_hash, secret)
+
+    def verify_and_update(self, password, password_hash):
+        # Same check as flask_security.utils.verify_password, plus the rehash when the policy changed
+        verify_secret = get_hmac(password) if use_double_hash(password_hash) else password
+        hash_secret = get_hmac(password).decode('ascii') if use_double_hash() else password
+        return self._run(_verify, verify_secret, password_hash, hash_secret)
+
+
+password_pool = PasswordPool()
@@ -0,0 +1,159 @@
+import threading
+import time
+from collections import OrderedDict
+from flask_security import UserMixin, RoleMixin
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from applications.model import User, RoleUser
+
+# Cache of authenticated principals, keyed by fs_token_uniquifier.
+# Token authenticated requests get a CachedUser instead of the User row: it carries the identity
+# and the role names, which is all auth_token_required/roles_required need, so a cache hit costs
+# no query at all. CachedUser is not mapped - load User by username if a handler needs the row.
+#
+# Entries are evicted on Logout, when the user's roles, active flag or token uniquifier change
+# (through the ORM events below) and when the TTL runs out. The cache is per process, so keep the
+# TTL short: another worker only notices a rotation once its own entry expires.
+
+
+class CachedRole(RoleMixin):
+    def __init__(self, name):
+        self.name = name
+        self.permissions = None
+
+
+class CachedUser(UserMixin):
+    def __init__(self, username, email, fs_uniquifier, fs_token_uniquifier, active, roles):
+        self.username = username
+        self.email = email
+        self.fs_uniquifier = fs_uniquifier
+        self.fs_token_uniquifier = fs_token_uniquifier
+        self.active = active
+        self.roles = [CachedRole(name) for name in roles]
+
+    def __repr__(self):
+        return f'<CachedUser {self.username}>'
+
+
+class PrincipalCache:
+    def __init__(self, maxsize=4096, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._by_username = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.maxsize = app.config.get('PRINCIPAL_CACHE_SIZE', self.maxsize)
+        self.ttl = app.config.get('PRINCIPAL_CACHE_TTL', self.ttl)
+        self.clear()
+
+    def get(self, uniquifier):
+        with self._lock:
+            item = self._data.get(uniquifier)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    self._remove(uniquifier)
+                self.misses += 1
+                return None
+            self._data.move_to_end(uniquifier)
+            self.hits += 1
+            return item[1]
+
+    def put(self, user):
+        principal = CachedUser(user.username, user.email, user.fs_uniquifier, user.fs_token_uniquifier,
+                               user.active, [role.name for role in user.roles])
+        if not self.ttl:
+            return principal
+        with self._lock:
+            self._remove(principal.fs_token_uniquifier)
+            self._data[principal.fs_token_uniquifier] = (time.monotonic() + self.ttl, principal)
+            self._by_username[principal.username] = principal.fs_token_uniquifier
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+        return principal
+
+    def evict(self, uniquifier):
+        with self._lock:
+            if self._remove(uniquifier):
+                self.evictions += 1
+
+    def evict_user(self, username):
+        with self._lock:
+            uniquifier = self._by_username.get(username)
+            if uniquifier is not None and self._remove(uniquifier):
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._by_username.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits':self.hits,
+                'misses':self.misses,
+                'evictions':self.evictions,
+                'hit_ratio':round(self.hits / lookups, 4) if lookups else None,
+                'size':len(self._data),
+                'maxsize':self.maxsize,
+                'ttl':self.ttl
+            }
+
+    def _remove(self, uniquifier):
+        item = self._data.pop(uniquifier, None)
+        if item is None:
+            return False
+        if self._by_username.get(item[1].username) == uniquifier:
+            del self._by_username[item[1].username]
+        return True
+
+
+principal_cache = PrincipalCache()
+
+
+def _evict_username(username, session=None):
+    # Evict now and again once the transaction commits, so a request that reloaded
+    # the old row in between cannot leave a stale entry behind
+    principal_cache.evict_user(username)
+    if session is not None:
+        session.info.setdefault('evict_principals', set()).add(username)
+
+
+@event.listens_for(User.fs_token_uniquifier, 'set')
+def _on_uniquifier_rotated(target, value, oldvalue, initiator):
+    if isinstance(oldvalue, str):
+        principal_cache.evict(oldvalue)
+    if target.username:
+        _evict_username(target.username, object_session(target))
+
+
+@event.listens_for(User.active, 'set')
+def _on_active_changed(target, value, oldvalue, initiator):
+    if target.username:
+        _evict_username(target.username, object_session(target))
+
+
+@event.listens_for(User.roles, 'append')
+@event.listens_for(User.roles, 'remove')
+def _on_roles_changed(target, value, initiator):
+    if target.username:
+        _evict_username(target.username, object_session(target))
+
+
+@event.listens_for(User, 'after_delete')
+@event.listens_for(RoleUser, 'after_insert')
+@event.listens_for(RoleUser, 'after_delete')
+def _on_row_changed(mapper, connection, target):
+    _evict_username(target.username, object_session(target))
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    for username in session.info.pop('evict_principals', ()):
+        principal_cache.evict_user(username)
@@ -0,0 +1,67 @@
+import logging
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Per-request SQL statement budget.
+# Every statement executed while handling a request is counted. A request that goes over its budget
+# (QUERY_BUDGET, or QUERY_BUDGETS[endpoint] for one resource, None for no limit) is an N+1 regression: an `include=` or a
+# serializer that started loading a relationship row by row. In strict mode (QUERY_BUDGET_STRICT,
+# defaults to app.testing) the request fails with QueryBudgetExceeded, otherwise a warning is logged.
+# In debug and testing the count is returned in the X-Query-Count header.
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    def __init__(self, endpoint, count, budget):
+        super().__init__(f'{endpoint} issued {count} SQL statements, budget is {budget}')
+        self.endpoint = endpoint
+        self.count = count
+        self.budget = budget
+
+
+class QueryBudget:
+    def __init__(self):
+        self.budget = 15
+        self.budgets = {}
+        self.strict = False
+        self.header = False
+
+    def init_app(self, app):
+        self.budget = app.config.get('QUERY_BUDGET', self.budget)
+        self.budgets = app.config.get('QUERY_BUDGETS', {})
+        self.strict = app.config.get('QUERY_BUDGET_STRICT', app.testing)
+        self.header = app.debug or app.testing
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def limit(self, endpoint):
+        return self.budgets.get(endpoint, self.budget)
+
+    def _before_request(self):
+        # g outlives the request when an app context was already pushed (CLI, test harnesses)
+        g.query_count = 0
+
+    def _after_request(self, response):
+        count = g.get('query_count', 0)
+        if self.header:
+            response.headers['X-Query-Count'] = str(count)
+        budget = self.limit(request.endpoint)
+        if budget is not None and count > budget:
+            if self.strict:
+                raise QueryBudgetExceeded(request.endpoint, count, budget)
+            logger.warning('%s %s issued %d SQL statements, budget is %d', request.method, request.path,
+                           count, budget)
+        return response
+
+
+query_budget = QueryBudget()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    # Statements issued outside a request (CLI, scheduler) are not counted. Streamed bodies run after
+    # after_request, so their batches are not counted either.
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
@@ -0,0 +1,166 @@
+import os
+import re
+import tempfile
+from sqlalchemy import event
+from applications.database import db
+
+# Query plan regression check.
+# Builds a throwaway app on an empty database, drives every API resource through the test client,
+# records each SQL statement the requests issue and runs EXPLAIN QUERY PLAN on it. A statement whose
+# plan contains a full table scan (a bare `SCAN <table>`, not an index walk) is reported. Run it with `flask --app main check-query-plans`,
+# it exits with status 1 when a plan regressed (for instance after dropping an index).
+# The tour runs in testing mode, so a request going over its SQL statement budget (query_guard.py) fails it too,
+# and so does a request answering another status than the one the tour expects (TourRequestFailed).
+
+# Tables that may be scanned: role only ever holds a handful of rows
+ALLOWED_SCANS = {'role'}
+
+# `SCAN book` or `SCAN role_1` (aliased), but not `SCAN book USING INDEX ...` or virtual tables
+_SCAN = re.compile(r'^SCAN (\w+?)(?:_\d+)?$')
+# Subqueries and CTEs the plan builds itself, reading them back is not a table scan
+_DERIVED = re.compile(r'^(?:MATERIALIZE|CO-ROUTINE) (\w+?)(?:_\d+)?$')
+
+
+class TourRequestFailed(Exception):
+    pass
+
+
+def _expect(response, status):
+    # A request answering another status took another path than the one whose plans are to be checked
+    if response.status_code != status:
+        raise TourRequestFailed('%s %s answered %d, expected %d: %s' % (
+            response.request.method, response.request.full_path.rstrip('?'), response.status_code, status,
+            response.get_data(as_text=True).strip()[:200]))
+    return response
+
+
+def _tour(client):
+    # One call of every resource/method, in an order that leaves something to read, update and delete
+    login = _expect(client.post('/api/v1/login', json={'email':'admin@gmail.com', 'password':'password'}), 200)
+    admin = {'Authentication-Token':login.json['user']['auth_token']}
+
+    section_id = _expect(client.post('/api/v1/section', json={'name':'Fiction', 'description':'Novels'},
+                                     headers=admin), 201).json['section']['section_id']
+    other_section_id = _expect(client.post('/api/v1/section', json={'name':'Science', 'description':'Physics'},
+                                           headers=admin), 201).json['section']['section_id']
+    book = {'title':'Dune', 'content_type':'pdf', 'content':'dune.pdf', 'author':'Herbert',
+            'download_price':5, 'section_id':section_id}
+    book_id = _expect(client.post('/api/v1/book', json=book, headers=admin), 201).json['book']['book_id']
+
+    _expect(client.get('/api/v1/get_all_sections'), 200)
+    _expect(client.get('/api/v1/get_all_sections?limit=1'), 200)
+    _expect(client.get('/api/v1/get_all_sections?stream=1'), 200).get_data()
+    _expect(client.get(f'/api/v1/section/{section_id}'), 200)
+    _expect(client.get(f'/api/v1/{section_id}/books'), 200)
+    _expect(client.get(f'/api/v1/{section_id}/books?limit=1&after=0'), 200)
+    _expect(client.get(f'/api/v1/{section_id}/books?stream=1'), 200).get_data()
+    _expect(client.get(f'/api/v1/book/{book_id}'), 200)
+    _expect(client.get('/api/v1/get_all_sections?include=books,ratings_summary'), 200)
+    _expect(client.get(f'/api/v1/section/{section_id}?include=books,ratings_summary'), 200)
+    _expect(client.get(f'/api/v1/{section_id}/books?include=section,ratings_summary'), 200)
+    _expect(client.get(f'/api/v1/book/{book_id}?include=ratings_summary'), 200)
+    _expect(client.get('/api/v1/search?q=dune&section_id=%d&price_min=1&price_max=10' % section_id), 200)
+    _expect(client.get('/api/v1/search?q=fic&type=sections'), 200)
+    _expect(client.get('/api/v1/books/top'), 200)
+    _expect(client.get(f'/api/v1/books/top?section_id={section_id}&limit=5'), 200)
+    _expect(client.get(f'/api/v1/book/{book_id}/related?limit=5'), 200)
+
+    _expect(client.put(f'/api/v1/book/{book_id}', json=dict(book, title='Dune Messiah', section_id=other_section_id),
+                       headers=admin), 200)
+    _expect(client.put(f'/api/v1/book/{book_id}', json=dict(book, copies=3), headers=admin), 200)
+    _expect(client.put(f'/api/v1/section/{section_id}', json={'name':'Novels'}, headers=admin), 200)
+    _expect(client.patch('/api/v1/books', json={'filter':{'section_id':other_section_id}, 'set':{'price_factor':1.1}},
+                         headers=admin), 200)
+    _expect(client.patch('/api/v1/books', json={'filter':{'ids':[book_id]}, 'set':{'section_id':section_id}},
+                         headers=admin), 200)
+    batch = _expect(client.post('/api/v1/batch', headers=admin, json={'operations':[
+        {'method':'POST', 'path':'/section', 'body':{'name':'Poetry', 'description':'Verse'}},
+        {'method':'POST', 'path':'/book', 'body':dict(book, section_id='$0.section.section_id')},
+        {'method':'GET', 'path':'/book/$1.book.book_id'},
+    ], 'mode':'independent'}), 200)
+    if [result['status'] for result in batch.json['results']] != [201, 201, 200]:
+        raise TourRequestFailed('Batch operations answered %s, expected [201, 201, 200]' % (
+            [result['status'] for result in batch.json['results']]))
+    _expect(client.get('/api/v1/admin/stats', headers=admin), 200)
+    _expect(client.get(f'/api/v1/admin/stats?grain=hour&from=2024-01-01&to=2024-01-02&section_id={section_id}'
+                       '&by_section=1', headers=admin), 200)
+    _expect(client.get('/api/v1/auth/cache_stats', headers=admin), 200)
+    _expect(client.get('/api/v1/metrics', headers=admin), 200)
+    _expect(client.delete(f'/api/v1/book/{book_id}', headers=admin), 200)
+    _expect(client.delete(f'/api/v1/section/{section_id}', headers=admin), 200)
+
+    # The reader only reads a book they neither own nor borrowed
+    book_id = _expect(client.post('/api/v1/book', json=dict(book, section_id=other_section_id), headers=admin),
+                      201).json['book']['book_id']
+    _expect(client.post('/api/v1/register', json={'email':'reader@example.com', 'password':'password123',
+                                                  'username':'reader', 'role':'user'}), 200)
+    login = _expect(client.post('/api/v1/login', json={'email':'reader@example.com', 'password':'password123'}), 200)
+    reader = {'Authentication-Token':login.json['user']['auth_token']}
+    _expect(client.get(f'/api/v1/book/{book_id}/content', headers=reader), 403)
+    _expect(client.post(f'/api/v1/book/{book_id}/borrow', headers=reader), 201)
+    _expect(client.post(f'/api/v1/book/{book_id}/borrow', headers=reader), 409) # already borrowed
+    _expect(client.get(f'/api/v1/book/{book_id}/content', headers=reader), 200).close()
+    _expect(client.post(f'/api/v1/book/{book_id}/return', headers=reader), 200)
+    _expect(client.get('/api/v1/recommendations', headers=reader), 200)
+    _expect(client.post('/api/v1/logout', headers=reader), 200)
+
+
+def collect_statements(create_app, config, folder):
+    # Returns {sql: parameters} for every distinct statement issued by the tour, on a database in folder
+    uri = 'sqlite:///' + os.path.join(folder, 'query_plans.sqlite3')
+    content_root = os.path.join(folder, 'content')
+    os.makedirs(content_root)
+    with open(os.path.join(content_root, 'dune.pdf'), 'wb') as f: # the book file the borrower reads
+        f.write(b'%PDF-1.4\n')
+
+    class QueryPlanConfig(config):
+        TESTING = True
+        SQLALCHEMY_DATABASE_URI = uri
+        SQLALCHEMY_BINDS = {key:uri for key in config.SQLALCHEMY_BINDS} # a read engine reads the same file
+        CACHE_BACKEND = 'null' # every read must reach the database
+        PRINCIPAL_CACHE_TTL = 0
+        PASSWORD_POOL_WORKERS = 0
+        SCHEDULER_ENABLED = False
+        QUERY_BUDGET_STRICT = True
+        CONTENT_ROOT = content_root
+
+    from applications.commands import init_db, seed
+    app = create_app(QueryPlanConfig)
+    init_db(app)
+    seed(app)
+    statements = {}
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.setdefault(statement, parameters)
+
+    with app.app_context():
+        engines = list(db.engines.values())
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', record)
+        try:
+            _tour(app.test_client(use_cookies=False))
+        finally:
+            for engine in engines:
+                event.remove(engine, 'before_cursor_execute', record)
+    return app, statements
+
+
+def check_query_plans(create_app, config):
+    # Returns a list of (sql, plan) for the statements that scan a table. The database is deleted afterwards.
+    with tempfile.TemporaryDirectory(prefix='query_plans.') as folder:
+        app, statements = collect_statements(create_app, config, folder)
+        violations = []
+        with app.app_context():
+            with db.engine.connect() as conn:
+                for sql, parameters in statements.items():
+                    if not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')):
+                        continue
+                    plan = [row[-1] for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql, parameters)]
+                    derived = {name for line in plan for name in _DERIVED.findall(line.strip())}
+                    scans = {table for line in plan for table in _SCAN.findall(line.strip())} - derived - ALLOWED_SCANS
+                    if scans:
+                        violations.append((sql, plan))
+            for engine in db.engines.values():
+                engine.dispose()
+    return violations, len(statements)
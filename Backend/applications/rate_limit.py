@@ -0,0 +1,184 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from flask import g, request, current_app, make_response, jsonify
+from flask_security.utils import parse_auth_token
+
+# Token bucket rate limits, configured per endpoint in RATE_LIMITS as {scope: (requests, seconds)}.
+# A bucket holds up to `requests` tokens and refills at requests/seconds per second; each request takes
+# one token from every bucket of its endpoint and is answered 429 with Retry-After when one is empty.
+# Scopes: 'ip' (request.remote_addr, put the app behind werkzeug's ProxyFix when a proxy terminates the
+# connections), 'user' (the uid of a validly signed auth token, read without a database lookup) and
+# 'account' (the email posted to Login/Register). A request without the identity of a scope skips it.
+# Every limited response carries RateLimit-Limit/Remaining/Reset and RateLimit-Policy of its tightest
+# bucket.
+#
+# The buckets live in a fixed table of RATE_LIMIT_SLOTS slots in a file every worker maps (RATE_LIMIT_STORE,
+# relative to the instance folder), so the gunicorn workers of a host share one budget without a round trip
+# to the database or another server. Without a store the table is an unlinked temporary file, shared only
+# with the processes forked after create_app() (gunicorn --preload).
+# A key hashes to one stripe of the table and one of PROBES slots in it; the stripe is locked with an fcntl
+# byte-range lock (between processes) and a threading lock (between the threads of a worker, fcntl locks
+# are per process). When all PROBES slots hold other keys, the least recently used one is taken over and
+# its key starts again from a full bucket.
+
+SLOT = struct.Struct('<Qdd') # key hash (0 = free), tokens, last update (unix time)
+STRIPES = 256
+PROBES = 8
+
+
+class BucketStore:
+    def __init__(self, path=None, slots=65536):
+        self.per_stripe = max(slots // STRIPES, PROBES)
+        self.stripe_size = self.per_stripe * SLOT.size
+        size = self.stripe_size * STRIPES
+        if path is None:
+            self.fd, path = tempfile.mkstemp(prefix='rate_limit.', suffix='.buckets')
+            os.unlink(path)
+        else:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size != size: # new file, or the table was resized: start empty
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        self.map = mmap.mmap(self.fd, size)
+        self.locks = [threading.Lock() for _ in range(STRIPES)]
+
+    def take(self, key, capacity, rate, now):
+        # Takes a token from the bucket of `key` if it has one. Returns (taken, tokens left).
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+        stripe = digest % STRIPES
+        start = stripe * self.stripe_size
+        first = (digest // STRIPES) % self.per_stripe
+        with self.locks[stripe]:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, self.stripe_size, start)
+            try:
+                found = free = oldest = None
+                oldest_update = math.inf
+                for probe in range(PROBES):
+                    offset = start + (first + probe) % self.per_stripe * SLOT.size
+                    slot_key, tokens, updated = SLOT.unpack_from(self.map, offset)
+                    if slot_key == digest:
+                        found = offset
+                        break
+                    if slot_key == 0:
+                        if free is None:
+                            free = offset
+                    elif updated < oldest_update:
+                        oldest, oldest_update = offset, updated
+
+                if found is None:
+                    found = free if free is not None else oldest
+                    tokens = capacity
+                else:
+                    tokens = min(capacity, tokens + max(now - updated, 0) * rate)
+                taken = tokens >= 1
+                if taken:
+                    tokens -= 1
+                SLOT.pack_into(self.map, found, digest, tokens, now)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, self.stripe_size, start)
+        return taken, tokens
+
+    def clear(self):
+        for stripe in range(STRIPES):
+            with self.locks[stripe]:
+                start = stripe * self.stripe_size
+                fcntl.lockf(self.fd, fcntl.LOCK_EX, self.stripe_size, start)
+                self.map[start:start + self.stripe_size] = bytes(self.stripe_size)
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, self.stripe_size, start)
+
+
+def _client_ip():
+    return request.remote_addr
+
+
+def _token_user():
+    header = current_app.config.get('SECURITY_TOKEN_AUTHENTICATION_HEADER', 'Authentication-Token')
+    token = request.headers.get(header)
+    if not token:
+        return None
+    try:
+        return parse_auth_token(token)['uid']
+    except Exception: # unsigned, expired or malformed: the request is anonymous
+        return None
+
+
+def _account():
+    data = request.get_json(silent=True)
+    email = data.get('email') if isinstance(data, dict) else None
+    return email.strip().lower() if isinstance(email, str) and email.strip() else None
+
+
+SCOPES = {'ip':_client_ip, 'user':_token_user, 'account':_account}
+
+
+class RateLimiter:
+    def __init__(self):
+        self.enabled = False
+        self.limits = {} # endpoint -> [(scope, capacity, refill per second, seconds)]
+        self.store = None
+
+    def init_app(self, app):
+        self.enabled = app.config.get('RATE_LIMIT_ENABLED', True)
+        self.limits = {}
+        for endpoint, scopes in (app.config.get('RATE_LIMITS') or {}).items():
+            for scope in scopes:
+                if scope not in SCOPES:
+                    raise ValueError(f'Unknown rate limit scope {scope} for {endpoint}')
+            self.limits[endpoint] = [(scope, requests, requests / seconds, seconds)
+                                     for scope, (requests, seconds) in scopes.items()]
+        if not self.enabled or not self.limits:
+            return
+        path = app.config.get('RATE_LIMIT_STORE')
+        if path:
+            path = os.path.join(app.instance_path, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.store = BucketStore(path, app.config.get('RATE_LIMIT_SLOTS', 65536))
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def _before_request(self):
+        limits = self.limits.get(request.endpoint)
+        if not limits:
+            return None
+        now = time.time()
+        tightest = order = None # bucket reported: the one refusing the longest, else the emptiest
+        for scope, capacity, rate, seconds in limits:
+            who = SCOPES[scope]()
+            if who is None:
+                continue
+            taken, tokens = self.store.take(f'{request.endpoint}:{scope}:{who}', capacity, rate, now)
+            rank = (taken, tokens / capacity if taken else (tokens - 1) / rate)
+            if order is None or rank < order:
+                tightest, order = (taken, tokens, capacity, rate, seconds), rank
+        g.rate_limit = tightest
+        if tightest is None or tightest[0]:
+            return None
+        wait = math.ceil((1 - tightest[1]) / tightest[3])
+        response = make_response(jsonify({'message':f'Too many requests, try again in {wait} seconds'}),429)
+        response.headers['Retry-After'] = str(wait)
+        return response
+
+    def _after_request(self, response):
+        state = g.get('rate_limit')
+        if state is None:
+            return response
+        taken, tokens, capacity, rate, seconds = state
+        response.headers['RateLimit-Limit'] = str(capacity)
+        response.headers['RateLimit-Remaining'] = str(int(tokens))
+        response.headers['RateLimit-Reset'] = str(math.ceil((capacity - tokens) / rate))
+        response.headers['RateLimit-Policy'] = f'{capacity};w={seconds:g}'
+        return response
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,143 @@
+from sqlalchemy import event, inspect, text, and_, func, select, update
+from sqlalchemy.orm import Session
+from applications.model import Book, Rating, Section
+from applications.cache import evict_on_commit, ALL_SECTIONS_KEY, section_key, section_books_key, book_key
+
+# Denormalized rating aggregates.
+# book.rating_count/rating_sum and section.rating_count/rating_sum are kept up to date in the same
+# transaction as the Rating rows (see the after_flush hook at the bottom), so nothing ever averages
+# Book.ratings on the fly. book.rating_score holds the Bayesian average
+#     (PRIOR_WEIGHT * PRIOR_MEAN + rating_sum) / (PRIOR_WEIGHT + rating_count)
+# and is indexed (alone and with section_id), so the top-N of a section is an index range scan.
+# Writes that bypass the ORM (raw/bulk SQL) must call apply_delta()/move_book()/move_books() themselves
+# or run backfill().
+
+
+class RatingAggregates:
+    def __init__(self):
+        self.prior_mean = 3.0
+        self.prior_weight = 5
+
+    def init_app(self, app):
+        self.prior_mean = app.config.get('RATING_PRIOR_MEAN', self.prior_mean)
+        self.prior_weight = app.config.get('RATING_PRIOR_WEIGHT', self.prior_weight)
+
+    def _params(self, **params):
+        params.update(prior=self.prior_weight * self.prior_mean, weight=self.prior_weight)
+        return params
+
+    def apply_delta(self, conn, book_id, count, total):
+        # Adds `count` ratings worth `total` to a book and its section
+        conn.execute(text("""
+            UPDATE book SET rating_count = rating_count + :count,
+                            rating_sum = rating_sum + :total,
+                            rating_score = (:prior + rating_sum + :total) / (:weight + rating_count + :count)
+            WHERE id = :book_id
+        """), self._params(book_id=book_id, count=count, total=total))
+        conn.execute(text("""
+            UPDATE section SET rating_count = rating_count + :count, rating_sum = rating_sum + :total
+            WHERE id = (SELECT section_id FROM book WHERE id = :book_id)
+        """), {'book_id':book_id, 'count':count, 'total':total})
+
+    def move_book(self, conn, count, total, old_section_id, new_section_id):
+        # Moves a book's totals from one section to another
+        conn.execute(text("""
+            UPDATE section SET rating_count = rating_count - :count, rating_sum = rating_sum - :total WHERE id = :old
+        """), {'count':count, 'total':total, 'old':old_section_id})
+        conn.execute(text("""
+            UPDATE section SET rating_count = rating_count + :count, rating_sum = rating_sum + :total WHERE id = :new
+        """), {'count':count, 'total':total, 'new':new_section_id})
+
+    def move_books(self, conn, condition, new_section_id):
+        # move_book() for every book matching `condition` (a where clause on Book) in two statements,
+        # whatever sections they come from. Run it before the UPDATE that moves the books.
+        moved = and_(condition, Book.section_id != new_section_id)
+
+        def moved_total(column, *where):
+            return select(func.coalesce(func.sum(column), 0)).where(moved, *where).scalar_subquery()
+
+        conn.execute(update(Section).where(Section.id.in_(select(Book.section_id).where(moved))).values(
+            rating_count=Section.rating_count - moved_total(Book.rating_count, Book.section_id == Section.id),
+            rating_sum=Section.rating_sum - moved_total(Book.rating_sum, Book.section_id == Section.id),
+        ))
+        conn.execute(update(Section).where(Section.id == new_section_id).values(
+            rating_count=Section.rating_count + moved_total(Book.rating_count),
+            rating_sum=Section.rating_sum + moved_total(Book.rating_sum),
+        ))
+
+    def backfill(self, conn):
+        # Recomputes every aggregate from the rating table (also needed after changing the prior)
+        conn.execute(text("""
+            UPDATE book SET
+                rating_count = (SELECT count(*) FROM rating WHERE rating.book_id = book.id),
+                rating_sum = (SELECT coalesce(sum(rating), 0) FROM rating WHERE rating.book_id = book.id)
+        """))
+        conn.execute(text("""
+            UPDATE book SET rating_score = (:prior + rating_sum) / (:weight + rating_count)
+        """), self._params())
+        conn.execute(text("""
+            UPDATE section SET
+                rating_count = (SELECT coalesce(sum(rating_count), 0) FROM book WHERE book.section_id = section.id),
+                rating_sum = (SELECT coalesce(sum(rating_sum), 0) FROM book WHERE book.section_id = section.id)
+        """))
+
+
+rating_aggregates = RatingAggregates()
+
+
+def _previous(state, attr):
+    history = state.attrs[attr].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(state.object, attr)
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_aggregates(session, flush_context):
+    deltas = {}
+
+    def add(book_id, count, total):
+        current = deltas.get(book_id, (0, 0.0))
+        deltas[book_id] = (current[0] + count, current[1] + total)
+
+    for obj in session.new:
+        if isinstance(obj, Rating):
+            add(obj.book_id, 1, obj.rating)
+    for obj in session.deleted:
+        if isinstance(obj, Rating):
+            state = inspect(obj)
+            add(_previous(state, 'book_id'), -1, -_previous(state, 'rating'))
+    for obj in session.dirty:
+        if isinstance(obj, Rating):
+            state = inspect(obj)
+            if state.attrs.rating.history.has_changes() or state.attrs.book_id.history.has_changes():
+                add(_previous(state, 'book_id'), -1, -_previous(state, 'rating'))
+                add(obj.book_id, 1, obj.rating)
+
+    moves = []
+    for obj in session.dirty:
+        if isinstance(obj, Book) and inspect(obj).attrs.section_id.history.has_changes():
+            moves.append((obj, _previous(inspect(obj), 'section_id'), obj.section_id))
+    for obj in session.deleted:
+        if isinstance(obj, Book):
+            moves.append((obj, _previous(inspect(obj), 'section_id'), None))
+
+    if not deltas and not moves:
+        return
+
+    conn = session.connection()
+    for book_id, (count, total) in deltas.items():
+        if count or total:
+            rating_aggregates.apply_delta(conn, book_id, count, total)
+            # ratings_summary is part of the cached book and section responses
+            section_id = conn.execute(text('SELECT section_id FROM book WHERE id = :id'), {'id':book_id}).scalar()
+            evict_on_commit(session, book_key(book_id), section_key(section_id), section_books_key(section_id),
+                            ALL_SECTIONS_KEY)
+    for book, old_section_id, new_section_id in moves:
+        # Read the totals back unless the row is gone, the deltas above may have changed them
+        totals = conn.execute(text('SELECT rating_count, rating_sum FROM book WHERE id = :id'), {'id':book.id}).first()
+        if totals is None:
+            loaded = inspect(book).dict
+            totals = (loaded.get('rating_count') or 0, loaded.get('rating_sum') or 0.0)
+        if totals[0]:
+            rating_aggregates.move_book(conn, totals[0], totals[1], old_section_id, new_section_id)
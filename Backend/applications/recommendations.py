@@ -0,0 +1,145 @@
+from sqlalchemy import event, text, select, union_all, func, exists
+from sqlalchemy.orm import Session
+from applications.model import Book, UserRequest, borrow_history, book_cooccurrence
+from applications.marshal_fields import book_schema
+
+# "Also borrowed" recommendations from loan co-occurrence.
+# borrow_history keeps each (user, book) pair of user_request and user_book once, numbered per user in the
+# order it first appeared. book_cooccurrence counts, for every ordered pair of books, the users who borrowed
+# both within WINDOW books of each other: a new borrow is only paired with the borrower's WINDOW previous
+# books, so recording it costs at most 2 * WINDOW upserts however long the loan history grows, and a reader
+# of thousands of books does not relate everything to everything.
+# The counts are indexed by (book_id, borrowers, related_id): the top-K of a book is a K-row index walk, and
+# the recommendations of a user merge the top-K of their SEED_BOOKS most recent books in one statement.
+# New UserRequest rows are recorded in the same transaction by the after_flush hook at the bottom. Writes
+# that bypass the ORM (raw/bulk SQL, user_book inserts) must call record_borrows() themselves or run rebuild().
+
+
+class CoOccurrenceIndex:
+    def __init__(self):
+        self.window = 20
+        self.limit = 10
+        self.seed_books = 10
+
+    def init_app(self, app):
+        self.window = app.config.get('RECOMMENDATIONS_WINDOW', self.window)
+        self.limit = app.config.get('RECOMMENDATIONS_LIMIT', self.limit)
+        self.seed_books = app.config.get('RECOMMENDATIONS_SEED_BOOKS', self.seed_books)
+
+    def record_borrows(self, conn, borrows):
+        # Adds (username, book_id) pairs to the index, pairs it already holds are skipped.
+        # Returns the number of new pairs.
+        recorded = 0
+        for username, book_id in dict.fromkeys(borrows):
+            position = conn.execute(text("""
+                INSERT INTO borrow_history (username, book_id, position)
+                SELECT :username, :book_id, coalesce(max(position), 0) + 1 FROM borrow_history WHERE username = :username
+                ON CONFLICT DO NOTHING
+                RETURNING position
+            """), {'username':username, 'book_id':book_id}).scalar()
+            if position is None:
+                continue
+            conn.execute(text("""
+                WITH previous AS (
+                    SELECT book_id FROM borrow_history
+                    WHERE username = :username AND position >= :position - :window AND position < :position
+                )
+                INSERT INTO book_cooccurrence (book_id, related_id, borrowers)
+                SELECT :book_id, book_id, 1 FROM previous
+                UNION ALL
+                SELECT book_id, :book_id, 1 FROM previous WHERE true
+                ON CONFLICT (book_id, related_id) DO UPDATE SET borrowers = borrowers + 1
+            """), {'username':username, 'book_id':book_id, 'position':position, 'window':self.window})
+            recorded += 1
+        return recorded
+
+    def related_ids(self, book_id, limit):
+        # Select of the (related_id, borrowers) top of a book
+        return (select(book_cooccurrence.c.related_id, book_cooccurrence.c.borrowers)
+                .where(book_cooccurrence.c.book_id == book_id)
+                .order_by(book_cooccurrence.c.borrowers.desc(), book_cooccurrence.c.related_id.desc())
+                .limit(limit))
+
+    def related(self, book_id, limit=None):
+        # Select of the books most often borrowed with book_id, with their `borrowers` count
+        return (select(*book_schema.columns, book_cooccurrence.c.borrowers)
+                .join(Book, Book.id == book_cooccurrence.c.related_id)
+                .where(book_cooccurrence.c.book_id == book_id)
+                .order_by(book_cooccurrence.c.borrowers.desc(), book_cooccurrence.c.related_id.desc())
+                .limit(limit or self.limit))
+
+    def recommended(self, username, seeds, limit=None):
+        # Select of the books most often borrowed with the `seeds` book ids, leaving out the ones the
+        # user already has, with their `score` (borrowers summed over the seeds)
+        limit = limit or self.limit
+        # each seed brings twice the answer size, room for the books the user already has
+        tops = [self.related_ids(seed, limit * 2).subquery(f'top_{n}') for n, seed in enumerate(seeds)]
+        candidates = union_all(*[select(top.c.related_id, top.c.borrowers) for top in tops]).subquery('candidates')
+        score = func.sum(candidates.c.borrowers).label('score')
+        owned = exists().where(borrow_history.c.username == username,
+                               borrow_history.c.book_id == candidates.c.related_id)
+        scores = (select(candidates.c.related_id, score).where(~owned)
+                  .group_by(candidates.c.related_id).subquery('scores'))
+        return (select(*book_schema.columns, scores.c.score)
+                .join(Book, Book.id == scores.c.related_id)
+                .order_by(scores.c.score.desc(), scores.c.related_id.desc())
+                .limit(limit))
+
+    def seeds(self, username):
+        # Select of the user's most recent book ids
+        return (select(borrow_history.c.book_id).where(borrow_history.c.username == username)
+                .order_by(borrow_history.c.position.desc()).limit(self.seed_books))
+
+    def rebuild(self, conn):
+        # Recomputes the whole index from user_request and user_book (also needed after changing the window).
+        # Returns the number of (user, book) pairs and of book pairs.
+        conn.execute(text('DELETE FROM book_cooccurrence'))
+        conn.execute(text('DELETE FROM borrow_history'))
+        # Filling the tables without their secondary indexes and building these once at the end is
+        # several times faster than updating them row by row
+        indexes = [index for table in (borrow_history, book_cooccurrence) for index in table.indexes]
+        for index in indexes:
+            index.drop(conn, checkfirst=True)
+        # Loans in the order they were made, then the books only owned
+        conn.execute(text("""
+            INSERT INTO borrow_history (username, book_id, position)
+            SELECT username, book_id, row_number() OVER (
+                PARTITION BY username ORDER BY first IS NULL, first, book_id
+            ) FROM (
+                SELECT username, book_id, min(first) AS first FROM (
+                    SELECT username, book_id, id AS first FROM user_request
+                    UNION ALL
+                    SELECT username, book_id, NULL FROM user_book
+                ) GROUP BY username, book_id
+            )
+        """))
+        conn.execute(text("""
+            INSERT INTO book_cooccurrence (book_id, related_id, borrowers)
+            SELECT book_id, related_id, count(*) FROM (
+                SELECT later.book_id AS book_id, earlier.book_id AS related_id
+                FROM borrow_history AS later JOIN borrow_history AS earlier
+                ON earlier.username = later.username
+                AND earlier.position >= later.position - :window AND earlier.position < later.position
+                UNION ALL
+                SELECT earlier.book_id, later.book_id
+                FROM borrow_history AS later JOIN borrow_history AS earlier
+                ON earlier.username = later.username
+                AND earlier.position >= later.position - :window AND earlier.position < later.position
+            ) GROUP BY book_id, related_id
+        """), {'window':self.window})
+        for index in indexes:
+            index.create(conn)
+        return (conn.execute(text('SELECT count(*) FROM borrow_history')).scalar(),
+                conn.execute(text('SELECT count(*) FROM book_cooccurrence')).scalar())
+
+
+co_occurrence = CoOccurrenceIndex()
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_new_loans(session, flush_context):
+    # In id order, the order rebuild() numbers them in
+    loans = sorted((obj for obj in session.new if isinstance(obj, UserRequest)), key=lambda loan: loan.id)
+    borrows = [(loan.username, loan.book_id) for loan in loans]
+    if borrows:
+        co_occurrence.record_borrows(session.connection(), borrows)
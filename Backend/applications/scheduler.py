@@ -0,0 +1,123 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import text
+from applications.database import db
+
+# Small periodic job runner.
+# Jobs register with @scheduler.job(name, interval) and run one after the other in a daemon thread,
+# each inside an app context. Run it in-process (SCHEDULER_ENABLED, started by autostart() in the serving
+# processes: the gunicorn workers through the post_worker_init hook of gunicorn.conf.py, `python main.py`;
+# never by create_app or in a preloading master) or as a sidecar process with `flask --app main run-scheduler`.
+# autostart() only starts it in the process holding the lock on SCHEDULER_LOCK (in the instance folder),
+# so of several workers one runs the jobs, and the worker replacing it takes over when it dies.
+#
+# Every run is recorded in the job_run table (see JobRun in model.py). A job can checkpoint its progress
+# on its run row, and a run that was interrupted (status 'running') is resumed by the next start.
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    def __init__(self):
+        self.app = None
+        self.jobs = {}
+        self._thread = None
+        self._lock_fd = None
+        self._stop = threading.Event()
+
+    def init_app(self, app):
+        self.app = app
+
+    def autostart(self):
+        # Returns whether this process runs the jobs
+        if not self.app.config.get('SCHEDULER_ENABLED'):
+            return False
+        if self._lock_fd is None:
+            path = os.path.join(self.app.instance_path, self.app.config.get('SCHEDULER_LOCK', 'scheduler.lock'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB) # held until this process exits
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            self._lock_fd = fd
+        self.start()
+        return True
+
+    def job(self, name, interval):
+        # interval is in seconds, config key SCHEDULER_INTERVALS[name] overrides it
+        def decorator(f):
+            self.jobs[name] = (interval, f)
+            return f
+        return decorator
+
+    def run_job(self, name, **kwargs):
+        interval, f = self.jobs[name]
+        with self.app.app_context():
+            return f(**kwargs)
+
+    def run_forever(self):
+        intervals = self.app.config.get('SCHEDULER_INTERVALS', {})
+        next_run = {name: 0 for name in self.jobs}
+        while not self._stop.is_set():
+            for name, (interval, f) in self.jobs.items():
+                if time.monotonic() < next_run[name]:
+                    continue
+                try:
+                    self.run_job(name)
+                except Exception:
+                    logger.exception('Scheduled job %s failed', name)
+                next_run[name] = time.monotonic() + intervals.get(name, interval)
+            self._stop.wait(1)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run_forever, name='scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+scheduler = Scheduler()
+
+
+def begin_run(job, cutoff=None):
+    # Returns the run to work on: the interrupted one if any, else a new one. Rows are (id, cutoff, rows).
+    with db.engine.begin() as conn:
+        run = conn.execute(text("""
+            SELECT id, cutoff, rows FROM job_run WHERE job = :job AND status = 'running' ORDER BY id DESC LIMIT 1
+        """), {'job':job}).first()
+        if run is not None:
+            return run
+        run_id = conn.execute(text("""
+            INSERT INTO job_run (job, status, started_at, cutoff, rows, batches, duration_ms)
+            VALUES (:job, 'running', :now, :cutoff, 0, 0, 0)
+        """), {'job':job, 'now':datetime.now(), 'cutoff':cutoff}).lastrowid
+        return (run_id, cutoff, 0)
+
+
+def checkpoint(conn, run_id, rows, last_id, duration_ms):
+    # Records one batch on the run row, in the same transaction as the batch itself
+    conn.execute(text("""
+        UPDATE job_run SET rows = rows + :rows, batches = batches + 1, last_id = :last_id,
+                           duration_ms = duration_ms + :duration_ms
+        WHERE id = :id
+    """), {'id':run_id, 'rows':rows, 'last_id':last_id, 'duration_ms':duration_ms})
+
+
+def finish_run(run_id, status='finished', error=None):
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+            UPDATE job_run SET status = :status, finished_at = :now, error = :error WHERE id = :id
+        """), {'id':run_id, 'status':status, 'now':datetime.now(), 'error':error})
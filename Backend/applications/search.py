@@ -0,0 +1,139 @@
+from sqlalchemy import text, select, update, table, column, bindparam
+from applications.database import db
+from applications.model import Book, Section
+
+# Full text search over the catalog using SQLite FTS5.
+# book_search holds one row per book (rowid = book.id) with the section name/description copied in,
+# so a query for a section name also finds its books. section_search holds one row per section.
+# The write handlers call index_*/unindex_* inside their own transaction, so the index never drifts.
+
+BOOK_COLUMNS = ('title', 'author', 'content_type', 'section_name', 'section_description')
+SECTION_COLUMNS = ('name', 'description')
+
+_book_search = table('book_search', column('rowid'), column('section_name'), column('section_description'))
+
+# bm25 column weights, in the order of the columns above
+BOOK_WEIGHTS = (10.0, 5.0, 1.0, 2.0, 1.0)
+SECTION_WEIGHTS = (10.0, 2.0)
+
+_INDEX_BOOKS = """
+    INSERT INTO book_search (rowid, title, author, content_type, section_name, section_description)
+    SELECT book.id, book.title, book.author, book.content_type, section.name, section.description
+    FROM book LEFT JOIN section ON section.id = book.section_id
+"""
+
+_INDEX_SECTIONS = """
+    INSERT INTO section_search (rowid, name, description)
+    SELECT section.id, section.name, section.description FROM section
+"""
+
+
+def create_search_index():
+    # Creates the FTS tables on first start and fills them from the existing catalog
+    exists = db.session.execute(text(
+        "SELECT count(*) FROM sqlite_master WHERE name IN ('book_search', 'section_search')"
+    )).scalar()
+    if exists == 2:
+        return
+
+    db.session.execute(text(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS book_search USING fts5(%s)' % ', '.join(BOOK_COLUMNS)
+    ))
+    db.session.execute(text(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS section_search USING fts5(%s)' % ', '.join(SECTION_COLUMNS)
+    ))
+    rebuild_search_index()
+    db.session.commit()
+
+
+def rebuild_search_index():
+    db.session.execute(text('DELETE FROM book_search'))
+    db.session.execute(text('DELETE FROM section_search'))
+    db.session.execute(text(_INDEX_BOOKS))
+    db.session.execute(text(_INDEX_SECTIONS))
+
+
+def index_book(book_id):
+    db.session.flush()
+    db.session.execute(text('DELETE FROM book_search WHERE rowid = :id'), {'id': book_id})
+    db.session.execute(text(_INDEX_BOOKS + ' WHERE book.id = :id'), {'id': book_id})
+
+
+def index_books(book_ids):
+    # index_book() for new books, in one statement
+    db.session.execute(text(_INDEX_BOOKS + ' WHERE book.id IN :ids').bindparams(bindparam('ids', expanding=True)),
+                       {'ids': list(book_ids)})
+
+
+def unindex_book(book_id):
+    db.session.execute(text('DELETE FROM book_search WHERE rowid = :id'), {'id': book_id})
+
+
+def index_section(section_id):
+    db.session.flush()
+    db.session.execute(text('DELETE FROM section_search WHERE rowid = :id'), {'id': section_id})
+    db.session.execute(text(_INDEX_SECTIONS + ' WHERE section.id = :id'), {'id': section_id})
+    db.session.execute(text("""
+        UPDATE book_search
+        SET section_name = (SELECT name FROM section WHERE id = :id),
+            section_description = (SELECT description FROM section WHERE id = :id)
+        WHERE rowid IN (SELECT id FROM book WHERE section_id = :id)
+    """), {'id': section_id})
+
+
+def index_sections(section_ids):
+    # index_section() for new sections (they have no books yet), in one statement
+    db.session.execute(text(_INDEX_SECTIONS + ' WHERE section.id IN :ids').bindparams(bindparam('ids', expanding=True)),
+                       {'ids': list(section_ids)})
+
+
+def move_books(condition, section_id):
+    # Books matching `condition` (a where clause on Book) now show section `section_id`. Run it before
+    # the UPDATE that moves them, while `condition` still matches the same books.
+    db.session.execute(update(_book_search).where(_book_search.c.rowid.in_(select(Book.id).where(condition))).values(
+        section_name=select(Section.name).where(Section.id == section_id).scalar_subquery(),
+        section_description=select(Section.description).where(Section.id == section_id).scalar_subquery(),
+    ))
+
+
+def unindex_section(section_id):
+    db.session.execute(text('DELETE FROM section_search WHERE rowid = :id'), {'id': section_id})
+    db.session.execute(text(
+        'DELETE FROM book_search WHERE rowid IN (SELECT id FROM book WHERE section_id = :id)'
+    ), {'id': section_id})
+
+
+def match_expression(query):
+    # Turns free text into an FTS5 query: every word must match, as a prefix, and quotes are escaped
+    terms = ['"%s"*' % term.replace('"', '""') for term in query.split()]
+    return ' '.join(terms)
+
+
+def search_books(query, section_id=None, price_min=None, price_max=None, limit=20, offset=0):
+    # Returns book ids ranked by bm25 (best first)
+    sql = """
+        SELECT book.id FROM book_search JOIN book ON book.id = book_search.rowid
+        WHERE book_search MATCH :query
+    """
+    params = {'query': match_expression(query), 'limit': limit, 'offset': offset}
+    if section_id is not None:
+        sql += ' AND book.section_id = :section_id'
+        params['section_id'] = section_id
+    if price_min is not None:
+        sql += ' AND book.download_price >= :price_min'
+        params['price_min'] = price_min
+    if price_max is not None:
+        sql += ' AND book.download_price <= :price_max'
+        params['price_max'] = price_max
+    sql += ' ORDER BY bm25(book_search, %s) LIMIT :limit OFFSET :offset' % ', '.join(map(str, BOOK_WEIGHTS))
+    return db.session.execute(text(sql), params).scalars().all()
+
+
+def search_sections(query, section_id=None, limit=20, offset=0):
+    sql = 'SELECT rowid FROM section_search WHERE section_search MATCH :query'
+    params = {'query': match_expression(query), 'limit': limit, 'offset': offset}
+    if section_id is not None:
+        sql += ' AND rowid = :section_id'
+        params['section_id'] = section_id
+    sql += ' ORDER BY bm25(section_search, %s) LIMIT :limit OFFSET :offset' % ', '.join(map(str, SECTION_WEIGHTS))
+    return db.session.execute(text(sql), params).scalars().all()
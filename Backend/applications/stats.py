@@ -0,0 +1,199 @@
+from datetime import datetime, timedelta
+from flask import make_response, jsonify, request, current_app
+from flask_restful import Resource
+from flask_security import auth_token_required, roles_required
+from sqlalchemy import event, text, select, func
+from sqlalchemy.orm import Session
+from applications.database import db
+from applications.model import Book, UserRequest, Rating, stats_rollup
+
+# Analytics rollups for the admin dashboard.
+# stats_rollup holds, per grain (hour and day), bucket and section, the loans made, the revenue they imply
+# (the download_price of the loaned books) and the ratings given with their distribution, so the dashboard
+# sums a few rows per bucket instead of grouping user_request and rating on every refresh.
+# Rows are counted once, in id order: stats_watermark keeps the last user_request/rating id already counted.
+# The after_flush hook at the bottom counts new rows in the same transaction as their INSERT, together
+# with the rows written before them without the ORM (up to STATS_INLINE_MAX_ROWS). Anything further behind
+# is left to the rollup_stats job (applications/jobs.py), which catches up in batches.
+# Both move the watermark with a conditional UPDATE first, so a range is never counted twice.
+# Rollups record what happened at write time: later price changes, book moves, deleted loans and deleted
+# sections do not change them. Loans older than migration 6 are bucketed at midnight of their request_date,
+# ratings older than it (they had no date) in the bucket they are rolled up in.
+
+GRAINS = {'hour':'%Y-%m-%dT%H', 'day':'%Y-%m-%d'} # strftime format of the bucket
+STEPS = {'hour':timedelta(hours=1), 'day':timedelta(days=1)}
+COUNTERS = ('loans', 'revenue', 'ratings', 'rating_sum', 'rating_1', 'rating_2', 'rating_3', 'rating_4', 'rating_5')
+
+# source table: statement adding its rows with :first < id <= :last to the :grain rollup
+ROLLUPS = {
+    'user_request':"""
+        INSERT INTO stats_rollup (grain, bucket, section_id, loans, revenue)
+        SELECT :grain, strftime(:format, coalesce(user_request.created_at, user_request.request_date)), book.section_id,
+               count(*), sum(book.download_price)
+        FROM user_request JOIN book ON book.id = user_request.book_id
+        WHERE user_request.id > :first AND user_request.id <= :last
+        GROUP BY 2, 3
+        ON CONFLICT (grain, bucket, section_id) DO UPDATE SET
+            loans = loans + excluded.loans, revenue = revenue + excluded.revenue
+    """,
+    'rating':"""
+        INSERT INTO stats_rollup (grain, bucket, section_id, ratings, rating_sum,
+                                  rating_1, rating_2, rating_3, rating_4, rating_5)
+        SELECT :grain, strftime(:format, coalesce(rating.created_at, datetime('now', 'localtime'))), book.section_id,
+               count(*), sum(rating.rating),
+               sum(rating.rating < 1.5), sum(rating.rating >= 1.5 AND rating.rating < 2.5),
+               sum(rating.rating >= 2.5 AND rating.rating < 3.5), sum(rating.rating >= 3.5 AND rating.rating < 4.5),
+               sum(rating.rating >= 4.5)
+        FROM rating JOIN book ON book.id = rating.book_id
+        WHERE rating.id > :first AND rating.id <= :last
+        GROUP BY 2, 3
+        ON CONFLICT (grain, bucket, section_id) DO UPDATE SET
+            ratings = ratings + excluded.ratings, rating_sum = rating_sum + excluded.rating_sum,
+            rating_1 = rating_1 + excluded.rating_1, rating_2 = rating_2 + excluded.rating_2,
+            rating_3 = rating_3 + excluded.rating_3, rating_4 = rating_4 + excluded.rating_4,
+            rating_5 = rating_5 + excluded.rating_5
+    """,
+}
+SOURCES = {'user_request':UserRequest, 'rating':Rating}
+
+
+def watermark(conn, source):
+    return conn.execute(text('SELECT last_id FROM stats_watermark WHERE source = :source'),
+                        {'source':source}).scalar() or 0
+
+
+def roll_up(conn, source, first, last):
+    # Counts the rows of `source` with first < id <= last if the watermark is still at `first`.
+    # Returns False when another transaction counted them first.
+    claimed = conn.execute(text("""
+        INSERT INTO stats_watermark (source, last_id) VALUES (:source, :last)
+        ON CONFLICT (source) DO UPDATE SET last_id = excluded.last_id WHERE last_id = :first
+    """), {'source':source, 'first':first, 'last':last}).rowcount
+    if not claimed:
+        return False
+    for grain, fmt in GRAINS.items():
+        conn.execute(text(ROLLUPS[source]), {'grain':grain, 'format':fmt, 'first':first, 'last':last})
+    return True
+
+
+def reset(conn):
+    # Drops every rollup, the rollup_stats job then recounts the whole history
+    conn.execute(text('DELETE FROM stats_rollup'))
+    conn.execute(text('DELETE FROM stats_watermark'))
+
+
+def bucket_of(moment, grain):
+    return moment.strftime(GRAINS[grain])
+
+
+def series(grain, start, end, section_id=None, by_section=False):
+    # Select of the counters of every bucket from start to end (datetimes), summed over the sections
+    # unless by_section
+    keys = [stats_rollup.c.bucket] + ([stats_rollup.c.section_id] if by_section else [])
+    query = select(*keys, *[func.sum(stats_rollup.c[name]).label(name) for name in COUNTERS]).where(
+        stats_rollup.c.grain == grain,
+        stats_rollup.c.bucket >= bucket_of(start, grain),
+        stats_rollup.c.bucket <= bucket_of(end, grain),
+    )
+    if section_id is not None:
+        query = query.where(stats_rollup.c.section_id == section_id)
+    return query.group_by(*keys).order_by(*keys)
+
+
+def active_loans(section_id=None):
+    # Loans currently out, counted on ix_user_request_is_active_return_date, or for a section on
+    # ix_user_request_book_id_is_active book by book: the cost follows the loans currently out (the
+    # expire_loans job ends the overdue ones), not the history
+    query = select(func.count()).select_from(UserRequest).where(UserRequest.is_active == True)
+    if section_id is not None:
+        query = query.where(UserRequest.book_id.in_(select(Book.id).where(Book.section_id == section_id)))
+    return query
+
+
+def counters(values):
+    # Response form of a {counter: value} mapping
+    return {
+        'loans':values['loans'],
+        'revenue':round(values['revenue'], 2),
+        'ratings':values['ratings'],
+        'rating_average':round(values['rating_sum'] / values['ratings'], 2) if values['ratings'] else None,
+        'rating_distribution':{str(stars):values[f'rating_{stars}'] for stars in range(1, 6)},
+    }
+
+
+def parse_moment(value):
+    # A date (start of the day) or a datetime, in ISO format
+    return datetime.fromisoformat(value)
+
+
+class AdminStats(Resource):
+    # GET /api/v1/admin/stats?grain=<hour|day>&from=<iso>&to=<iso>&section_id=<id>&by_section=1
+    # Defaults to the last 30 days (day grain) or 48 hours (hour grain), at most STATS_MAX_BUCKETS buckets.
+    @auth_token_required
+    @roles_required('admin')
+    def get(self):
+        grain = request.args.get('grain', 'day')
+        if grain not in GRAINS:
+            return make_response(jsonify({'message':'grain must be %s' % ' or '.join(GRAINS)}),400)
+        try:
+            end = parse_moment(request.args['to']) if 'to' in request.args else datetime.now()
+            start = parse_moment(request.args['from']) if 'from' in request.args else \
+                end - (timedelta(days=29) if grain == 'day' else timedelta(hours=47))
+        except ValueError:
+            return make_response(jsonify({'message':'from and to must be ISO dates or datetimes'}),400)
+        try:
+            section_id = int(request.args['section_id']) if 'section_id' in request.args else None
+        except ValueError:
+            return make_response(jsonify({'message':'section_id must be an integer'}),400)
+
+        limit = current_app.config.get('STATS_MAX_BUCKETS', 1000)
+        if start > end:
+            return make_response(jsonify({'message':'from must not be after to'}),400)
+        if (end - start) // STEPS[grain] + 1 > limit:
+            return make_response(jsonify({'message':f'A range covers at most {limit} {grain} buckets'}),400)
+
+        by_section = request.args.get('by_section') == '1'
+        buckets = []
+        totals = dict.fromkeys(COUNTERS, 0)
+        for row in db.session.execute(series(grain, start, end, section_id, by_section)):
+            bucket = {'bucket':row.bucket}
+            if by_section:
+                bucket['section_id'] = row.section_id
+            bucket.update(counters(row._mapping))
+            buckets.append(bucket)
+            for name in COUNTERS:
+                totals[name] += row._mapping[name]
+
+        response = {
+            'grain':grain,
+            'from':bucket_of(start, grain),
+            'to':bucket_of(end, grain),
+            'section_id':section_id,
+            'active_loans':db.session.execute(active_loans(section_id)).scalar(),
+            'totals':counters(totals),
+            'buckets':buckets,
+        }
+        return make_response(jsonify(response),200)
+
+
+class StatsRollups:
+    def __init__(self):
+        self.inline_max_rows = 1000
+
+    def init_app(self, app):
+        self.inline_max_rows = app.config.get('STATS_INLINE_MAX_ROWS', self.inline_max_rows)
+
+
+stats_rollups = StatsRollups()
+
+
+@event.listens_for(Session, 'after_flush')
+def _roll_up_new_rows(session, flush_context):
+    for source, model in SOURCES.items():
+        ids = [obj.id for obj in session.new if isinstance(obj, model)]
+        if not ids:
+            continue
+        conn = session.connection()
+        first = watermark(conn, source)
+        if first < max(ids) <= first + stats_rollups.inline_max_rows:
+            roll_up(conn, source, first, max(ids))
@@ -1,5 +1,23 @@
 from flask_security import Security, SQLAlchemySessionUserDatastore, hash_password
 from applications.model import User, Role
 from applications.database import db
+from applications.principal_cache import principal_cache
 
-user_datastore = SQLAlchemySessionUserDatastore(db.session, User, Role)
\ No newline at end of file
+
+class CachedUserDatastore(SQLAlchemySessionUserDatastore):
+    # Auth token lookups are served from the principal cache (see applications/principal_cache.py),
+    # every other lookup goes to the database as before.
+    def find_user(self, case_insensitive=False, **kwargs):
+        if list(kwargs) != ['fs_token_uniquifier']:
+            return super().find_user(case_insensitive, **kwargs)
+
+        principal = principal_cache.get(kwargs['fs_token_uniquifier'])
+        if principal is None:
+            user = super().find_user(case_insensitive, **kwargs)
+            if not user:
+                return None
+            principal = principal_cache.put(user)
+        return principal
+
+
+user_datastore = CachedUserDatastore(db.session, User, Role)
\ No newline at end of file
@@ -0,0 +1,2 @@
+# Benchmarks for the library backend. Run them from the Backend folder, e.g.
+#   python -m benchmarks.bench_password_hashing
@@ -0,0 +1,78 @@
+import argparse
+import json
+import time
+from applications.config import TestingConfig
+
+# One /api/v1/batch request against the sequential calls the admin UI makes (applications/batch.py).
+# For --books books: create a section, add the books to it, then update every book, either as
+# 2 * --books + 1 requests or as one batch. Best of --repeat runs, through the test client (in process,
+# so the difference is the per-request auth, dispatch and commit, without any network round trip).
+#
+#   python -m benchmarks.bench_batch --books 50
+
+
+def operations(n, run, books):
+    book = {'content_type':'pdf', 'content':'batch.pdf', 'author':'Batch', 'download_price':1}
+    ops = [{'method':'POST', 'path':'/section', 'body':{'name':f'Batch {run}-{n}', 'description':'Benchmark'}}]
+    ops += [{'method':'POST', 'path':'/book', 'body':dict(book, title=f'Book {i}', section_id='$0.section.section_id')}
+            for i in range(books)]
+    ops += [{'method':'PUT', 'path':'/book/%s', 'ref':1 + i, 'body':dict(book, title=f'Book {i} v2',
+                                                                        section_id='$0.section.section_id')}
+            for i in range(books)]
+    return ops
+
+
+def sequential(client, admin, ops):
+    results = []
+    for op in ops:
+        body = op['body']
+        if isinstance(body.get('section_id'), str):
+            body = dict(body, section_id=results[0]['section']['section_id'])
+        path = op['path'] % results[op['ref']]['book']['book_id'] if 'ref' in op else op['path']
+        response = client.open('/api/v1' + path, method=op['method'], json=body, headers=admin)
+        assert response.status_code < 400, response.json
+        results.append(response.json)
+
+
+def batched(client, admin, ops):
+    ops = [dict({key:value for key, value in op.items() if key != 'ref'},
+                path=op['path'] % ('$%d.book.book_id' % op['ref']) if 'ref' in op else op['path'])
+           for op in ops]
+    response = client.post('/api/v1/batch', json={'operations':ops}, headers=admin)
+    assert response.status_code == 200, response.json
+
+
+def run(books, repeat):
+    from main import create_app
+    from applications.commands import init_db, seed
+
+    class BatchConfig(TestingConfig):
+        QUERY_BUDGET_STRICT = False
+        BATCH_MAX_OPERATIONS = 2 * books + 1
+
+    app = create_app(BatchConfig)
+    init_db(app)
+    seed(app)
+    client = app.test_client(use_cookies=False)
+    admin = {'Authentication-Token':client.post('/api/v1/login', json={
+        'email':'admin@gmail.com', 'password':'password'}).json['user']['auth_token']}
+
+    results = {'books':books, 'operations':2 * books + 1}
+    for name, fn in (('sequential', sequential), ('batch', batched)):
+        timings = []
+        for n in range(repeat):
+            ops = operations(n, name, books)
+            started = time.perf_counter()
+            fn(client, admin, ops)
+            timings.append(time.perf_counter() - started)
+        results[f'{name}_ms'] = round(min(timings) * 1000, 1)
+    results['speedup'] = round(results['sequential_ms'] / results['batch_ms'], 2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run(args.books, args.repeat), indent=2))
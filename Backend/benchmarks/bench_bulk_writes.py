@@ -0,0 +1,70 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from applications.config import TestingConfig
+from benchmarks import dataset
+
+# Set-based writes on a large section (applications/library_management_api.py).
+# Generates one section holding --books books (with --books ratings and loans), then times through the
+# API, with the number of SQL statements each request issued:
+#   reprice:  PATCH /api/v1/books {"filter": {"section_id": 1}, "set": {"price_factor": 1.1}}
+#   move:     PATCH /api/v1/books moving every book to a second section and back
+#   delete:   DELETE /api/v1/section/<id>, the books, ratings, loans and owners go by ON DELETE CASCADE
+# and, for comparison, the same reprice done the ORM way (load every Book, set the price, commit).
+#
+#   python -m benchmarks.bench_bulk_writes --books 50000
+
+
+def timed(fn):
+    started = time.perf_counter()
+    response = fn()
+    assert response.status_code == 200, response.json
+    return {'ms':round((time.perf_counter() - started) * 1000, 1), 'statements':int(response.headers['X-Query-Count'])}
+
+
+def run(books):
+    from main import create_app
+    from applications.commands import init_db, seed
+    from applications.database import db
+    from applications.model import Book
+
+    class BulkConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bulk.sqlite3')
+        QUERY_BUDGET_STRICT = False
+
+    app = create_app(BulkConfig)
+    init_db(app)
+    seed(app)
+    dataset.generate(app, sections=1, books=books, users=1000, ratings=books, requests=books)
+
+    client = app.test_client(use_cookies=False)
+    admin = {'Authentication-Token':client.post('/api/v1/login', json={
+        'email':'admin@gmail.com', 'password':'password'}).json['user']['auth_token']}
+    other = client.post('/api/v1/section', json={'name':'Other', 'description':'Bulk move target'},
+                        headers=admin).json['section']['section_id']
+
+    results = {'books':books}
+    with app.app_context():
+        started = time.perf_counter()
+        for book in db.session.query(Book).filter_by(section_id=1):
+            book.download_price = round(book.download_price * 1.1, 2)
+        db.session.commit()
+        results['orm_reprice'] = {'ms':round((time.perf_counter() - started) * 1000, 1)}
+
+    results['reprice'] = timed(lambda: client.patch('/api/v1/books', headers=admin, json={
+        'filter':{'section_id':1}, 'set':{'price_factor':1.1}}))
+    results['move'] = timed(lambda: client.patch('/api/v1/books', headers=admin, json={
+        'filter':{'section_id':1}, 'set':{'section_id':other}}))
+    timed(lambda: client.patch('/api/v1/books', headers=admin, json={
+        'filter':{'section_id':other}, 'set':{'section_id':1}}))
+    results['delete'] = timed(lambda: client.delete('/api/v1/section/1', headers=admin))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=50000)
+    args = parser.parse_args()
+    print(json.dumps(run(args.books), indent=2))
@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+from applications.config import TestingConfig
+
+# Bulk catalog import/export (applications/catalog_io.py) against the one-book-per-request API.
+# Writes --books books (over --sections sections) as NDJSON and CSV files, then times on empty databases:
+#   post_book:   POST /api/v1/book for the first --post-sample books, reported as books/s
+#   import:      POST /api/v1/admin/import/books with the file streamed as the body, per format
+#   export:      GET /api/v1/admin/export/books, read as a stream, per format
+# with the peak RSS of the process after each step (the file is never held in memory whole).
+#
+#   python -m benchmarks.bench_catalog_io --books 100000
+
+
+def peak_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def write_files(folder, books, sections):
+    import csv
+    rows = [{'id':i, 'title':f'Book {i}', 'content_type':'pdf', 'content':f'book-{i}.pdf', 'author':f'Author {i % 997}',
+             'download_price':round(i % 5000 / 100, 2), 'section_id':1 + i % sections} for i in range(1, books + 1)]
+    paths = {'ndjson':os.path.join(folder, 'books.ndjson'), 'csv':os.path.join(folder, 'books.csv')}
+    with open(paths['ndjson'], 'w') as f:
+        for row in rows:
+            f.write(json.dumps(row) + '\n')
+    with open(paths['csv'], 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    return paths, rows
+
+
+def fresh_app(folder, name, sections):
+    from main import create_app
+    from applications.commands import init_db, seed
+
+    class CatalogConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(folder, name + '.sqlite3')
+        QUERY_BUDGET_STRICT = False
+        METRICS_ENABLED = False
+
+    app = create_app(CatalogConfig)
+    init_db(app)
+    seed(app)
+    client = app.test_client(use_cookies=False)
+    admin = {'Authentication-Token':client.post('/api/v1/login', json={
+        'email':'admin@gmail.com', 'password':'password'}).json['user']['auth_token']}
+    body = ''.join(json.dumps({'id':i, 'name':f'Section {i}', 'description':'Benchmark section'}) + '\n'
+                   for i in range(1, sections + 1))
+    client.post('/api/v1/admin/import/sections', data=body, headers=admin)
+    return client, admin
+
+
+def run(books, sections, post_sample):
+    folder = tempfile.mkdtemp()
+    paths, rows = write_files(folder, books, sections)
+    results = {'books':books, 'sections':sections}
+
+    client, admin = fresh_app(folder, 'post', sections)
+    started = time.perf_counter()
+    for row in rows[:post_sample]:
+        row = {key:value for key, value in row.items() if key != 'id'}
+        assert client.post('/api/v1/book', json=row, headers=admin).status_code == 201
+    results['post_book'] = {'books_per_sec':round(post_sample / (time.perf_counter() - started))}
+
+    for fmt, path in paths.items():
+        client, admin = fresh_app(folder, fmt, sections)
+        started = time.perf_counter()
+        with open(path, 'rb') as f:
+            report = client.post(f'/api/v1/admin/import/books?format={fmt}', data=f, headers=admin).json
+        seconds = time.perf_counter() - started
+        assert report['inserted'] == books, report
+        results[f'import_{fmt}'] = {'seconds':round(seconds, 2), 'books_per_sec':round(books / seconds),
+                                    'chunks':report['chunks'], 'peak_rss_mb':peak_rss_mb()}
+
+        started = time.perf_counter()
+        response = client.get(f'/api/v1/admin/export/books?format={fmt}', headers=admin, buffered=False)
+        size = sum(len(piece) for piece in response.response)
+        seconds = time.perf_counter() - started
+        results[f'export_{fmt}'] = {'seconds':round(seconds, 2), 'books_per_sec':round(books / seconds),
+                                    'mb':round(size / 1024 / 1024, 1), 'peak_rss_mb':peak_rss_mb()}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--sections', type=int, default=100)
+    parser.add_argument('--post-sample', type=int, default=500, help='books loaded one request each')
+    args = parser.parse_args()
+    print(json.dumps(run(args.books, args.sections, args.post_sample), indent=2))
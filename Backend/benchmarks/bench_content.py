@@ -0,0 +1,148 @@
+import argparse
+import http.client
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+from applications.config import TestingConfig
+
+# Throughput and memory of GET /api/v1/book/<id>/content (applications/library_management_api.py).
+# Writes a --size-mb file under a temporary CONTENT_ROOT, serves the app from a threaded werkzeug server
+# and downloads it from --concurrency threads, --downloads times in full and --downloads times as 1 MB
+# ranges (206). Reports MB/s, p50/p95 latency and the peak RSS of the process before and after: the file
+# is streamed in blocks, so the peak stays flat whatever the file size and the concurrency.
+#
+#   python -m benchmarks.bench_content --size-mb 200 --concurrency 8 --downloads 32
+
+CHUNK = 1024 * 1024
+
+
+def peak_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) # kilobytes on Linux
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))], 2) if values else None
+
+
+def prepare(size_mb):
+    from main import create_app
+    from applications.commands import init_db, seed
+    from applications.database import db
+    from applications.model import Section, Book, user_book
+    from datetime import date
+    root = tempfile.mkdtemp()
+    with open(os.path.join(root, 'book.pdf'), 'wb') as f:
+        block = os.urandom(CHUNK)
+        for _ in range(size_mb):
+            f.write(block)
+
+    class ContentConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(root, 'content.sqlite3')
+        CONTENT_ROOT = root
+        QUERY_BUDGET_STRICT = False
+        METRICS_ENABLED = False
+
+    app = create_app(ContentConfig)
+    init_db(app)
+    seed(app)
+    with app.app_context():
+        db.session.add(Section(id=1, name='Content', description='Benchmark section', date_created=date.today()))
+        db.session.add(Book(id=1, title='Content', content_type='pdf', content='book.pdf', author='Author',
+                            download_price=1.0, section_id=1, date_created=date.today()))
+        db.session.flush() # Core statements do not autoflush, the book must exist for the foreign key
+        db.session.execute(user_book.insert().values(username='admin', book_id=1))
+        db.session.commit()
+    return app
+
+
+def download(port, headers):
+    # Returns (bytes read, seconds), reading the body in blocks like a client saving it to disk
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    try:
+        started = time.perf_counter()
+        conn.request('GET', '/api/v1/book/1/content', headers=headers)
+        response = conn.getresponse()
+        assert response.status in (200, 206), response.status
+        size = 0
+        while True:
+            block = response.read(CHUNK)
+            if not block:
+                break
+            size += len(block)
+        return size, time.perf_counter() - started
+    finally:
+        conn.close()
+
+
+def measure(port, headers, concurrency, downloads, ranged, size_mb):
+    latencies = []
+    received = [0]
+    lock = threading.Lock()
+    counter = iter(range(downloads))
+
+    def worker():
+        while True:
+            with lock:
+                n = next(counter, None)
+            if n is None:
+                return
+            request_headers = dict(headers)
+            if ranged:
+                start = n * 7919 % size_mb * CHUNK
+                request_headers['Range'] = 'bytes=%d-%d' % (start, start + CHUNK - 1)
+            size, seconds = download(port, request_headers)
+            with lock:
+                received[0] += size
+                latencies.append(seconds * 1000)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        'downloads':len(latencies),
+        'mb_per_sec':round(received[0] / CHUNK / elapsed, 1),
+        'p50_ms':percentile(latencies, 0.50),
+        'p95_ms':percentile(latencies, 0.95),
+        'peak_rss_mb':peak_rss_mb(),
+    }
+
+
+def run(size_mb, concurrency, downloads):
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    app = prepare(size_mb)
+    token = app.test_client(use_cookies=False).post('/api/v1/login', json={
+        'email':'admin@gmail.com', 'password':'password'}).json['user']['auth_token']
+    headers = {'Authentication-Token':token}
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        before = peak_rss_mb()
+        full = measure(server.server_port, headers, concurrency, downloads, False, size_mb)
+        ranged = measure(server.server_port, headers, concurrency, downloads, True, size_mb)
+    finally:
+        server.shutdown()
+
+    return {'size_mb':size_mb, 'concurrency':concurrency, 'peak_rss_before_mb':before, 'full':full, 'range':ranged}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--downloads', type=int, default=32, help='downloads per mode (full, range)')
+    args = parser.parse_args()
+    print(json.dumps(run(args.size_mb, args.concurrency, args.downloads), indent=2))
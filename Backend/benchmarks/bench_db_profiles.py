@@ -0,0 +1,145 @@
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import date
+from applications.config import config_profiles
+
+# Read throughput while admins write, for each configuration profile.
+# Every profile gets its own database file seeded with --sections x --books-per-section books. --readers
+# threads then page through section listings and fetch books while --writers threads keep updating books,
+# for --seconds. The response cache is off so every read reaches SQLite. Compare reads_per_sec and the
+# error counts ("database is locked" shows up as 400/500 answers) between development and production.
+#
+#   python -m benchmarks.bench_db_profiles --readers 8 --writers 2 --seconds 10
+
+
+def bench_config(profile, folder):
+    base = config_profiles[profile]
+    uri = 'sqlite:///' + os.path.join(folder, f'{profile}.sqlite3')
+
+    class BenchConfig(base):
+        DEBUG = False
+        SQLALCHEMY_DATABASE_URI = uri
+        SQLALCHEMY_BINDS = {key:uri for key in base.SQLALCHEMY_BINDS}
+        CACHE_BACKEND = 'null'
+        PASSWORD_POOL_WORKERS = 0
+        SCHEDULER_ENABLED = False
+        QUERY_BUDGET_STRICT = False
+        RATE_LIMIT_ENABLED = False # the clients all share one address, the limits would throttle the run
+
+    return BenchConfig
+
+
+def seed(app, sections, books_per_section):
+    from applications.database import db
+    from applications.model import Section, Book
+    from applications.search import rebuild_search_index
+    with app.app_context():
+        section_rows = [Section(name=f'Section {i}', description='Benchmark section', date_created=date.today())
+                        for i in range(sections)]
+        db.session.add_all(section_rows)
+        db.session.flush()
+        db.session.add_all([
+            Book(title=f'Book {s.id}-{i}', content_type='pdf', content='book.pdf', author='Author',
+                 download_price=1.0, section_id=s.id, date_created=date.today())
+            for s in section_rows for i in range(books_per_section)
+        ])
+        db.session.flush()
+        rebuild_search_index()
+        db.session.commit()
+        return [s.id for s in section_rows], [row[0] for row in db.session.query(Book.id).all()]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))], 2)
+
+
+def run_profile(create_app, profile, folder, sections, books_per_section, readers, writers, seconds):
+    from applications.commands import init_db, seed as seed_admin
+    app = create_app(bench_config(profile, folder))
+    init_db(app)
+    seed_admin(app)
+    section_ids, book_ids = seed(app, sections, books_per_section)
+
+    client = app.test_client(use_cookies=False)
+    login = client.post('/api/v1/login', json={'email':'admin@gmail.com', 'password':'password'})
+    admin = {'Authentication-Token':login.json['user']['auth_token']}
+
+    deadline = time.perf_counter() + seconds
+    stats = {'reads':0, 'read_errors':0, 'writes':0, 'write_errors':0}
+    read_ms = []
+    lock = threading.Lock()
+
+    def read(i):
+        client = app.test_client(use_cookies=False)
+        n = i
+        while time.perf_counter() < deadline:
+            n += 1
+            url = (f'/api/v1/{section_ids[n % len(section_ids)]}/books?limit=50' if n % 2
+                   else f'/api/v1/book/{book_ids[n * 7919 % len(book_ids)]}')
+            started = time.perf_counter()
+            ok = client.get(url).status_code == 200
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                stats['reads' if ok else 'read_errors'] += 1
+                read_ms.append(elapsed)
+
+    def write(i):
+        client = app.test_client(use_cookies=False)
+        n = i
+        while time.perf_counter() < deadline:
+            n += 1
+            book_id = book_ids[n * 104729 % len(book_ids)]
+            ok = client.put(f'/api/v1/book/{book_id}', headers=admin, json={
+                'title':f'Book {book_id} v{n}', 'download_price':2.0,
+                'section_id':section_ids[n % len(section_ids)]
+            }).status_code == 200
+            with lock:
+                stats['writes' if ok else 'write_errors'] += 1
+
+    threads = [threading.Thread(target=read, args=(i,)) for i in range(readers)]
+    threads += [threading.Thread(target=write, args=(i,)) for i in range(writers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'profile':profile,
+        'reads_per_sec':round(stats['reads'] / elapsed, 1),
+        'writes_per_sec':round(stats['writes'] / elapsed, 1),
+        'read_errors':stats['read_errors'],
+        'write_errors':stats['write_errors'],
+        'read_p50_ms':percentile(read_ms, 0.50),
+        'read_p95_ms':percentile(read_ms, 0.95),
+        'readers':readers,
+        'writers':writers
+    }
+
+
+def run(profiles, sections, books_per_section, readers, writers, seconds):
+    from main import create_app
+    folder = tempfile.mkdtemp()
+    return [run_profile(create_app, profile, folder, sections, books_per_section, readers, writers, seconds)
+            for profile in profiles]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profiles', nargs='+', default=['development', 'production'], choices=list(config_profiles))
+    parser.add_argument('--sections', type=int, default=20)
+    parser.add_argument('--books-per-section', type=int, default=200)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run(args.profiles, args.sections, args.books_per_section, args.readers, args.writers,
+                         args.seconds), indent=2))
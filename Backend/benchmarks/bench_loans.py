@@ -0,0 +1,154 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from applications.config import TestingConfig, ProductionConfig
+
+# Concurrent borrow/return stress test (applications/loans.py).
+# Serves the app from a threaded werkzeug server on a WAL database and lets --borrowers threads, one user
+# each, borrow and return --books books of --copies copies for --seconds: every thread borrows a random
+# book and, once it holds LOAN_LIMIT books or at random, returns one. Reports the answers by status, the
+# completed borrows/returns per second (to check the throughput holds steady) and p50/p95 latency, then
+# checks the invariants against user_request: no book lent more than its copies, every available_copies
+# and active_loans counter equal to the loans actually active, no user over the limit.
+#
+#   python -m benchmarks.bench_loans --borrowers 300 --books 20 --copies 5 --seconds 20
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))], 2) if values else None
+
+
+def prepare(borrowers, books, copies):
+    from sqlalchemy import update
+    from main import create_app
+    from applications.commands import init_db, seed
+    from applications.database import db
+    from applications.model import Book, User
+    from benchmarks import dataset
+
+    class LoanConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'loans.sqlite3')
+        SQLITE_PRAGMAS = ProductionConfig.SQLITE_PRAGMAS
+        SQLALCHEMY_ENGINE_OPTIONS = ProductionConfig.SQLALCHEMY_ENGINE_OPTIONS
+        PRINCIPAL_CACHE_TTL = 60
+        QUERY_BUDGET_STRICT = False
+        METRICS_ENABLED = False
+
+    app = create_app(LoanConfig)
+    init_db(app)
+    seed(app)
+    dataset.generate(app, sections=1, books=books, users=borrowers, ratings=0, requests=0)
+    with app.app_context():
+        db.session.execute(update(Book).values(copies=copies, available_copies=copies))
+        db.session.commit()
+        tokens = [db.session.get(User, f'user{n}').get_auth_token() for n in range(1, borrowers + 1)]
+    return app, tokens
+
+
+def check(app, limit):
+    # Returns the invariants that do not hold (empty when all is well)
+    from sqlalchemy import text
+    from applications.database import db
+    with app.app_context():
+        return {
+            'books_lent_over_copies':db.session.execute(text("""
+                SELECT count(*) FROM book WHERE copies < (
+                    SELECT count(*) FROM user_request WHERE book_id = book.id AND is_active = 1)
+            """)).scalar(),
+            'available_copies_off':db.session.execute(text("""
+                SELECT count(*) FROM book WHERE available_copies != copies - (
+                    SELECT count(*) FROM user_request WHERE book_id = book.id AND is_active = 1)
+            """)).scalar(),
+            'active_loans_off':db.session.execute(text("""
+                SELECT count(*) FROM "user" WHERE active_loans != (
+                    SELECT count(*) FROM user_request WHERE username = "user".username AND is_active = 1)
+            """)).scalar(),
+            'users_over_limit':db.session.execute(text('SELECT count(*) FROM "user" WHERE active_loans > :limit'),
+                                                  {'limit':limit}).scalar(),
+        }
+
+
+def run(borrowers, books, copies, seconds):
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    app, tokens = prepare(borrowers, books, copies)
+    limit = app.config['LOAN_LIMIT']
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    server.socket.listen(1024)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    statuses = {}
+    latencies = []
+    completed = [] # second of every 2xx answer
+    lock = threading.Lock()
+    started = time.perf_counter()
+    deadline = started + seconds
+
+    def call(token, action, book_id):
+        conn = http.client.HTTPConnection('127.0.0.1', server.server_port, timeout=60)
+        try:
+            sent = time.perf_counter()
+            conn.request('POST', f'/api/v1/book/{book_id}/{action}', headers={'Authentication-Token':token})
+            status = conn.getresponse().status
+        finally:
+            conn.close()
+        with lock:
+            key = f'{action} {status}'
+            statuses[key] = statuses.get(key, 0) + 1
+            latencies.append((time.perf_counter() - sent) * 1000)
+            if status < 300:
+                completed.append(int(time.perf_counter() - started))
+        return status
+
+    def borrower(token, rng):
+        held = []
+        while time.perf_counter() < deadline:
+            if held and (len(held) >= limit or rng.random() < 0.3):
+                book_id = held.pop(rng.randrange(len(held)))
+                call(token, 'return', book_id)
+                continue
+            book_id = rng.randrange(1, books + 1)
+            if call(token, 'borrow', book_id) == 201:
+                held.append(book_id)
+
+    threads = [threading.Thread(target=borrower, args=(token, random.Random(n))) for n, token in enumerate(tokens)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+
+    per_second = [completed.count(second) for second in range(int(seconds))]
+    return {
+        'borrowers':borrowers,
+        'books':books,
+        'copies':copies,
+        'requests':len(latencies),
+        'requests_per_sec':round(len(latencies) / elapsed, 1),
+        'completed_per_sec':per_second,
+        'p50_ms':percentile(latencies, 0.50),
+        'p95_ms':percentile(latencies, 0.95),
+        'statuses':dict(sorted(statuses.items())),
+        'violations':check(app, limit),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--borrowers', type=int, default=300)
+    parser.add_argument('--books', type=int, default=20)
+    parser.add_argument('--copies', type=int, default=5)
+    parser.add_argument('--seconds', type=float, default=20)
+    args = parser.parse_args()
+    print(json.dumps(run(args.borrowers, args.books, args.copies, args.seconds), indent=2))
@@ -0,0 +1,73 @@
+import argparse
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from passlib.context import CryptContext
+from applications.password_pool import _init_worker, _verify
+
+# Logins/sec against hash cost, to size PASSWORD_POOL_WORKERS and the cost parameters.
+# For every cost setting it verifies the same password inline (one request thread, what Login did before)
+# and through a process pool of --workers processes fed by --concurrency request threads.
+#
+#   python -m benchmarks.bench_password_hashing --workers 4 --concurrency 16 --seconds 5
+
+COSTS = [
+    ('argon2', {'argon2__rounds': 1, 'argon2__memory_cost': 8192}),
+    ('argon2', {'argon2__rounds': 2, 'argon2__memory_cost': 32768}),
+    ('argon2', {}), # passlib default (t=3, m=64MiB)
+    ('bcrypt', {'bcrypt__rounds': 10}),
+    ('bcrypt', {'bcrypt__rounds': 12}),
+]
+
+
+def measure(fn, seconds, concurrency=1):
+    # Calls fn from `concurrency` threads for `seconds`, returns calls per second
+    deadline = time.perf_counter() + seconds
+    counts = [0] * concurrency
+
+    def loop(i):
+        while time.perf_counter() < deadline:
+            fn()
+            counts[i] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as threads:
+        list(threads.map(loop, range(concurrency)))
+    return sum(counts) / (time.perf_counter() - started)
+
+
+def run(workers, concurrency, seconds):
+    results = []
+    for scheme, options in COSTS:
+        context = CryptContext(schemes=[scheme], default=scheme, **options)
+        password_hash = context.hash('password')
+        policy = context.to_string()
+
+        inline = measure(lambda: _verify('password', password_hash, 'password', context=context), seconds)
+
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker, initargs=(policy,)) as pool:
+            pool.submit(_verify, 'password', password_hash, 'password').result() # warm up the workers
+            pooled = measure(lambda: pool.submit(_verify, 'password', password_hash, 'password').result(),
+                             seconds, concurrency)
+
+        results.append({
+            'scheme':scheme,
+            'options':options,
+            'hash_ms':round(1000 / inline, 2),
+            'inline_logins_per_sec':round(inline, 1),
+            'pool_logins_per_sec':round(pooled, 1),
+            'workers':workers,
+            'concurrency':concurrency
+        })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=3)
+    args = parser.parse_args()
+    print(json.dumps(run(args.workers, args.concurrency, args.seconds), indent=2))
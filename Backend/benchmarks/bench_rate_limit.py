@@ -0,0 +1,122 @@
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from applications.config import TestingConfig
+
+# Overhead of the token bucket rate limits (applications/rate_limit.py).
+# Reports the cost of one BucketStore.take() from one thread and from --threads threads, checks that
+# --processes forked workers hammering one key share a single budget (together they get exactly the
+# bucket's capacity), then the p50/p95 latency of GET /api/v1/get_all_sections (answered from the response
+# cache, so the limiter is a visible part of it) with the limits off and on, with and without an auth token.
+#
+#   python -m benchmarks.bench_rate_limit --calls 200000 --threads 8 --processes 4 --samples 5000
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))], 2) if values else None
+
+
+def timings(fn, samples):
+    latencies = []
+    for n in range(samples):
+        started = time.perf_counter()
+        fn(n)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return {'p50_ms':percentile(latencies, 0.50), 'p95_ms':percentile(latencies, 0.95)}
+
+
+def store_path():
+    return os.path.join(tempfile.mkdtemp(), 'rate_limit.buckets')
+
+
+def take_cost(calls, threads):
+    from applications.rate_limit import BucketStore
+    store = BucketStore(store_path())
+    per_thread = calls // threads
+
+    def worker(n):
+        for call in range(per_thread):
+            store.take(f'bench:ip:10.0.{n}.{call % 1000}', 1000, 1000.0, time.time())
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {'threads':threads, 'calls':per_thread * threads, 'us_per_call':round(elapsed / (per_thread * threads) * 1e6, 2)}
+
+
+def shared_budget(processes, capacity):
+    # Every process takes from the same key until it is refused; the bucket barely refills meanwhile
+    from applications.rate_limit import BucketStore
+    path = store_path()
+    store = BucketStore(path)
+    reads = []
+    for _ in range(processes):
+        read, write = os.pipe()
+        if os.fork() == 0:
+            os.close(read)
+            taken = 0
+            for _ in range(capacity):
+                taken += store.take('bench:ip:shared', capacity, 1e-6, time.time())[0]
+            os.write(write, str(taken).encode())
+            os._exit(0)
+        os.close(write)
+        reads.append(read)
+    taken = [int(os.read(read, 64)) for read in reads]
+    for _ in range(processes):
+        os.wait()
+    return {'processes':processes, 'capacity':capacity, 'taken_per_process':taken, 'taken':sum(taken),
+            'budget_held':sum(taken) == capacity}
+
+
+def request_overhead(samples):
+    from main import create_app
+    from applications.commands import init_db, seed
+    from applications.database import db
+    from applications.model import User
+    from benchmarks import dataset
+
+    result = {}
+    for enabled in (False, True):
+        class LimitConfig(TestingConfig):
+            CACHE_BACKEND = 'lru'
+            QUERY_BUDGET_STRICT = False
+            METRICS_ENABLED = False
+            RATE_LIMIT_ENABLED = enabled
+            RATE_LIMIT_STORE = store_path()
+            RATE_LIMITS = {'allsections': {'ip': (10 ** 9, 1), 'user': (10 ** 9, 1)}}
+
+        app = create_app(LimitConfig)
+        init_db(app)
+        seed(app)
+        dataset.generate(app, sections=20, books=200, users=1, ratings=0, requests=0)
+        with app.app_context():
+            token = db.session.get(User, 'user1').get_auth_token()
+        client = app.test_client(use_cookies=False)
+        client.get('/api/v1/get_all_sections') # fills the response cache
+        label = 'limits_on' if enabled else 'limits_off'
+        result[label] = timings(lambda n: client.get('/api/v1/get_all_sections'), samples)
+        result[label + '_with_token'] = timings(lambda n: client.get(
+            '/api/v1/get_all_sections', headers={'Authentication-Token':token}), samples)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=200000, help='BucketStore.take() calls timed')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--samples', type=int, default=5000, help='timed requests per configuration')
+    args = parser.parse_args()
+    print(json.dumps({
+        'take':[take_cost(args.calls, 1), take_cost(args.calls, args.threads)],
+        'shared_budget':shared_budget(args.processes, 20000),
+        'requests':request_overhead(args.samples),
+    }, indent=2))
@@ -0,0 +1,81 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import date, timedelta
+from applications.config import TestingConfig
+from benchmarks import dataset
+
+# "Also borrowed" index (applications/recommendations.py) at growing loan histories.
+# For each --loans size, generates a library with that many loans (one user per 20 loans, one book per
+# 10), then reports the offline rebuild time and size, the cost of recording a new loan through the ORM
+# (the after_flush hook updates the index in the same commit) and the p50/p95 latency of
+# GET /api/v1/book/<id>/related and GET /api/v1/recommendations. The last three stay flat as the
+# history grows: they only touch a window of the borrower's books and the top-K of a few books.
+#
+#   python -m benchmarks.bench_recommendations --loans 100000 1000000
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))], 2) if values else None
+
+
+def timings(fn, samples):
+    latencies = []
+    for n in range(samples):
+        started = time.perf_counter()
+        fn(n)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return {'p50_ms':percentile(latencies, 0.50), 'p95_ms':percentile(latencies, 0.95)}
+
+
+def run(loans, samples):
+    from main import create_app
+    from applications.commands import init_db, seed
+    from applications.database import db
+    from applications.model import UserRequest
+    from applications.recommendations import co_occurrence
+
+    class RecommendationConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'recommendations.sqlite3')
+        QUERY_BUDGET_STRICT = False
+        METRICS_ENABLED = False
+
+    books, users = max(loans // 10, 100), max(loans // 20, 10)
+    app = create_app(RecommendationConfig)
+    init_db(app)
+    seed(app)
+    dataset.generate(app, sections=max(books // 100, 1), books=books, users=users, ratings=0, requests=loans)
+    rng = random.Random(7)
+
+    with app.app_context():
+        started = time.perf_counter()
+        borrows, pairs = co_occurrence.rebuild(db.session.connection())
+        db.session.commit()
+        result = {'loans':loans, 'books':books, 'users':users, 'borrows':borrows, 'book_pairs':pairs,
+                  'rebuild_s':round(time.perf_counter() - started, 2)}
+
+        def borrow(n):
+            db.session.add(UserRequest(username=f'user{rng.randrange(1, users + 1)}', book_id=rng.randrange(1, books + 1),
+                                       request_date=date.today(), return_date=date.today() + timedelta(days=14)))
+            db.session.commit()
+        result['record_loan'] = timings(borrow, samples)
+
+    client = app.test_client(use_cookies=False)
+    result['related'] = timings(lambda n: client.get(f'/api/v1/book/{rng.randrange(1, books + 1)}/related'), samples)
+    tokens = [client.post('/api/v1/login', json={'email':f'user{n}@example.com', 'password':dataset.PASSWORD})
+              .json['user']['auth_token'] for n in range(1, min(users, 20) + 1)]
+    result['recommendations'] = timings(lambda n: client.get('/api/v1/recommendations', headers={
+        'Authentication-Token':tokens[n % len(tokens)]}), samples)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loans', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--samples', type=int, default=200, help='timed calls per operation')
+    args = parser.parse_args()
+    print(json.dumps([run(loans, args.samples) for loans in args.loans], indent=2))
@@ -0,0 +1,96 @@
+import argparse
+import json
+import time
+from datetime import date, datetime
+from flask_restful import marshal
+from sqlalchemy import select
+from applications.config import TestingConfig
+from applications.marshal_fields import section, book_schema, section_schema
+
+# Rows serialized per second by the old code paths and by the compiled schemas (applications/marshal_fields.py).
+# Seeds an in-memory database with --rows books and --rows sections, then times, for each serializer,
+# the query plus the serialization of every row, best of --repeat runs:
+#   legacy:   select(Book) ORM objects + the per-row dict/strftime the handlers used to build
+#   marshal:  select(Section) ORM objects + flask_restful marshal(row, section)
+#   schema:   select(Book) ORM objects + book_schema.from_object
+#   tuples:   book_schema.select() column tuples + book_schema.from_row (what the listings use now)
+#
+#   python -m benchmarks.bench_serializers --rows 20000
+
+
+def legacy_book_dict(book):
+    return {
+        'book_id':book.id,
+        'title':book.title,
+        'content_type':book.content_type,
+        'content':book.content,
+        'author':book.author,
+        'image':book.image,
+        'date_created':datetime.strftime(book.date_created,'%Y-%m-%d'),
+        'download_price':book.download_price,
+        'section_id':book.section_id
+    }
+
+
+def seed(db, rows):
+    from applications.model import Section, Book
+    db.session.add_all([Section(name=f'Section {i}', description='Benchmark section',
+                                date_created=date(2024, 1, 1 + i % 28)) for i in range(rows)])
+    db.session.flush()
+    db.session.add_all([Book(title=f'Book {i}', content_type='pdf', content='book.pdf', author='Author',
+                             download_price=1.0, section_id=1 + i % rows, date_created=date(2024, 1, 1 + i % 28))
+                        for i in range(rows)])
+    db.session.commit()
+
+
+def best(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        count = len(fn())
+        timings.append(time.perf_counter() - started)
+    return count / min(timings)
+
+
+def run(rows, repeat):
+    from main import create_app
+    from applications.database import db
+    from applications.model import Section, Book
+
+    class BenchConfig(TestingConfig):
+        QUERY_BUDGET_STRICT = False
+
+    from applications.commands import init_db
+    app = create_app(BenchConfig)
+    init_db(app)
+    with app.app_context():
+        seed(db, rows)
+
+        def orm(model):
+            db.session.expunge_all() # start from an empty identity map like a new request
+            return db.session.execute(select(model)).scalars()
+
+        cases = {
+            'legacy_books':lambda: [legacy_book_dict(book) for book in orm(Book)],
+            'schema_books':lambda: [book_schema.from_object(book) for book in orm(Book)],
+            'tuple_books':lambda: [book_schema.from_row(row) for row in db.session.execute(book_schema.select())],
+            'marshal_sections':lambda: [marshal(row, section) for row in orm(Section)],
+            'schema_sections':lambda: [section_schema.from_object(row) for row in orm(Section)],
+            'tuple_sections':lambda: [section_schema.from_row(row) for row in db.session.execute(section_schema.select())],
+        }
+        results = {name:round(best(fn, repeat)) for name, fn in cases.items()}
+
+    return {
+        'rows':rows,
+        'rows_per_sec':results,
+        'books_speedup':round(results['tuple_books'] / results['legacy_books'], 2),
+        'sections_speedup':round(results['tuple_sections'] / results['marshal_sections'], 2)
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run(args.rows, args.repeat), indent=2))
@@ -0,0 +1,123 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Startup cost of a worker.
+#   cold:    a fresh interpreter imports main, builds the app and answers its first request (what every
+#            worker pays without --preload), measured in --runs separate processes
+#   setup:   init_db + seed on an existing database, the work every worker used to do at import, plus
+#            admin_hash_ms, the hash_password call it made whenever the admin was missing
+#   preload: the app is built and warmed (wsgi.py) once in this process, then --workers children are
+#            forked and each answers its first request; reported per child from fork to response
+#
+#   python -m benchmarks.bench_startup --runs 5 --workers 4
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_COLD = """
+import json, sys, time
+started = time.perf_counter()
+import main
+from applications.config import get_config
+imported = time.perf_counter()
+
+class StartupConfig(get_config()):
+    SQLALCHEMY_DATABASE_URI = %(uri)r
+    SQLALCHEMY_BINDS = {key:%(uri)r for key in get_config().SQLALCHEMY_BINDS}
+    SCHEDULER_ENABLED = False
+
+app = main.create_app(StartupConfig)
+built = time.perf_counter()
+app.test_client().get('/api/v1/get_all_sections')
+answered = time.perf_counter()
+
+from applications.commands import init_db, seed
+init_db(app)
+seed(app)
+setup = time.perf_counter() - answered
+
+from flask_security import hash_password
+with app.app_context():
+    hashed = time.perf_counter()
+    hash_password('password')
+    hashed = time.perf_counter() - hashed
+print(json.dumps({'import_ms':(imported - started) * 1000, 'create_app_ms':(built - imported) * 1000,
+                  'first_request_ms':(answered - built) * 1000, 'setup_ms':setup * 1000,
+                  'admin_hash_ms':hashed * 1000}))
+"""
+
+
+def median(values):
+    values = sorted(values)
+    return round(values[len(values) // 2], 1)
+
+
+def cold(uri, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        out = subprocess.run([sys.executable, '-c', _COLD % {'uri':uri}], cwd=BACKEND, check=True,
+                             capture_output=True, text=True).stdout
+        sample = json.loads(out.strip().splitlines()[-1])
+        sample['process_ms'] = (time.perf_counter() - started) * 1000
+        samples.append(sample)
+    return {key:median([s[key] for s in samples]) for key in samples[0]}
+
+
+def preload(uri, workers):
+    from main import create_app, warm_up
+    from applications.config import get_config
+
+    class StartupConfig(get_config()):
+        SQLALCHEMY_DATABASE_URI = uri
+        SQLALCHEMY_BINDS = {key:uri for key in get_config().SQLALCHEMY_BINDS}
+        SCHEDULER_ENABLED = False
+
+    started = time.perf_counter()
+    app = warm_up(create_app(StartupConfig))
+    master_ms = (time.perf_counter() - started) * 1000
+
+    per_worker = []
+    for _ in range(workers):
+        read, write = os.pipe()
+        forked = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            app.test_client().get('/api/v1/get_all_sections')
+            os.write(write, str((time.perf_counter() - forked) * 1000).encode())
+            os._exit(0)
+        os.close(write)
+        per_worker.append(float(os.read(read, 64)))
+        os.close(read)
+        os.waitpid(pid, 0)
+    return {'master_build_ms':round(master_ms, 1), 'worker_first_response_ms':median(per_worker)}
+
+
+def run(runs, workers):
+    from main import create_app
+    from applications.config import get_config
+    from applications.commands import init_db, seed
+    uri = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'startup.sqlite3')
+
+    class SetupConfig(get_config()):
+        SQLALCHEMY_DATABASE_URI = uri
+        SQLALCHEMY_BINDS = {key:uri for key in get_config().SQLALCHEMY_BINDS}
+
+    app = create_app(SetupConfig)
+    init_db(app)
+    seed(app)
+
+    return {'cold':cold(uri, runs), 'preload':preload(uri, workers), 'runs':runs, 'workers':workers}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+    print(json.dumps(run(args.runs, args.workers), indent=2))
@@ -0,0 +1,92 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from datetime import date, timedelta
+from applications.config import TestingConfig
+from benchmarks import dataset
+
+# Admin dashboard from the analytics rollups (applications/stats.py) at growing histories.
+# For each --loans size, generates a library with that many loans and ratings (timestamps spread over 2024),
+# then reports the p50/p95 latency of GET /api/v1/admin/stats for a month of days and for two days of hours,
+# against the same month computed the ad-hoc way (GROUP BY over user_request, rating and book), and the
+# cost of writing a loan with the rollup maintained in the same transaction. The rollup reads stay flat as
+# the history grows, the ad-hoc query grows with it.
+#
+#   python -m benchmarks.bench_stats --loans 100000 1000000
+
+AD_HOC = """
+    SELECT strftime('%Y-%m-%d', user_request.created_at) AS day, count(*), sum(book.download_price)
+    FROM user_request JOIN book ON book.id = user_request.book_id
+    WHERE user_request.created_at >= '2024-06-01' AND user_request.created_at < '2024-07-01'
+    GROUP BY day
+"""
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))], 2) if values else None
+
+
+def timings(fn, samples):
+    latencies = []
+    for n in range(samples):
+        started = time.perf_counter()
+        fn(n)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return {'p50_ms':percentile(latencies, 0.50), 'p95_ms':percentile(latencies, 0.95)}
+
+
+def run(loans, samples):
+    from sqlalchemy import text
+    from main import create_app
+    from applications.commands import init_db, seed
+    from applications.database import db
+    from applications.model import UserRequest
+
+    class StatsConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'stats.sqlite3')
+        QUERY_BUDGET_STRICT = False
+        METRICS_ENABLED = False
+
+    books = max(loans // 10, 100)
+    app = create_app(StatsConfig)
+    init_db(app)
+    seed(app)
+    started = time.perf_counter()
+    dataset.generate(app, sections=max(books // 100, 1), books=books, users=max(loans // 20, 10),
+                     ratings=loans, requests=loans)
+    result = {'loans':loans, 'ratings':loans, 'generate_s':round(time.perf_counter() - started, 1)}
+
+    client = app.test_client(use_cookies=False)
+    admin = {'Authentication-Token':client.post('/api/v1/login', json={
+        'email':'admin@gmail.com', 'password':'password'}).json['user']['auth_token']}
+
+    def stats(url):
+        response = client.get(url, headers=admin)
+        assert response.status_code == 200, response.json
+
+    result['stats_month_by_day'] = timings(lambda n: stats('/api/v1/admin/stats?from=2024-06-01&to=2024-06-30'), samples)
+    result['stats_month_by_section'] = timings(lambda n: stats(
+        '/api/v1/admin/stats?from=2024-06-01&to=2024-06-30&section_id=1&by_section=1'), samples)
+    result['stats_two_days_by_hour'] = timings(lambda n: stats(
+        '/api/v1/admin/stats?grain=hour&from=2024-06-01&to=2024-06-02T23'), samples)
+
+    with app.app_context():
+        result['ad_hoc_month_by_day'] = timings(lambda n: db.session.execute(text(AD_HOC)).all(), max(samples // 10, 3))
+
+        def borrow(n):
+            db.session.add(UserRequest(username='user1', book_id=n % books + 1, request_date=date.today(),
+                                       return_date=date.today() + timedelta(days=14)))
+            db.session.commit()
+        result['record_loan'] = timings(borrow, samples)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loans', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--samples', type=int, default=100, help='timed calls per operation')
+    args = parser.parse_args()
+    print(json.dumps([run(loans, args.samples) for loans in args.loans], indent=2))
@@ -0,0 +1,112 @@
+import random
+from datetime import date, datetime, timedelta
+from sqlalchemy import insert, select
+from applications.database import db
+from applications.model import User, Role, RoleUser, Section, Book, Rating, UserRequest, user_book
+
+# Deterministic synthetic library for the benchmarks.
+# The same seed and sizes always produce the same rows, so two runs (or two commits) load the exact
+# same data. Rows are bulk inserted in chunks through the models' tables; the flush hooks do not run, so
+# the rating aggregates, the loan counters, the search index and the co-occurrence index are rebuilt once
+# at the end, and the analytics rollups caught up. Creation times come from a second generator, so the
+# other rows are the same as before they existed.
+# Ids are predictable: sections 1..sections, books 1..books, users user1..userN (password 'password').
+
+SIZES = {
+    'tiny':{'sections':10, 'books':500, 'users':200, 'ratings':2000, 'requests':2000},
+    'small':{'sections':100, 'books':10000, 'users':5000, 'ratings':100000, 'requests':100000},
+    'large':{'sections':1000, 'books':100000, 'users':50000, 'ratings':1000000, 'requests':1000000},
+}
+
+PASSWORD = 'password'
+CHUNK_SIZE = 10000
+EPOCH = date(2024, 1, 1)
+
+
+def _insert(target, rows):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(insert(target), rows[start:start + CHUNK_SIZE])
+
+
+def generate(app, sections, books, users, ratings, requests, seed=42):
+    # Fills the (empty) database of `app`. Returns the sizes actually generated.
+    from flask_security import hash_password
+    from applications.ratings import rating_aggregates
+    from applications.search import rebuild_search_index
+    from applications.recommendations import co_occurrence
+    from applications.jobs import rollup_stats
+    from applications import loans as loan_counters
+
+    rng = random.Random(seed)
+    clock = random.Random(seed + 1)
+
+    def moment(day):
+        return datetime.combine(day, datetime.min.time()) + timedelta(seconds=clock.randrange(86400))
+    with app.app_context():
+        user_role = db.session.execute(select(Role.role_id).where(Role.name == 'user')).scalar()
+        password_hash = hash_password(PASSWORD) # one hash shared by every generated user
+
+        _insert(Section, [{
+            'id':i,
+            'name':f'Section {i}',
+            'description':f'Synthetic section {i}',
+            'date_created':EPOCH + timedelta(days=rng.randrange(365)),
+        } for i in range(1, sections + 1)])
+
+        _insert(Book, [{
+            'id':i,
+            'title':f'Book {i} {rng.choice(["Atlas", "River", "Night", "Garden", "Empire", "Signal"])}',
+            'content_type':rng.choice(['pdf', 'epub']),
+            'content':f'book-{i}.pdf',
+            'author':f'Author {rng.randrange(1, max(books // 10, 2))}',
+            'date_created':EPOCH + timedelta(days=rng.randrange(365)),
+            'download_price':round(rng.uniform(0, 50), 2),
+            'section_id':rng.randrange(1, sections + 1),
+        } for i in range(1, books + 1)])
+
+        _insert(User, [{
+            'username':f'user{i}',
+            'email':f'user{i}@example.com',
+            'password':password_hash,
+            'fs_uniquifier':'%032x' % rng.getrandbits(128),
+            'fs_token_uniquifier':'%032x' % rng.getrandbits(128),
+            'active':True,
+        } for i in range(1, users + 1)])
+        _insert(RoleUser, [{'username':f'user{i}', 'role_id':user_role} for i in range(1, users + 1)])
+
+        _insert(Rating, [{
+            'book_id':rng.randrange(1, books + 1),
+            'username':f'user{rng.randrange(1, users + 1)}',
+            'rating':float(rng.randrange(1, 6)),
+            'feedback':None,
+            'created_at':moment(EPOCH + timedelta(days=clock.randrange(365))),
+        } for _ in range(ratings)])
+
+        loans = []
+        access = set()
+        for _ in range(requests):
+            username = f'user{rng.randrange(1, users + 1)}'
+            book_id = rng.randrange(1, books + 1)
+            request_date = EPOCH + timedelta(days=rng.randrange(365))
+            is_active = rng.random() < 0.2
+            loans.append({
+                'username':username,
+                'book_id':book_id,
+                'request_date':request_date,
+                'return_date':request_date + timedelta(days=14),
+                'is_active':is_active,
+                'created_at':moment(request_date),
+            })
+            if is_active:
+                access.add((username, book_id))
+        _insert(UserRequest, loans)
+        _insert(user_book, [{'username':username, 'book_id':book_id} for username, book_id in sorted(access)])
+
+        rating_aggregates.backfill(db.session.connection())
+        loan_counters.backfill(db.session.connection())
+        rebuild_search_index()
+        co_occurrence.rebuild(db.session.connection())
+        db.session.commit()
+        rollup_stats()
+
+    return {'sections':sections, 'books':books, 'users':users, 'ratings':ratings, 'requests':requests, 'seed':seed}
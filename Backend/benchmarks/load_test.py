@@ -0,0 +1,345 @@
+import argparse
+import http.client
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from applications.config import config_profiles
+from benchmarks import dataset
+
+# Load test of every API resource on a seeded synthetic library (benchmarks/dataset.py).
+# Each scenario (one resource and method, or a borrow followed by its return) is run at every --concurrency
+# level, through the Flask test client (in process, measures the app alone) and/or a real threaded WSGI
+# server over HTTP. Results are throughput and p50/p95/p99 latency per (driver, scenario, concurrency),
+# printed as JSON.
+#
+#   python -m benchmarks.load_test --size small --concurrency 1 8 --save baseline.json
+#   python -m benchmarks.load_test --size small --concurrency 1 8 --baseline baseline.json
+#
+# With --baseline the run is compared with a saved one and exits with status 1 when a scenario lost more
+# than --tolerance of its throughput or its p95 grew by more than --tolerance.
+# The database is kept in --database: it is only generated when the file does not exist yet.
+
+
+def _section(ctx, n):
+    return 1 + n * 7919 % ctx['sections']
+
+
+def _book(ctx, n):
+    return 1 + n * 104729 % ctx['books']
+
+
+def _user(ctx, n):
+    return 1 + n * 3571 % ctx['users']
+
+
+def _content_book(ctx, n):
+    return 1 + n % min(ctx['books'], CONTENT_FILES)
+
+
+def _loan(ctx, n):
+    # A user under the loan limit and a book with a copy left, different for every n in flight
+    token = ctx['borrowers'][n % len(ctx['borrowers'])]
+    book_id = ctx['lendable'][n % len(ctx['lendable'])]
+    return [('POST', f'/api/v1/book/{book_id}/borrow', token, None),
+            ('POST', f'/api/v1/book/{book_id}/return', token, None)]
+
+
+def _import_books(ctx, n):
+    lines = [json.dumps({'title':f'Imported {ctx["run"]}-{n}-{row}', 'content_type':'pdf', 'content':'load.pdf',
+                         'author':'Load', 'download_price':1, 'section_id':_section(ctx, n)}) for row in range(10)]
+    return ('POST', '/api/v1/admin/import/books', dict(ctx['admin'], **{'Content-Type':'application/x-ndjson'}),
+            '\n'.join(lines) + '\n')
+
+
+CONTENT_FILES = 100 # books whose file is written for the content scenario
+LOAN_PAIRS = 1000 # borrowers and lendable books the loan scenario cycles through
+
+# name: (method, url, headers, body), or a list of them sent in order by one thread and timed together,
+# built from the dataset sizes and the request number n. A dict body is sent as JSON, a str as is.
+SCENARIOS = {
+    'login':lambda ctx, n: ('POST', '/api/v1/login', {}, {
+        'email':f'user{_user(ctx, n)}@example.com', 'password':dataset.PASSWORD}),
+    'register':lambda ctx, n: ('POST', '/api/v1/register', {}, {
+        'email':f'load{ctx["run"]}x{n}@example.com', 'password':'password123',
+        'username':f'load{ctx["run"]}x{n}', 'role':'user'}),
+    'logout':lambda ctx, n: ('POST', '/api/v1/logout', ctx['user'], None),
+    'all_sections':lambda ctx, n: ('GET', '/api/v1/get_all_sections?limit=50', {}, None),
+    'section':lambda ctx, n: ('GET', f'/api/v1/section/{_section(ctx, n)}', {}, None),
+    'section_books':lambda ctx, n: ('GET', f'/api/v1/{_section(ctx, n)}/books?limit=50', {}, None),
+    'book':lambda ctx, n: ('GET', f'/api/v1/book/{_book(ctx, n)}', {}, None),
+    'search':lambda ctx, n: ('GET', '/api/v1/search?q=%s' % ['atlas', 'river', 'night', 'garden'][n % 4], {}, None),
+    'top_books':lambda ctx, n: ('GET', f'/api/v1/books/top?section_id={_section(ctx, n)}', {}, None),
+    'related':lambda ctx, n: ('GET', f'/api/v1/book/{_book(ctx, n)}/related?limit=10', {}, None),
+    'recommendations':lambda ctx, n: ('GET', '/api/v1/recommendations', ctx['user'], None),
+    'content':lambda ctx, n: ('GET', f'/api/v1/book/{_content_book(ctx, n)}/content', ctx['admin'], None),
+    'borrow_return':_loan,
+    'cache_stats':lambda ctx, n: ('GET', '/api/v1/auth/cache_stats', ctx['admin'], None),
+    'metrics':lambda ctx, n: ('GET', '/api/v1/metrics', ctx['admin'], None),
+    'admin_stats':lambda ctx, n: ('GET', '/api/v1/admin/stats?from=2024-01-01&to=2024-12-31', ctx['admin'], None),
+    'admin_create_section':lambda ctx, n: ('POST', '/api/v1/section', ctx['admin'], {
+        'name':f'Load section {ctx["run"]}-{n}', 'description':'Created by the load test'}),
+    'admin_update_section':lambda ctx, n: ('PUT', f'/api/v1/section/{_section(ctx, n)}', ctx['admin'], {
+        'description':f'Updated {ctx["run"]}-{n}'}),
+    'admin_create_book':lambda ctx, n: ('POST', '/api/v1/book', ctx['admin'], {
+        'title':f'Load book {ctx["run"]}-{n}', 'content_type':'pdf', 'content':'load.pdf', 'author':'Load',
+        'download_price':1, 'section_id':_section(ctx, n)}),
+    'admin_update_book':lambda ctx, n: ('PUT', f'/api/v1/book/{_book(ctx, n)}', ctx['admin'], {
+        'title':f'Book {_book(ctx, n)} updated', 'download_price':2, 'section_id':_section(ctx, n)}),
+    'admin_bulk_update':lambda ctx, n: ('PATCH', '/api/v1/books', ctx['admin'], {
+        'filter':{'section_id':_section(ctx, n)}, 'set':{'price_factor':1}}),
+    'admin_batch':lambda ctx, n: ('POST', '/api/v1/batch', ctx['admin'], {'operations':[
+        {'method':'GET', 'path':f'/book/{_book(ctx, n)}'},
+        {'method':'GET', 'path':f'/section/{_section(ctx, n)}'},
+        {'method':'PUT', 'path':f'/section/{_section(ctx, n)}', 'body':{'description':f'Batch {ctx["run"]}-{n}'}},
+    ]}),
+    'admin_import_books':_import_books,
+    'admin_export_books':lambda ctx, n: ('GET', '/api/v1/admin/export/books', ctx['admin'], None),
+}
+
+
+class ClientDriver:
+    # In process, through the Flask test client (one per thread)
+    name = 'client'
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, url, headers, body):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client(use_cookies=False)
+        payload = {'data':body} if isinstance(body, str) else {'json':body}
+        response = self.local.client.open(url, method=method, headers=headers, **payload)
+        response.get_data() # runs streamed bodies to the end, as a server would
+        response.close()
+        return response.status_code
+
+    def close(self):
+        pass
+
+
+class WSGIDriver:
+    # Over HTTP, against a threaded werkzeug server running the app in the background
+    name = 'wsgi'
+
+    def __init__(self, app):
+        from werkzeug.serving import make_server, WSGIRequestHandler
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass # one log line per request would be measured too
+
+        self.server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def request(self, method, url, headers, body):
+        conn = http.client.HTTPConnection('127.0.0.1', self.server.server_port, timeout=60)
+        try:
+            headers = dict(headers)
+            data = None
+            if isinstance(body, str):
+                data = body.encode()
+            elif body is not None:
+                data = json.dumps(body)
+                headers['Content-Type'] = 'application/json'
+            conn.request(method, url, body=data, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        finally:
+            conn.close()
+
+    def close(self):
+        self.server.shutdown()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))], 2) if values else None
+
+
+def measure(driver, scenario, ctx, concurrency, requests):
+    # Sends `requests` requests from `concurrency` threads, returns one result row
+    build = SCENARIOS[scenario]
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    # Request numbers keep increasing across measurements, so created users/sections stay unique
+    start = ctx.setdefault('sent', 0)
+    ctx['sent'] += requests
+    counter = iter(range(start, start + requests))
+
+    def worker():
+        while True:
+            with lock:
+                n = next(counter, None)
+            if n is None:
+                return
+            steps = build(ctx, n)
+            started = time.perf_counter()
+            status = max([driver.request(*step) for step in (steps if isinstance(steps, list) else [steps])])
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                latencies.append(elapsed)
+                if status >= 400:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'driver':driver.name,
+        'scenario':scenario,
+        'concurrency':concurrency,
+        'requests':len(latencies),
+        'errors':errors[0],
+        'throughput':round(len(latencies) / elapsed, 1),
+        'p50_ms':percentile(latencies, 0.50),
+        'p95_ms':percentile(latencies, 0.95),
+        'p99_ms':percentile(latencies, 0.99),
+    }
+
+
+def bench_config(profile, path, cache):
+    base = config_profiles[profile]
+    uri = 'sqlite:///' + os.path.abspath(path)
+
+    class LoadTestConfig(base):
+        DEBUG = False
+        SQLALCHEMY_DATABASE_URI = uri
+        SQLALCHEMY_BINDS = {key:uri for key in base.SQLALCHEMY_BINDS}
+        SCHEDULER_ENABLED = False
+        QUERY_BUDGET_STRICT = False
+        RATE_LIMIT_ENABLED = False # the clients all share one address, the limits would throttle the run
+        CONTENT_ROOT = tempfile.mkdtemp(prefix='load_content.') # files of the content scenario
+
+    if cache is not None:
+        LoadTestConfig.CACHE_BACKEND = cache
+    return LoadTestConfig
+
+
+def prepare(path, size, seed, profile, cache):
+    # Returns (app, sizes), generating the dataset on first use of `path`
+    from main import create_app
+    from applications import commands
+    sizes = dict(dataset.SIZES[size], seed=seed)
+    meta_path = path + '.json'
+    fresh = not os.path.exists(path)
+
+    app = create_app(bench_config(profile, path, cache))
+    commands.init_db(app) # also migrates a dataset generated by an older version
+    if fresh:
+        commands.seed(app)
+        started = time.perf_counter()
+        dataset.generate(app, **sizes)
+        sizes['generated_in_s'] = round(time.perf_counter() - started, 1)
+        with open(meta_path, 'w') as f:
+            json.dump(sizes, f)
+    elif os.path.exists(meta_path):
+        with open(meta_path) as f:
+            sizes = json.load(f)
+    return app, sizes
+
+
+def loan_context(app):
+    # Tokens of users who may borrow one more book, and books with a copy left
+    from sqlalchemy import select
+    from applications.database import db
+    from applications.model import Book, User
+    with app.app_context():
+        users = db.session.execute(select(User).where(User.active_loans < app.config['LOAN_LIMIT'])
+                                   .order_by(User.username).limit(LOAN_PAIRS)).scalars()
+        return {
+            'borrowers':[{'Authentication-Token':user.get_auth_token()} for user in users],
+            'lendable':db.session.execute(select(Book.id).where(Book.available_copies > 0)
+                                          .order_by(Book.id).limit(LOAN_PAIRS)).scalars().all(),
+        }
+
+
+def compare(results, baseline, tolerance):
+    # Returns the scenarios that regressed against the baseline run
+    previous = {(r['driver'], r['scenario'], r['concurrency']):r for r in baseline['results']}
+    regressions = []
+    for row in results['results']:
+        base = previous.get((row['driver'], row['scenario'], row['concurrency']))
+        if base is None:
+            continue
+        if row['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(dict(row, metric='throughput', baseline=base['throughput']))
+        if base['p95_ms'] and row['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(dict(row, metric='p95_ms', baseline=base['p95_ms']))
+    return regressions
+
+
+def run(args):
+    path = args.database or os.path.join(tempfile.mkdtemp(), f'load_{args.size}.sqlite3')
+    app, sizes = prepare(path, args.size, args.seed, args.profile, args.cache)
+
+    client = app.test_client(use_cookies=False)
+    admin = client.post('/api/v1/login', json={'email':'admin@gmail.com', 'password':'password'})
+    user = client.post('/api/v1/login', json={'email':'user1@example.com', 'password':dataset.PASSWORD})
+    ctx = dict(sizes, run=int(time.time()),
+               admin={'Authentication-Token':admin.json['user']['auth_token']},
+               user={'Authentication-Token':user.json['user']['auth_token']})
+    ctx.update(loan_context(app))
+    for book_id in range(1, min(sizes['books'], CONTENT_FILES) + 1):
+        with open(os.path.join(app.config['CONTENT_ROOT'], f'book-{book_id}.pdf'), 'wb') as f:
+            f.write(os.urandom(65536))
+
+    results = []
+    for driver_class in [d for d in (ClientDriver, WSGIDriver) if d.name in args.drivers]:
+        driver = driver_class(app)
+        try:
+            for scenario in args.scenarios:
+                for concurrency in args.concurrency:
+                    results.append(measure(driver, scenario, ctx, concurrency, args.requests))
+        finally:
+            driver.close()
+
+    return {
+        'dataset':sizes,
+        'profile':args.profile,
+        'cache':app.config['CACHE_BACKEND'],
+        'requests':args.requests,
+        'results':results
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', choices=list(dataset.SIZES), default='tiny')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--database', help='dataset file, generated when missing (default: a temporary file)')
+    parser.add_argument('--profile', choices=list(config_profiles), default='production')
+    parser.add_argument('--cache', choices=['lru', 'shared', 'null'], help='override the profile cache backend')
+    parser.add_argument('--drivers', nargs='+', choices=['client', 'wsgi'], default=['client', 'wsgi'])
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 8])
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario and concurrency level')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare with the results saved in this file')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run(args)
+    print(json.dumps(results, indent=2))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for row in regressions:
+            print('REGRESSION %(driver)s %(scenario)s c=%(concurrency)s %(metric)s: %(baseline)s -> ' % row
+                  + str(row[row['metric']]), file=sys.stderr)
+        if regressions:
+            raise SystemExit(1)
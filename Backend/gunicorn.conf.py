@@ -0,0 +1,12 @@
+# gunicorn settings, read from this folder: gunicorn wsgi:app
+# The app is built once in the master (see wsgi.py). The scheduler thread is started in the workers
+# once they are ready, never in the master: a thread or pooled connection opened there would be shared
+# across the fork. Scheduler.autostart() lets a single worker run the jobs (lock file in the instance folder).
+
+preload_app = True
+
+
+def post_worker_init(worker):
+    from applications.scheduler import scheduler
+    if scheduler.autostart():
+        worker.log.info('Worker %s runs the scheduled jobs', worker.pid)
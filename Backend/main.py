@@ -1,55 +1,122 @@
 from flask import Flask
 
+# Application factory. Importing this module and calling create_app() only builds the app: nothing is
+# written to the database. The schema and the default roles/admin are set up once per deployment with
+#   flask --app main init-db
+#   flask --app main seed
+# Serve it with `gunicorn wsgi:app` (see wsgi.py and gunicorn.conf.py: the warmed app is preloaded and
+# shared between workers, one of them runs the scheduled jobs).
+
 # from applications.model import User, Role
-from applications.database import db
-from applications.config import Config
+from applications.database import db, configure_engines
+from applications.config import get_config
 from flask_restful import Api
 from applications.user_datastore import user_datastore
 
-from flask_security import Security, hash_password
-
-
-def create_app():
+from flask_security import Security
+from applications.cache import cache
+from applications.principal_cache import principal_cache
+from applications.password_pool import password_pool
+from applications.ratings import rating_aggregates
+from applications.recommendations import co_occurrence
+from applications.stats import stats_rollups
+from applications.scheduler import scheduler
+from applications.query_guard import query_budget
+from applications.metrics import metrics
+from applications.rate_limit import rate_limiter
+import applications.jobs # registers the scheduled jobs
+from applications.commands import register_commands
+
+
+def create_app(config=None):
     app = Flask(__name__)
 
-    app.config.from_object(Config) # Load configurations from Config class
+    app.config.from_object(config or get_config()) # Load the LMS_CONFIG profile from applications/config.py
     db.init_app(app) # Initialize the database
-
-    api = Api(app, prefix='/api/v1') # Initialize the API with versioning
+    configure_engines(app) # SQLite pragmas, read-only engine
+    cache.init_app(app) # Initialize the response cache
+    principal_cache.init_app(app) # Initialize the auth token -> user cache
+    password_pool.init_app(app) # Initialize the password hashing process pool
+    rating_aggregates.init_app(app) # Bayesian prior of the book ranking
+    co_occurrence.init_app(app) # Window and sizes of the "also borrowed" recommendations
+    stats_rollups.init_app(app) # Rows a write may roll up on top of its own
+    query_budget.init_app(app) # SQL statements allowed per request
+    metrics.init_app(app) # Latency histograms and SQL timings per endpoint
+    rate_limiter.init_app(app) # Token bucket limits per endpoint, shared by the workers
+
+    app.api = Api(app, prefix='/api/v1') # Initialize the API with versioning
     
     app.security = Security(app, user_datastore) # Initialize the Flask-Security extension
 
-    with app.app_context(): # Create all tables and roles if they don't exist
-        db.create_all() 
+    register_resources(app.api)
+    register_commands(app) # flask --app main init-db / seed / migrate / check-query-plans / run-scheduler ...
+    scheduler.init_app(app) # Periodic jobs, started by the serving entry points
+
+    return app
+
+
+def warm_up(app):
+    # Pays the first-request costs up front: mapper configuration and the SQLite dialect initialization
+    # done on the first connection. Called by wsgi.py, so with `gunicorn --preload` the forked workers
+    # inherit it. The pools are emptied afterwards so no connection is shared across the fork.
+    from sqlalchemy.orm import configure_mappers
+    configure_mappers()
+    with app.app_context():
+        for engine in db.engines.values():
+            with engine.connect():
+                pass
+            engine.dispose()
+    return app
 
-        admin = app.security.datastore.find_or_create_role(name='admin',description='Administrator')
-        # manager = app.security.datastore.find_or_create_role(name='manager',description='Manager')
-        user = app.security.datastore.find_or_create_role(name='user',description = 'Customers')
-        if not app.security.datastore.find_user(email="admin@gmail.com"): # Create an admin user if it doesn't exist
-            app.security.datastore.create_user(email="admin@gmail.com", username='admin', password=hash_password("password"),roles = [admin])
-        db.session.commit()
 
-    return app,  api
+def register_resources(api):
+    from applications.auth_api import Login, Register, Logout, PrincipalCacheStats
 
+    api.add_resource(Login,'/login')
+    api.add_resource(Register,'/register')
+    api.add_resource(Logout,'/logout')
+    api.add_resource(PrincipalCacheStats,'/auth/cache_stats') # Hit/miss counters of the principal cache
 
-app, api = create_app() 
+    from applications.library_management_api import AllSections, Sections
+    api.add_resource(Sections,'/section','/section/<int:id>') # Add the Sections resource to the API
+    api.add_resource(AllSections,'/get_all_sections') # Add the AllSections resource to the API
 
+    from applications.library_management_api import Books, BooksAPI
+    api.add_resource(Books,'/book','/book/<int:id>') # Add the Books resource to the API
+    from applications.library_management_api import BookContent
+    api.add_resource(BookContent,'/book/<int:id>/content') # Book file for its owners/borrowers, with Range support
+    from applications.loans import BookBorrow, BookReturn
+    api.add_resource(BookBorrow,'/book/<int:id>/borrow') # Take a copy on loan
+    api.add_resource(BookReturn,'/book/<int:id>/return') # Give it back
+    api.add_resource(BooksAPI,'/<int:section_id>/books') # Add the BooksAPI resource to the API
+    from applications.library_management_api import BulkBooks
+    api.add_resource(BulkBooks,'/books') # Bulk PATCH of the books matching a filter
 
-from applications.auth_api import Login, Register, Logout
+    from applications.library_management_api import Search, TopBooks
+    api.add_resource(Search,'/search') # Full text search over books and sections
+    api.add_resource(TopBooks,'/books/top') # Top rated books, overall or per section
+    from applications.library_management_api import RelatedBooks, Recommendations
+    api.add_resource(RelatedBooks,'/book/<int:id>/related') # Books most often borrowed with a book
+    api.add_resource(Recommendations,'/recommendations') # "Also borrowed" picks for the current user
 
-api.add_resource(Login,'/login')
-api.add_resource(Register,'/register')
-api.add_resource(Logout,'/logout')
+    from applications.library_management_api import CatalogImport, CatalogExport
+    api.add_resource(CatalogImport,'/admin/import/<string:kind>') # Streamed NDJSON/CSV load of sections or books
+    api.add_resource(CatalogExport,'/admin/export/<string:kind>') # Streamed dump in the same formats
 
-from applications.library_management_api import AllSections, Sections
-api.add_resource(Sections,'/section','/section/<int:id>') # Add the Sections resource to the API
-api.add_resource(AllSections,'/get_all_sections') # Add the AllSections resource to the API
+    from applications.stats import AdminStats
+    api.add_resource(AdminStats,'/admin/stats') # Hourly/daily loans, revenue and ratings from the rollup tables
 
-from applications.library_management_api import Books, BooksAPI
-api.add_resource(Books,'/book','/book/<int:id>') # Add the Books resource to the API
-api.add_resource(BooksAPI,'/<int:section_id>/books') # Add the BooksAPI resource to the API
+    from applications.batch import Batch
+    api.add_resource(Batch,'/batch') # Several Books/Sections operations in one request and one transaction
 
+    from applications.metrics import Metrics
+    api.add_resource(Metrics,'/metrics') # Prometheus text format metrics of this process, for admins and scrapers
 
 
 if __name__ == '__main__':
+    from applications.commands import init_db, seed
+    app = create_app()
+    init_db(app) # local runs set up the database themselves, deployments run init-db/seed once
+    seed(app)
+    scheduler.autostart()
     app.run(debug = True)
@@ -0,0 +1,18 @@
+import os
+
+# WSGI entry point: gunicorn 'wsgi:app' (settings in gunicorn.conf.py)
+# Served apps run the production profile unless LMS_CONFIG names another one: the development default of
+# applications/config.py is for `flask --app main run` and the CLI.
+# With --preload the app is built and warmed once in the master, and the forked workers share it
+# instead of each importing and building their own. Nothing here opens a connection or starts a thread:
+# the scheduler is started in the workers once they are ready (post_worker_init in gunicorn.conf.py, one
+# worker runs the jobs). Other servers call scheduler.autostart() in their own post-fork hook, or run
+# `flask --app main run-scheduler` once instead.
+# The rate limit buckets are a file every worker maps (RATE_LIMIT_STORE in production), so the limits
+# hold across them.
+
+os.environ.setdefault('LMS_CONFIG', 'production')
+
+from main import create_app, warm_up
+
+app = warm_up(create_app())